@@ -0,0 +1,104 @@
+"""
+Async variants of the read-heavy API views, served when ``API_ASYNC_VIEWS`` is on (see mysite/asgi.py).
+
+A view using ``AsyncViewMixin`` keeps its ordinary handlers for WSGI and may define ``a``-prefixed coroutine
+twins (``aget``, ``alist``). In async mode ``dispatch`` becomes a coroutine: authentication is answered from the
+local token cache inside the event loop when it can be, handlers with an async twin run on the loop with the
+async ORM, and any other handler runs in a worker thread through ``sync_to_async``. Permission classes must not
+query the database, since they are checked on the loop.
+
+Django's async ORM still runs each query in a thread, but a request only holds one while a query runs, not
+while it waits on the client, the cache or other queries.
+"""
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from rest_framework.response import Response
+
+
+def _owner(cls, name):
+    return next(klass for klass in cls.__mro__ if name in vars(klass))
+
+
+class AsyncViewMixin:
+    # None follows settings.API_ASYNC_VIEWS; as_view(asynchronous=True) forces a mode, e.g. in tests.
+    asynchronous = None
+
+    @classmethod
+    def as_view(cls, *args, **initkwargs):
+        if initkwargs.get('asynchronous') is None:
+            initkwargs['asynchronous'] = (
+                getattr(settings, 'API_ASYNC_VIEWS', False) if cls.asynchronous is None else cls.asynchronous
+            )
+        view = super().as_view(*args, **initkwargs)
+        if initkwargs['asynchronous']:
+            markcoroutinefunction(view)
+        return view
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.asynchronous:
+            return self.adispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_async_handler(self, handler):
+        """
+        Return the async twin of ``handler``, or None. A twin inherited from further up than the handler is
+        ignored, so a subclass that overrides ``get`` alone does not have its parent's ``aget`` served instead.
+        """
+        name = getattr(handler, '__name__', None)
+        if name is None or not hasattr(self, f'a{name}'):
+            return None
+        if not issubclass(_owner(type(self), f'a{name}'), _owner(type(self), name)):
+            return None
+        return getattr(self, f'a{name}')
+
+    async def authenticate(self, request):
+        """Resolve ``request.user`` on the loop when every authenticator can answer without I/O."""
+        for authenticator in request.authenticators:
+            authenticate_cached = getattr(authenticator, 'authenticate_cached', None)
+            result = authenticate_cached(request) if authenticate_cached else NotImplemented
+            if result is NotImplemented:
+                break
+            if result is not None:
+                request.user, request.auth = result
+                return
+        else:
+            # Every authenticator declined without I/O, so the usual path just settles on the anonymous user.
+            self.perform_authentication(request)
+            return
+        await sync_to_async(self.perform_authentication)(request)
+
+    async def adispatch(self, request, *args, **kwargs):
+        """``APIView.dispatch`` for async mode."""
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await self.authenticate(request)
+            self.initial(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            async_handler = self.get_async_handler(handler)
+            if async_handler is not None:
+                response = await async_handler(request, *args, **kwargs)
+            else:
+                response = await sync_to_async(handler)(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class AsyncListModelMixin(AsyncViewMixin):
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.paginator is None:
+            return Response(self.get_serializer([row async for row in queryset.aiterator()], many=True).data)
+        page = await self.paginator.apaginate_queryset(queryset, request, view=self)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
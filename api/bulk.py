@@ -0,0 +1,244 @@
+"""
+Bulk create, update and delete for the catalogue viewsets.
+
+``BulkListSerializer`` validates a whole batch in one pass: related ids are checked with one query per
+relation and unique fields with one query per field, instead of one query per item. ``BulkModelMixin`` then
+writes the valid items with ``bulk_create``/``bulk_update`` in one transaction. Invalid items are reported
+per item and skipped, as ``bulk_transition`` does for borrow requests.
+"""
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.relations import ManyRelatedField
+from rest_framework.response import Response
+from rest_framework.validators import UniqueValidator
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Checks ids against ``known_ids`` when a bulk serializer has preloaded them, instead of one query per id."""
+    known_ids = None
+
+    def to_internal_value(self, data):
+        if self.known_ids is None:
+            return super().to_internal_value(data)
+        pk = _as_pk(data)
+        if pk is None:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in self.known_ids:
+            self.fail('does_not_exist', pk_value=data)
+        return self.queryset.model(pk=pk)
+
+
+def _as_pk(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    def check_list(self, items):
+        """Reject payloads that are not a list of an acceptable length."""
+        if not isinstance(items, list):
+            self.fail('not_a_list', input_type=type(items).__name__)
+        if not items and not self.allow_empty:
+            self.fail('empty')
+        if self.max_length is not None and len(items) > self.max_length:
+            self.fail('max_length', max_length=self.max_length)
+
+    def validate_items(self, items, instances=None):
+        """
+        Validate ``items`` and return one ``[attrs, errors]`` pair per item, in order.
+
+        ``instances`` holds the object each item updates, for bulk updates.
+        """
+        self._preload_relations(items)
+        unique_fields = self._take_unique_validators()
+        results = []
+        for index, item in enumerate(items):
+            self.child.instance = instances[index] if instances else None
+            try:
+                results.append([self.child.run_validation(item), None])
+            except serializers.ValidationError as exc:
+                results.append([None, exc.detail])
+        self.child.instance = None
+
+        for field_name, source, message in unique_fields:
+            self._check_unique(results, field_name, source, message, instances)
+        return results
+
+    def _preload_relations(self, items):
+        for name, field in self.child.fields.items():
+            many = isinstance(field, ManyRelatedField)
+            relation = field.child_relation if many else field
+            if field.read_only or not isinstance(relation, PreloadedPrimaryKeyRelatedField):
+                continue
+            ids = set()
+            for item in items:
+                value = item.get(name) if isinstance(item, dict) else None
+                for pk in (value if many and isinstance(value, list) else [value]):
+                    if _as_pk(pk) is not None:
+                        ids.add(_as_pk(pk))
+            relation.known_ids = set(relation.get_queryset().filter(pk__in=ids).values_list('pk', flat=True))
+
+    def _take_unique_validators(self):
+        """Remove per-item uniqueness queries from the child's fields; they are checked for the batch instead."""
+        unique_fields = []
+        for name, field in self.child.fields.items():
+            unique = [validator for validator in field.validators if isinstance(validator, UniqueValidator)]
+            if unique:
+                field.validators = [validator for validator in field.validators if validator not in unique]
+                unique_fields.append((name, field.source, unique[0].message))
+        return unique_fields
+
+    def _check_unique(self, results, field_name, source, message, instances):
+        claimed = {}
+        for index, (attrs, errors) in enumerate(results):
+            if attrs is None or source not in attrs:
+                continue
+            if attrs[source] in claimed:
+                results[index] = [None, {field_name: [message]}]
+            else:
+                claimed[attrs[source]] = index
+
+        model = self.child.Meta.model
+        taken = model.objects.filter(**{f'{source}__in': list(claimed)}).values_list(source, 'pk')
+        for value, pk in taken:
+            index = claimed[value]
+            if not instances or instances[index].pk != pk:
+                results[index] = [None, {field_name: [message]}]
+
+
+class BulkModelMixin:
+    """
+    Adds a ``bulk`` route taking a list of objects: POST creates them, PATCH updates the listed fields of
+    objects identified by ``id`` and DELETE removes objects given by id.
+
+    Subclasses may override ``prepare_bulk_instance`` to fill derived fields that ``save()`` would set,
+    ``bulk_written`` to do what ``post_save`` receivers would, since bulk writes do not send it, and
+    ``perform_bulk_delete`` to delete without per-row delete receivers.
+    """
+    bulk_max_items = getattr(settings, 'API_BULK_MAX_ITEMS', 500)
+
+    @action(detail=False, methods=['post', 'patch', 'delete'])
+    def bulk(self, request):
+        if request.method == 'DELETE':
+            results = self.bulk_delete(request.data)
+        else:
+            results = self.bulk_save(request.data, partial=request.method == 'PATCH')
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+    def prepare_bulk_instance(self, instance, attrs):
+        """Return extra model fields changed on ``instance`` beyond ``attrs``."""
+        return ()
+
+    def bulk_written(self, ids):
+        pass
+
+    def perform_bulk_delete(self, queryset):
+        queryset.delete()
+
+    def _bulk_instances(self, items, results):
+        ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+        instances = self.get_queryset().in_bulk([_as_pk(pk) for pk in ids if _as_pk(pk) is not None])
+        found, seen = [], set()
+        for index, pk in enumerate(ids):
+            instance = instances.get(_as_pk(pk))
+            if instance is None:
+                results[index].update(ok=False, errors={'id': ['Not found.']})
+                continue
+            if instance.pk in seen:
+                results[index].update(ok=False, errors={'id': ['Listed more than once.']})
+                continue
+            seen.add(instance.pk)
+            try:
+                self.check_object_permissions(self.request, instance)
+            except PermissionDenied as exc:
+                results[index].update(ok=False, errors={'id': [str(exc.detail)]})
+                continue
+            found.append((index, instance))
+        return found
+
+    def bulk_save(self, items, partial):
+        serializer = self.get_serializer(
+            many=True, partial=partial, allow_empty=False, max_length=self.bulk_max_items,
+        )
+        serializer.check_list(items)
+
+        if partial:
+            results = [{'id': item.get('id') if isinstance(item, dict) else None, 'ok': False} for item in items]
+            targets = self._bulk_instances(items, results)
+            instances = [instance for _, instance in targets]
+        else:
+            results = [{'ok': False} for _ in items]
+            targets = [(index, None) for index in range(len(items))]
+            instances = None
+        validated = serializer.validate_items([items[index] for index, _ in targets], instances)
+
+        model = serializer.child.Meta.model
+        m2m_names = {field.name for field in model._meta.many_to_many}
+        saved, changed_fields = [], set()
+        for (index, instance), (attrs, errors) in zip(targets, validated):
+            if errors is not None:
+                results[index].update(errors=errors)
+                continue
+            fields = {name: value for name, value in attrs.items() if name not in m2m_names}
+            instance = instance or model()
+            for name, value in fields.items():
+                setattr(instance, name, value)
+            changed_fields.update(fields, self.prepare_bulk_instance(instance, attrs))
+            saved.append((index, instance, attrs))
+
+        with transaction.atomic():
+            instances = [instance for _, instance, _ in saved]
+            if partial and changed_fields:
+                model.objects.bulk_update(instances, sorted(changed_fields), batch_size=1000)
+            elif not partial:
+                model.objects.bulk_create(instances, batch_size=1000)
+            for name in m2m_names:
+                self._replace_links(model, name, [(instance, attrs[name]) for _, instance, attrs in saved if name in attrs])
+            if saved:
+                self.bulk_written([instance.pk for instance in instances])
+
+        for index, instance, _ in saved:
+            results[index].update(ok=True, id=instance.pk)
+        return results
+
+    @staticmethod
+    def _replace_links(model, name, links):
+        if not links:
+            return
+        field = model._meta.get_field(name)
+        through = field.remote_field.through
+        source, target = f'{field.m2m_field_name()}_id', f'{field.m2m_reverse_field_name()}_id'
+        through.objects.filter(**{f'{source}__in': [instance.pk for instance, _ in links]}).delete()
+        through.objects.bulk_create(
+            [
+                through(**{source: instance.pk, target: related.pk})
+                for instance, related_objects in links
+                for related in {related.pk: related for related in related_objects}.values()
+            ],
+            batch_size=1000,
+        )
+
+    def bulk_delete(self, items):
+        serializer = serializers.ListField(
+            child=serializers.IntegerField(), allow_empty=False, max_length=self.bulk_max_items,
+        )
+        ids = serializer.run_validation(
+            [item.get('id') if isinstance(item, dict) else item for item in items]
+            if isinstance(items, list) else items
+        )
+        results = [{'id': pk, 'ok': False} for pk in ids]
+        targets = self._bulk_instances([{'id': pk} for pk in ids], results)
+        with transaction.atomic():
+            self.perform_bulk_delete(
+                self.get_queryset().model.objects.filter(pk__in=[instance.pk for _, instance in targets]),
+            )
+        for index, _ in targets:
+            results[index]['ok'] = True
+        return results
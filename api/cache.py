@@ -0,0 +1,210 @@
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+BOOKS = 'books'
+AUTHORS = 'authors'
+GENRES = 'genres'
+
+
+def book_namespace(book_id):
+    return f'book:{book_id}'
+
+
+def get_catalogue_cache():
+    return caches[settings.CATALOGUE_CACHE_ALIAS]
+
+
+def _generation_key(namespace):
+    return f'catalogue:generation:{namespace}'
+
+
+def get_generations(namespaces):
+    """Return the current generation (a timestamp) of every namespace, starting missing ones now."""
+    cache = get_catalogue_cache()
+    keys = {_generation_key(namespace): namespace for namespace in namespaces}
+    generations = {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
+
+    for key, namespace in keys.items():
+        if namespace not in generations:
+            cache.add(key, time.time(), timeout=None)
+            generations[namespace] = cache.get(key)
+    return generations
+
+
+async def aget_generations(namespaces):
+    """``get_generations`` through the cache's async API."""
+    cache = get_catalogue_cache()
+    keys = {_generation_key(namespace): namespace for namespace in namespaces}
+    generations = {keys[key]: value for key, value in (await cache.aget_many(list(keys))).items()}
+
+    for key, namespace in keys.items():
+        if namespace not in generations:
+            await cache.aadd(key, time.time(), timeout=None)
+            generations[namespace] = await cache.aget(key)
+    return generations
+
+
+def _bump(namespaces):
+    cache = get_catalogue_cache()
+    now = time.time()
+    cache.set_many({_generation_key(namespace): now for namespace in namespaces}, timeout=None)
+
+
+def invalidate(*namespaces):
+    """
+    Move the given namespaces to a new generation, which orphans every cached response built from them.
+
+    The bump is repeated once the surrounding transaction commits, so a response cached by a concurrent
+    request that still read the old rows cannot outlive the write.
+    """
+    if not namespaces:
+        return
+    _bump(namespaces)
+    transaction.on_commit(lambda: _bump(namespaces))
+
+
+class _Validators:
+    """ETag and Last-Modified for a response built from ``stamps``, keyed by ``identity``."""
+
+    def __init__(self, identity, stamps, last_modified):
+        self.fingerprint = hashlib.sha1(repr((identity, stamps)).encode()).hexdigest()
+        self.etag = quote_etag(self.fingerprint)
+        self.last_modified = last_modified
+
+    def not_modified(self, request):
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+        if response is not None:
+            response['ETag'] = self.etag
+        return response
+
+    def tag(self, response):
+        response['ETag'] = self.etag
+        response['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+
+def _catalogue_validators(request, generations):
+    validators = _Validators(
+        request.build_absolute_uri(), sorted(generations.items()), int(max(generations.values())),
+    )
+    return validators, validators.not_modified(request)
+
+
+def _version_validators(request, stamps):
+    validators = _Validators(
+        request.get_full_path(),
+        [stamp and stamp.isoformat() for stamp in stamps],
+        int(max(stamp.timestamp() for stamp in stamps if stamp is not None)),
+    )
+    return validators, validators.not_modified(request)
+
+
+def cache_catalogue_response(*namespaces, anonymous_only=False):
+    """
+    Cache a GET handler's response data per URL until one of ``namespaces`` is invalidated.
+
+    Namespaces may be callables receiving the view kwargs, for per-object entries. Responses carry an
+    ETag and Last-Modified derived from the namespace generations, and matching conditional requests are
+    answered with 304 before the handler or the cache entry is touched. Coroutine handlers use the cache's
+    async API.
+    """
+    def bypass(request):
+        return request.method != 'GET' or (anonymous_only and request.user.is_authenticated)
+
+    def resolve(kwargs):
+        return [namespace(**kwargs) if callable(namespace) else namespace for namespace in namespaces]
+
+    def cache_key(view, validators):
+        return f'catalogue:response:{view.__class__.__name__}:{validators.fingerprint}'
+
+    def decorator(method):
+        if iscoroutinefunction(method):
+            @wraps(method)
+            async def async_wrapper(view, request, *args, **kwargs):
+                if bypass(request):
+                    return await method(view, request, *args, **kwargs)
+
+                validators, not_modified = _catalogue_validators(request, await aget_generations(resolve(kwargs)))
+                if not_modified is not None:
+                    return not_modified
+
+                cache = get_catalogue_cache()
+                data = await cache.aget(cache_key(view, validators))
+                if data is not None:
+                    return validators.tag(Response(data, status=status.HTTP_200_OK))
+                response = await method(view, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                await cache.aset(cache_key(view, validators), response.data, timeout=settings.CATALOGUE_CACHE_TIMEOUT)
+                return validators.tag(response)
+            return async_wrapper
+
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if bypass(request):
+                return method(view, request, *args, **kwargs)
+
+            validators, not_modified = _catalogue_validators(request, get_generations(resolve(kwargs)))
+            if not_modified is not None:
+                return not_modified
+
+            cache = get_catalogue_cache()
+            data = cache.get(cache_key(view, validators))
+            if data is not None:
+                return validators.tag(Response(data, status=status.HTTP_200_OK))
+            response = method(view, request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            cache.set(cache_key(view, validators), response.data, timeout=settings.CATALOGUE_CACHE_TIMEOUT)
+            return validators.tag(response)
+        return wrapper
+    return decorator
+
+
+def conditional_on_versions(versions):
+    """
+    Answer conditional GETs from row versions before the handler runs, and tag full responses with them.
+
+    ``versions(view, request, **kwargs)`` returns the ``updated_at`` values the response is built from (None
+    entries allowed), or None to skip the check, e.g. when the object does not exist and the handler should
+    report that. Coroutine handlers take a coroutine ``versions``.
+    """
+    def decorator(method):
+        if iscoroutinefunction(method):
+            @wraps(method)
+            async def async_wrapper(view, request, *args, **kwargs):
+                stamps = await versions(view, request, **kwargs)
+                if stamps is None:
+                    return await method(view, request, *args, **kwargs)
+
+                validators, not_modified = _version_validators(request, stamps)
+                if not_modified is not None:
+                    return not_modified
+                response = await method(view, request, *args, **kwargs)
+                return validators.tag(response) if response.status_code == status.HTTP_200_OK else response
+            return async_wrapper
+
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            stamps = versions(view, request, **kwargs)
+            if stamps is None:
+                return method(view, request, *args, **kwargs)
+
+            validators, not_modified = _version_validators(request, stamps)
+            if not_modified is not None:
+                return not_modified
+            response = method(view, request, *args, **kwargs)
+            return validators.tag(response) if response.status_code == status.HTTP_200_OK else response
+        return wrapper
+    return decorator
@@ -0,0 +1,124 @@
+"""
+Server-sent events for borrow request status changes.
+
+``hub`` is an in-process publish/subscribe registry keyed by borrower. ``borrow_requests_changed`` is relayed
+to it from whichever thread committed the change, and every subscriber is woken on its own event loop with
+``call_soon_threadsafe``. An idle subscriber is one small slotted object plus, while it waits, one future, so
+a process can hold many open streams for the cost of the connections themselves.
+
+Events only reach clients connected to the process that made the change. Streams therefore open with a
+snapshot of the caller's open requests and close after ``EVENTS_MAX_AGE``, so a client that reconnects is
+brought up to date even if a change was published elsewhere.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from myapp.models import BorrowRequest
+
+
+class Subscription:
+    """One open stream: events for ``user_id`` waiting to be sent, delivered on ``loop``."""
+    __slots__ = ('user_id', 'loop', 'pending', 'waiter')
+
+    def __init__(self, user_id, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.pending = None
+        self.waiter = None
+
+    def deliver(self, event, buffer):
+        """Queue ``event``, dropping the oldest beyond ``buffer``; runs on ``loop``."""
+        if self.pending is None:
+            self.pending = deque(maxlen=buffer)
+        self.pending.append(event)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def next(self, timeout):
+        """Return the next event, or ``None`` if none arrives within ``timeout`` seconds."""
+        if not self.pending:
+            self.waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except TimeoutError:
+                pass
+            finally:
+                self.waiter = None
+            if not self.pending:
+                return None
+        return self.pending.popleft()
+
+
+class EventHub:
+    def __init__(self, buffer=100):
+        self.buffer = buffer
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    def subscribe(self, user_id):
+        """Register a stream for ``user_id`` on the running event loop."""
+        subscription = Subscription(user_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id, event):
+        """Send ``event`` to every stream of ``user_id``. Safe to call from any thread."""
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event, self.buffer)
+            except RuntimeError:
+                # The loop has closed without the stream unsubscribing.
+                self.unsubscribe(subscription)
+
+
+hub = EventHub(buffer=getattr(settings, 'EVENTS_BUFFER', 100))
+
+
+def status_event(borrow_request_id, book_id, status):
+    return {'id': borrow_request_id, 'book': book_id, 'status': status}
+
+
+def open_requests(user):
+    """The caller's open borrow requests, sent as the ``snapshot`` event when a stream opens."""
+    rows = BorrowRequest.objects.filter(borrower=user, status__in=BorrowRequest.OPEN_STATUSES).order_by('pk')
+    return [status_event(*row) for row in rows.values_list('pk', 'book_id', 'status')]
+
+
+def format_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+async def stream(subscription, snapshot, heartbeat, max_age):
+    """
+    Yield the ``snapshot`` event, then one ``status`` event per change and a comment every ``heartbeat``
+    seconds without one, until ``max_age`` seconds have passed or the client goes away.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_age
+    try:
+        yield format_event('snapshot', {'borrow_requests': snapshot})
+        while (remaining := deadline - loop.time()) > 0:
+            event = await subscription.next(min(heartbeat, remaining))
+            yield ': keepalive\n\n' if event is None else format_event('status', event)
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,173 @@
+"""
+Streaming exports of the catalogue and the borrow history.
+
+Rows are read with ``values_list(...).iterator()`` and encoded one at a time as the response is sent, so
+memory use does not grow with the table and the first bytes go out as soon as the first chunk is read.
+
+Each export has an async twin (``astream_...``) reading with ``aiterator()`` for requests served by the ASGI
+handler, which would otherwise consume a sync generator in a thread and buffer the whole export before sending it.
+"""
+import csv
+import json
+from itertools import groupby
+from operator import itemgetter
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from myapp.models import Book, BorrowRequest
+
+CHUNK_SIZE = 2000
+
+BOOK_FIELDS = ('id', 'title', 'summary', 'isbn', 'available_count', 'published_date', 'publisher')
+BORROW_HISTORY_COLUMNS = (
+    ('id', 'id'),
+    ('book_id', 'book_id'),
+    ('book_title', 'book__title'),
+    ('borrower_id', 'borrower_id'),
+    ('borrower', 'borrower__username'),
+    ('status', 'status'),
+    ('request_date', 'request_date'),
+    ('approval_date', 'approval_date'),
+    ('due_date', 'due_date'),
+    ('complete_date', 'complete_date'),
+    ('overdue', 'overdue'),
+)
+BORROW_HISTORY_SOURCES = tuple(source for _, source in BORROW_HISTORY_COLUMNS)
+
+
+class Echo:
+    """File-like object whose ``write`` hands the written line back, for streaming ``csv.writer`` output."""
+
+    def write(self, value):
+        return value
+
+
+async def _arows(queryset, fields):
+    """
+    Async ``queryset.values_list(*fields).iterator()``. Django 5.1 runs a ``values_list`` query straight on the
+    event loop in ``aiterator``, so rows are read as dicts, which it fetches in a thread, and turned back into tuples.
+    """
+    row_tuple = itemgetter(*fields)
+    async for row in queryset.values(*fields).aiterator(chunk_size=CHUNK_SIZE):
+        yield row_tuple(row)
+
+
+def _link_rows(through, column):
+    return through.objects.order_by('book_id', column)
+
+
+class _Links:
+    """Walks ``(book_id, related_id)`` rows ordered by book id alongside a stream of ascending book ids."""
+
+    def __init__(self, through, column):
+        rows = _link_rows(through, column).values_list('book_id', column).iterator(chunk_size=CHUNK_SIZE)
+        self._groups = (
+            (book_id, [related_id for _, related_id in group]) for book_id, group in groupby(rows, key=itemgetter(0))
+        )
+        self._current = next(self._groups, None)
+
+    def pop(self, book_id):
+        while self._current is not None and self._current[0] < book_id:
+            self._current = next(self._groups, None)
+        if self._current is None or self._current[0] != book_id:
+            return []
+        related = self._current[1]
+        self._current = next(self._groups, None)
+        return related
+
+
+async def _agroup_links(through, column):
+    """Async ``groupby`` of the link rows: ``(book_id, [related_id, ...])`` for each book with any."""
+    book_id, related = None, []
+    async for row_book_id, related_id in _arows(_link_rows(through, column), ('book_id', column)):
+        if row_book_id != book_id and related:
+            yield book_id, related
+            related = []
+        book_id = row_book_id
+        related.append(related_id)
+    if related:
+        yield book_id, related
+
+
+class _AsyncLinks:
+    """``_Links`` read with ``aiterator()``; ``await start()`` before the first ``pop``."""
+
+    def __init__(self, through, column):
+        self._groups = _agroup_links(through, column)
+        self._current = None
+
+    async def start(self):
+        self._current = await anext(self._groups, None)
+
+    async def pop(self, book_id):
+        while self._current is not None and self._current[0] < book_id:
+            self._current = await anext(self._groups, None)
+        if self._current is None or self._current[0] != book_id:
+            return []
+        related = self._current[1]
+        self._current = await anext(self._groups, None)
+        return related
+
+    async def aclose(self):
+        await self._groups.aclose()
+
+
+def _book_line(row, authors, genres):
+    book = dict(zip(BOOK_FIELDS, row))
+    book['authors'] = authors
+    book['genres'] = genres
+    return json.dumps(book, cls=DjangoJSONEncoder) + '\n'
+
+
+def stream_books_jsonl():
+    """Yield every book as one JSON line, with author and genre ids merged in from the through tables."""
+    authors = _Links(Book.authors.through, 'author_id')
+    genres = _Links(Book.genres.through, 'genre_id')
+    rows = Book.objects.order_by('id').values_list(*BOOK_FIELDS).iterator(chunk_size=CHUNK_SIZE)
+    for row in rows:
+        yield _book_line(row, authors.pop(row[0]), genres.pop(row[0]))
+
+
+async def astream_books_jsonl():
+    """``stream_books_jsonl`` for the ASGI handler."""
+    authors = _AsyncLinks(Book.authors.through, 'author_id')
+    genres = _AsyncLinks(Book.genres.through, 'genre_id')
+    try:
+        await authors.start()
+        await genres.start()
+        async for row in _arows(Book.objects.order_by('id'), BOOK_FIELDS):
+            yield _book_line(row, await authors.pop(row[0]), await genres.pop(row[0]))
+    finally:
+        await authors.aclose()
+        await genres.aclose()
+
+
+def _borrow_history():
+    """The header line of the borrow history CSV and a function encoding one row of it."""
+    writer = csv.writer(Echo())
+    statuses = dict(BorrowRequest.STATUS_CHOICES)
+    status_position = [name for name, _ in BORROW_HISTORY_COLUMNS].index('status')
+
+    def encode(row):
+        row = [value.isoformat() if hasattr(value, 'isoformat') else value for value in row]
+        row[status_position] = statuses[row[status_position]]
+        return writer.writerow(row)
+
+    return writer.writerow([name for name, _ in BORROW_HISTORY_COLUMNS]), encode
+
+
+def stream_borrow_history_csv(queryset):
+    """Yield ``queryset`` as CSV lines, header first."""
+    header, encode = _borrow_history()
+    yield header
+    rows = queryset.order_by('id').values_list(*BORROW_HISTORY_SOURCES)
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield encode(row)
+
+
+async def astream_borrow_history_csv(queryset):
+    """``stream_borrow_history_csv`` for the ASGI handler."""
+    header, encode = _borrow_history()
+    yield header
+    async for row in _arows(queryset.order_by('id'), BORROW_HISTORY_SOURCES):
+        yield encode(row)
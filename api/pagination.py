@@ -0,0 +1,173 @@
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class _PageQuery(Exception):
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+
+class _Replay:
+    """
+    Queryset stand-in for running the synchronous ``paginate_queryset`` from async code. Without ``rows`` it
+    raises the page query instead of running it; with ``rows`` it hands back the rows fetched for that query.
+    ``CursorPagination`` only ever orders, filters and then slices its queryset once.
+    """
+
+    def __init__(self, queryset, rows=None):
+        self.queryset = queryset
+        self.rows = rows
+
+    def order_by(self, *fields):
+        return _Replay(self.queryset.order_by(*fields), self.rows)
+
+    def filter(self, *args, **kwargs):
+        return _Replay(self.queryset.filter(*args, **kwargs), self.rows)
+
+    def __getitem__(self, index):
+        if self.rows is None:
+            raise _PageQuery(self.queryset[index])
+        return self.rows
+
+
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 100)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` with the page read through the async ORM."""
+        try:
+            return self.paginate_queryset(_Replay(queryset), request, view=view)
+        except _PageQuery as query:
+            page_query = query.queryset
+        rows = [row async for row in page_query.aiterator(chunk_size=self.page_size + 1)]
+        return self.paginate_queryset(_Replay(queryset, rows), request, view=view)
+
+
+class KeysetCursorPagination(IdCursorPagination):
+    """
+    Cursor pagination over an ordering of non-null fields ending in a unique one, such as ``('-request_date',
+    '-id')``.
+
+    ``CursorPagination`` positions its cursors on the first ordering field alone and steps over rows sharing that
+    value with an offset, so runs of equal values are read with offset scans and can be skipped past
+    ``offset_cutoff``. These cursors hold the value of every ordering field instead, and a page starts strictly
+    after the row they name, bounded on the first field as well so the query seeks along the matching index.
+    Every position is unique, so the links never carry an offset.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (self.cursor.reverse, self.cursor.position) if self.cursor else (False, None)
+
+        queryset = queryset.order_by(*(_flip(field) for field in self.ordering) if reverse else self.ordering)
+        if position is not None:
+            try:
+                queryset = queryset.filter(self._after(position, reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following = self._get_position_from_instance(results[-1], self.ordering) if len(results) > self.page_size \
+            else None
+
+        # Positions are kept from the direction of travel: the row past the page, and the row the cursor named.
+        ahead, behind = (following, position) if not reverse else (position, following)
+        if reverse:
+            self.page.reverse()
+        self.has_next, self.next_position = ahead is not None, ahead
+        self.has_previous, self.previous_position = behind is not None, behind
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def _after(self, position, reverse):
+        """The rows past ``position`` in the direction of travel, as one ``Q``."""
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        fields = [(field.lstrip('-'), field.startswith('-') != reverse) for field in self.ordering]
+        condition = None
+        for (name, descending), value in reversed(list(zip(fields, values))):
+            past = Q(**{f'{name}__{"lt" if descending else "gt"}': value})
+            condition = past if condition is None else past | (Q(**{name: value}) & condition)
+        name, descending = fields[0]
+        return Q(**{f'{name}__{"lte" if descending else "gte"}': values[0]}) & condition
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = [
+            instance[field.lstrip('-')] if isinstance(instance, dict) else getattr(instance, field.lstrip('-'))
+            for field in ordering
+        ]
+        return json.dumps([str(value) for value in values], separators=(',', ':'))
+
+
+def _flip(field):
+    return field[1:] if field.startswith('-') else f'-{field}'
+
+
+class BorrowRequestCursorPagination(KeysetCursorPagination):
+    ordering = ('-request_date', '-id')
+
+
+class OverdueCursorPagination(KeysetCursorPagination):
+    ordering = ('due_date', 'id')
+
+
+class AnalyticsPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = getattr(settings, 'API_MAX_PAGE_SIZE', 100)
+
+
+class SearchPagination(LimitOffsetPagination):
+    """Limit/offset paging over ranked hits that probes one hit past the page instead of counting matches."""
+    default_limit = 20
+    max_limit = getattr(settings, 'API_MAX_PAGE_SIZE', 100)
+
+    def paginate_hits(self, search, request):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        hits = search(limit=self.limit + 1, offset=self.offset)
+        self.has_next = len(hits) > self.limit
+        return hits[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_previous_link(self):
+        if self.offset <= 0:
+            return None
+        url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+        if self.offset - self.limit <= 0:
+            return remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.offset_query_param, self.offset - self.limit)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
@@ -3,7 +3,8 @@ from datetime import date
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from rest_framework import serializers
-from myapp.models import BorrowRequest, Book, Genre, Author
+from myapp.models import BorrowRequest, Book, CirculationRollup, Genre, Author, Hold, UserLoanStats
+from .bulk import BulkListSerializer, PreloadedPrimaryKeyRelatedField
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -26,15 +27,23 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 
 class BorrowRequestHistorySerializer(serializers.ModelSerializer):
+    book_title = serializers.CharField(source='book.title', read_only=True)
+
     class Meta:
         model = BorrowRequest
-        fields = ['book', 'borrower', 'status', 'request_date', 'approval_date', 'due_date', 'complete_date', 'overdue']
+        fields = ['book', 'book_title', 'borrower', 'status', 'request_date', 'approval_date', 'due_date',
+                  'complete_date', 'overdue']
 
 
 class BookSerializer(serializers.ModelSerializer):
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
+    available = serializers.BooleanField(read_only=True)
+
     class Meta:
         model = Book
-        fields = ['id', 'title', 'summary', 'isbn', 'available', 'published_date', 'publisher', 'genres', 'authors']
+        fields = ['id', 'title', 'summary', 'isbn', 'available', 'available_count', 'published_date', 'publisher',
+                  'genres', 'authors', 'borrow_count']
+        list_serializer_class = BulkListSerializer
 
     def validate_published_date(self, value):
         if value > date.today():
@@ -46,29 +55,67 @@ class AuthorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Author
         fields = ['id', 'name', 'bio']
+        list_serializer_class = BulkListSerializer
 
 
 class GenreSerializer(serializers.ModelSerializer):
     class Meta:
         model = Genre
         fields = ['id', 'name']
+        list_serializer_class = BulkListSerializer
 
 
 class BookStockSerializer(serializers.ModelSerializer):
+    summary = serializers.CharField(source='summary_excerpt', read_only=True)
+    available = serializers.BooleanField(read_only=True)
+    availability_status = serializers.CharField(read_only=True)
+
     class Meta:
         model = Book
-        fields = ['id', 'title', 'authors', 'summary', 'available']
+        fields = ['id', 'title', 'authors', 'summary', 'available', 'available_count', 'availability_status']
 
 
 class BorrowRequestSerializer(serializers.ModelSerializer):
     class Meta:
         model = BorrowRequest
         fields = ['id', 'book', 'borrower', 'status', 'overdue', 'request_date', 'approval_date', 'due_date', 'complete_date']
-        read_only_fields = ['borrower', 'request_date', 'overdue']
+        # Requests are made with myapp.services.borrow_or_hold and moved on by its transitions, never written as is.
+        read_only_fields = ['borrower', 'status', 'overdue', 'request_date', 'approval_date', 'due_date',
+                            'complete_date']
+
+
+class HoldSerializer(serializers.ModelSerializer):
+    # Set on the instance by the view, from myapp.services.hold_position.
+    position = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Hold
+        fields = ['id', 'book', 'user', 'created_at', 'position']
+
+
+class UserLoanStatsSerializer(serializers.ModelSerializer):
+    # Summaries are served from myapp.history as dicts holding the user id.
+    user = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = UserLoanStats
+        fields = ['user', 'active_loans', 'loans', 'pending', 'approved', 'collected', 'complete', 'declined',
+                  'next_due_date']
+
+
+class BorrowRequestTransitionSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    action = serializers.CharField()
+    due_date = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+
+
+class CirculationQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    dimension = serializers.ChoiceField(choices=CirculationRollup.DIMENSION_CHOICES, default=CirculationRollup.TOTAL)
+    granularity = serializers.ChoiceField(choices=['day', 'week', 'total'], default='day')
 
     def validate(self, data):
-        if data.get('status') == BorrowRequest.APPROVED and not data.get('approval_date'):
-            raise serializers.ValidationError("Approval date is required when status is 'Approved'.")
-        if data.get('status') == BorrowRequest.COMPLETE and not data.get('complete_date'):
-            raise serializers.ValidationError("Complete date is required when status is 'Complete'.")
+        if data.get('start') and data.get('end') and data['start'] > data['end']:
+            raise serializers.ValidationError("Start date must not be after end date.")
         return data
@@ -0,0 +1,82 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from mysite.authentication import invalidate_token
+from myapp.models import Author, Book, Genre
+from myapp.signals import books_changed, borrow_requests_changed, in_bulk_delete, relations_changed
+from . import cache, events
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_book(sender, instance, **kwargs):
+    cache.invalidate(cache.BOOKS, cache.book_namespace(instance.pk))
+
+
+@receiver(books_changed)
+def invalidate_changed_books(sender, book_ids, **kwargs):
+    cache.invalidate(cache.BOOKS, *(cache.book_namespace(book_id) for book_id in book_ids))
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.genres.through)
+def invalidate_book_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    # Reverse clears are handled before the through rows disappear, while the affected books can still be read.
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        book_ids = [instance.pk]
+    elif action == 'pre_clear':
+        book_ids = list(instance.books.values_list('pk', flat=True))
+    else:
+        book_ids = pk_set
+    cache.invalidate(cache.BOOKS, *(cache.book_namespace(book_id) for book_id in book_ids))
+
+
+@receiver(post_save, sender=Author)
+def invalidate_author(sender, instance, **kwargs):
+    cache.invalidate(cache.AUTHORS)
+
+
+@receiver(post_save, sender=Genre)
+def invalidate_genre(sender, instance, **kwargs):
+    cache.invalidate(cache.GENRES)
+
+
+@receiver(relations_changed)
+def invalidate_bulk_relations(sender, **kwargs):
+    cache.invalidate(cache.AUTHORS if sender is Author else cache.GENRES)
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def invalidate_deleted_relation(sender, instance, **kwargs):
+    # Deleting an author or genre drops its through rows without sending m2m_changed.
+    if in_bulk_delete():
+        return
+    namespace = cache.AUTHORS if sender is Author else cache.GENRES
+    book_ids = list(instance.books.values_list('pk', flat=True))
+    cache.invalidate(namespace, cache.BOOKS, *(cache.book_namespace(book_id) for book_id in book_ids))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    # Cached tokens carry a copy of the user, so permission or activity changes must drop them.
+    if created:
+        return
+    for key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+@receiver(borrow_requests_changed)
+def publish_borrow_request_events(sender, changes, **kwargs):
+    for borrow_request_id, borrower_id, book_id, status in changes:
+        events.hub.publish(borrower_id, events.status_event(borrow_request_id, book_id, status))
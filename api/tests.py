@@ -1,11 +1,31 @@
+import asyncio
+import csv
+import json
+import threading
+import tracemalloc
 from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
-from rest_framework.test import APITestCase
-from myapp.models import Book, BorrowRequest
+from rest_framework.test import APIRequestFactory, APITestCase
+from myapp import history, search, services
+from myapp.models import Author, Book, BorrowRequest, CirculationRollup, Genre, Hold, UserLoanStats
+from myapp.signals import borrow_requests_changed
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
+from . import events
+from .cache import get_catalogue_cache
+from .pagination import BorrowRequestCursorPagination, IdCursorPagination
+from .views import AuthorViewSet, BookDetailView, BookViewSet, BorrowHistoryExportView, BorrowRequestHistoryView, \
+    LibraryFundView
+from mysite.authentication import ExpiringTokenAuthentication, local_tokens
+from mysite.metrics import MetricsRegistry, registry
 
 
 class UserAuthenticationTests(APITestCase):
@@ -105,7 +125,6 @@ class LibraryFundViewTests(APITestCase):
             summary='A long summary of book one that exceeds thirty words for testing purposes.fd g dfg dfg dg dg df '
                     'gd g dg d gf d dg gf d gdg  ' * 2,
             isbn='1234567890123',
-            available=True,
             published_date='2023-01-01',
             publisher='Publisher One'
         )
@@ -113,10 +132,10 @@ class LibraryFundViewTests(APITestCase):
             title='Book Two',
             summary='A short summary of book two.',
             isbn='1234567890124',
-            available=False,
             published_date='2023-02-01',
             publisher='Publisher Two'
         )
+        services.set_copies(self.book2, 0)
 
     def authenticate(self, user_type='regular'):
         """Helper method to authenticate with a token."""
@@ -134,23 +153,28 @@ class LibraryFundViewTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
-        for book in response.data:
+        for book in response.data['results']:
             if book['available']:
                 self.assertEqual(book['availability_status'], 'Available')
             else:
                 self.assertEqual(book['availability_status'], 'Not Available')
 
-        book1_response = next(book for book in response.data if book['title'] == 'Book One')
+        book1_response = next(book for book in response.data['results'] if book['title'] == 'Book One')
         self.assertTrue(book1_response['summary'].endswith('...'))
+        self.assertEqual(len(book1_response['summary'][:-3].split()), 30)
+
+        book2_response = next(book for book in response.data['results'] if book['title'] == 'Book Two')
+        self.assertEqual(book2_response['summary'], 'A short summary of book two.')
 
     def test_post_borrow_request_authenticated(self):
         url = reverse('api_library_fund')
 
         self.authenticate()
 
-        response = self.client.post(url, {'book_id': self.book1.id}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'book_id': self.book1.id}, format='json')
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
@@ -177,9 +201,35 @@ class LibraryFundViewTests(APITestCase):
 
         response = self.client.post(url, {'book_id': self.book2.id}, format='json')
 
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
-
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['hold']['position'], 1)
         self.assertFalse(BorrowRequest.objects.filter(book=self.book2, borrower=self.user).exists())
+        self.assertTrue(Hold.objects.filter(book=self.book2, user=self.user).exists())
+
+    def test_hold_is_promoted_when_a_copy_comes_back(self):
+        url = reverse('api_library_fund')
+        self.authenticate()
+        self.client.post(url, {'book_id': self.book2.id}, format='json')
+
+        hold_url = reverse('api_hold', kwargs={'book_id': self.book2.id})
+        self.assertEqual(self.client.get(hold_url).data['position'], 1)
+
+        services.set_copies(self.book2, 1)
+
+        self.assertEqual(self.client.get(hold_url).status_code, status.HTTP_404_NOT_FOUND)
+        borrow_request = BorrowRequest.objects.get(book=self.book2, borrower=self.user)
+        self.assertEqual(borrow_request.status, BorrowRequest.PENDING)
+
+    def test_leaving_the_hold_queue(self):
+        other = User.objects.create_user(username='other', password='password123')
+        Hold.objects.create(book=self.book2, user=other)
+        self.authenticate()
+        response = self.client.post(reverse('api_library_fund'), {'book_id': self.book2.id}, format='json')
+        self.assertEqual(response.data['hold']['position'], 2)
+
+        hold_url = reverse('api_hold', kwargs={'book_id': self.book2.id})
+        self.assertEqual(self.client.delete(hold_url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(hold_url).status_code, status.HTTP_404_NOT_FOUND)
 
     def test_post_borrow_request_book_not_found(self):
         url = reverse('api_library_fund')
@@ -191,7 +241,7 @@ class LibraryFundViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_token_expiration(self):
-        self.token.created = timezone.now() - timedelta(minutes=2)
+        self.token.created = timezone.now() - settings.TOKEN_TTL - timedelta(minutes=1)
         self.token.save()
 
         self.authenticate()
@@ -204,7 +254,7 @@ class LibraryFundViewTests(APITestCase):
         self.assertEqual(response.data['detail'], 'Token has expired')
 
     def test_superuser_token_not_expire(self):
-        self.superuser_token.created = timezone.now() - timedelta(minutes=2)
+        self.superuser_token.created = timezone.now() - settings.TOKEN_TTL - timedelta(minutes=1)
         self.superuser_token.save()
 
         self.authenticate(user_type='superuser')
@@ -216,6 +266,67 @@ class LibraryFundViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
+class TokenAuthenticationCacheTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.url = reverse('api_home')
+
+    def test_repeated_requests_skip_the_database(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_shared_cache_serves_other_processes(self):
+        self.client.get(self.url)
+        local_tokens.clear()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_token_is_renewed_after_half_its_lifetime(self):
+        issued = timezone.now() - settings.TOKEN_TTL * 0.75
+        Token.objects.filter(pk=self.token.pk).update(created=issued)
+
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+        self.token.refresh_from_db()
+        self.assertGreater(self.token.created, issued + settings.TOKEN_TTL * 0.5)
+
+    def test_fresh_token_is_not_rewritten(self):
+        issued = timezone.now() - settings.TOKEN_TTL * 0.25
+        Token.objects.filter(pk=self.token.pk).update(created=issued)
+
+        self.client.get(self.url)
+
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.created, issued)
+
+    def test_deleted_token_is_rejected_immediately(self):
+        self.client.get(self.url)
+
+        self.token.delete()
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_is_rejected_immediately(self):
+        self.client.get(self.url)
+
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
 class BookDetailViewTests(APITestCase):
 
     def setUp(self):
@@ -226,7 +337,6 @@ class BookDetailViewTests(APITestCase):
             title='Test Book',
             summary='This is a test summary for the book.',
             isbn='1234567890123',
-            available=True,
             published_date='2023-01-01',
             publisher='Test Publisher'
         )
@@ -271,7 +381,8 @@ class BookDetailViewTests(APITestCase):
     def test_post_borrow_book_authenticated(self):
         self.authenticate()
 
-        response = self.client.post(self.url, {'action': 'borrow'}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'action': 'borrow'}, format='json')
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data['detail'], 'Borrow request created.')
@@ -351,7 +462,6 @@ class BorrowRequestViewSetTests(APITestCase):
             title='Test Book',
             summary='This is a test summary for the book.',
             isbn='1234567890123',
-            available=True,
             published_date='2023-01-01',
             publisher='Test Publisher'
         )
@@ -375,6 +485,34 @@ class BorrowRequestViewSetTests(APITestCase):
 
         self.assertTrue(BorrowRequest.objects.filter(book=self.book, borrower=self.user).exists())
 
+    def test_create_borrow_request_claims_a_copy_and_ignores_status(self):
+        self.authenticate(self.user)
+
+        response = self.client.post(self.url_list, {'book': self.book.id, 'status': BorrowRequest.COLLECTED},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], BorrowRequest.PENDING)
+        self.assertIsNotNone(BorrowRequest.objects.get(pk=response.data['id']).copy_id)
+
+        response = self.client.post(self.url_list, {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.authenticate(self.staff_user)
+        response = self.client.post(self.url_list, {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['hold']['user'], self.staff_user.id)
+
+    def test_delete_borrow_request_serves_the_hold_queue(self):
+        borrow_request = services.request_borrow(self.book, self.user)
+        services.borrow_or_hold(self.book, self.staff_user)
+        self.authenticate(self.user)
+
+        response = self.client.delete(self.url_detail(borrow_request.id))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(BorrowRequest.objects.get(borrower=self.staff_user).status, BorrowRequest.PENDING)
+        self.assertFalse(Hold.objects.exists())
+
     def test_create_borrow_request_unauthenticated(self):
         response = self.client.post(self.url_list, {'book': self.book.id}, format='json')
 
@@ -393,8 +531,8 @@ class BorrowRequestViewSetTests(APITestCase):
         response = self.client.get(self.url_list)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['borrower'], self.user.id)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['borrower'], self.user.id)
 
     def test_get_borrow_requests_authenticated_staff(self):
         self.authenticate(self.staff_user)
@@ -415,7 +553,7 @@ class BorrowRequestViewSetTests(APITestCase):
         response = self.client.get(self.url_list)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_update_borrow_request_approve(self):
         self.authenticate(self.staff_user)
@@ -427,8 +565,9 @@ class BorrowRequestViewSetTests(APITestCase):
             request_date=timezone.now()
         )
 
-        response = self.client.put(self.url_detail(borrow_request.id),
-                                   {'action': 'approve', 'due_date': '2024-01-01'}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(self.url_detail(borrow_request.id),
+                                       {'action': 'approve', 'due_date': '2024-01-01'}, format='json')
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['status'], BorrowRequest.APPROVED)
@@ -497,3 +636,1030 @@ class BorrowRequestViewSetTests(APITestCase):
         response = self.client.put(self.url_detail(borrow_request.id), {'action': 'invalid_action'}, format='json')
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CursorPaginationTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+        self.books = [
+            Book.objects.create(
+                title=f'Book {i}',
+                summary='Summary',
+                isbn=f'{i:013d}',
+                published_date='2023-01-01',
+                publisher='Publisher'
+            )
+            for i in range(5)
+        ]
+
+    def test_library_fund_walks_pages_with_cursor(self):
+        url = reverse('api_library_fund')
+
+        first_page = self.client.get(url, {'page_size': 2})
+        self.assertEqual(first_page.status_code, status.HTTP_200_OK)
+        self.assertEqual([book['id'] for book in first_page.data['results']], [b.id for b in self.books[:2]])
+        self.assertIsNone(first_page.data['previous'])
+
+        second_page = self.client.get(first_page.data['next'])
+        self.assertEqual([book['id'] for book in second_page.data['results']], [b.id for b in self.books[2:4]])
+
+        last_page = self.client.get(second_page.data['next'])
+        self.assertEqual([book['id'] for book in last_page.data['results']], [self.books[4].id])
+        self.assertIsNone(last_page.data['next'])
+
+    def test_library_fund_filters_on_availability(self):
+        for index in (1, 3):
+            services.set_copies(self.books[index], 0)
+        url = reverse('api_library_fund')
+
+        available = self.client.get(url, {'available': 'true'})
+        unavailable = self.client.get(url, {'available': 'false'})
+
+        self.assertEqual([book['id'] for book in available.data['results']], [self.books[i].id for i in (0, 2, 4)])
+        self.assertEqual([book['id'] for book in unavailable.data['results']], [self.books[i].id for i in (1, 3)])
+
+    def test_page_size_is_capped(self):
+        url = reverse('book-list')
+
+        with mock.patch.object(IdCursorPagination, 'max_page_size', 3):
+            response = self.client.get(url, {'page_size': 10_000})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_borrow_history_orders_by_request_date_then_id(self):
+        now = timezone.now()
+        older = BorrowRequest.objects.create(book=self.books[0], borrower=self.user, request_date=now - timedelta(days=1))
+        newer_a = BorrowRequest.objects.create(book=self.books[1], borrower=self.user, request_date=now)
+        newer_b = BorrowRequest.objects.create(book=self.books[2], borrower=self.user, request_date=now)
+
+        url = reverse('api_borrow_history')
+        first_page = self.client.get(url, {'page_size': 2})
+        self.assertEqual([item['book'] for item in first_page.data['results']], [newer_b.book_id, newer_a.book_id])
+
+        second_page = self.client.get(first_page.data['next'])
+        self.assertEqual([item['book'] for item in second_page.data['results']], [older.book_id])
+
+    def test_borrow_request_pages_are_stable_over_equal_request_dates(self):
+        now = timezone.now()
+        # Like the requests promote_holds creates in one go.
+        requests = [
+            BorrowRequest.objects.create(book=book, borrower=self.user, request_date=now)
+            for book in self.books * 3
+        ]
+        expected = [borrow_request.pk for borrow_request in reversed(requests)]
+        url = reverse('borrowrequest-list')
+
+        # An offset past the cutoff would be clamped to it; keyset cursors never need one.
+        with mock.patch.object(BorrowRequestCursorPagination, 'offset_cutoff', 2):
+            seen, pages, response = [], [], self.client.get(url, {'page_size': 4})
+            for _ in requests:
+                pages.append(response.data['results'])
+                seen.extend(item['id'] for item in response.data['results'])
+                if response.data['next'] is None:
+                    break
+                response = self.client.get(response.data['next'])
+            self.assertEqual(seen, expected)
+
+            for page in reversed(pages[:-1]):
+                response = self.client.get(response.data['previous'])
+                self.assertEqual(response.data['results'], page)
+            self.assertIsNone(response.data['previous'])
+
+        self.assertEqual(self.client.get(url, {'cursor': 'cD1bIngiXQ=='}).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BookQueryCountTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        # Resolve the token once so every counted request sees it cached.
+        self.client.get(reverse('api_home'))
+
+        self.author = Author.objects.create(name='Author')
+        self.genre = Genre.objects.create(name='Genre')
+        self.book_count = 0
+
+    def add_books(self, count):
+        for _ in range(count):
+            self.book_count += 1
+            book = Book.objects.create(
+                title=f'Book {self.book_count}',
+                summary='Summary',
+                isbn=f'{self.book_count:013d}',
+                published_date='2023-01-01',
+                publisher='Publisher'
+            )
+            book.authors.add(self.author, Author.objects.create(name=f'Author {self.book_count}'))
+            book.genres.add(self.genre)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_list_endpoints_use_constant_query_count(self):
+        for url in (reverse('api_library_fund'), reverse('book-list')):
+            with self.subTest(url=url):
+                self.add_books(2)
+                small = self.count_queries(url)
+                self.add_books(10)
+                large = self.count_queries(url)
+                self.assertEqual(small, large)
+
+    def test_book_detail_query_count_does_not_depend_on_relations(self):
+        self.add_books(1)
+        book = Book.objects.get()
+        url = reverse('api_book-detail', kwargs={'book_id': book.id})
+        few = self.count_queries(url)
+
+        book.authors.add(*[Author.objects.create(name=f'Extra {i}') for i in range(5)])
+        self.assertEqual(self.count_queries(url), few)
+
+
+class CatalogueCacheTests(APITestCase):
+
+    def setUp(self):
+        get_catalogue_cache().clear()
+
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.token = Token.objects.create(user=self.user)
+
+        self.author = Author.objects.create(name='Author')
+        self.book = Book.objects.create(
+            title='Cached Book',
+            summary='Summary',
+            isbn='1234567890123',
+            published_date='2023-01-01',
+            publisher='Publisher'
+        )
+        self.book.authors.add(self.author)
+
+    def test_repeated_anonymous_get_skips_database(self):
+        url = reverse('api_library_fund')
+        self.client.get(url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['title'], 'Cached Book')
+
+    def test_book_save_invalidates_listing_and_detail(self):
+        list_url = reverse('api_library_fund')
+        detail_url = reverse('api_book-detail', kwargs={'book_id': self.book.id})
+        self.client.get(list_url)
+        self.client.get(detail_url)
+
+        self.book.title = 'Renamed Book'
+        self.book.save()
+
+        self.assertEqual(self.client.get(list_url).data['results'][0]['title'], 'Renamed Book')
+        self.assertEqual(self.client.get(detail_url).data['book']['title'], 'Renamed Book')
+
+    def test_m2m_change_invalidates_book_detail(self):
+        url = reverse('api_book-detail', kwargs={'book_id': self.book.id})
+        self.client.get(url)
+
+        other_author = Author.objects.create(name='Other Author')
+        other_author.books.add(self.book)
+
+        self.assertCountEqual(self.client.get(url).data['book']['authors'], [self.author.id, other_author.id])
+
+    def test_author_delete_invalidates_books(self):
+        url = reverse('api_library_fund')
+        self.client.get(url)
+
+        self.author.delete()
+
+        self.assertEqual(self.client.get(url).data['results'][0]['authors'], [])
+
+    def test_author_list_is_invalidated_by_author_save(self):
+        url = reverse('author-list')
+        self.client.get(url)
+
+        Author.objects.create(name='New Author')
+
+        names = [author['name'] for author in self.client.get(url).data['results']]
+        self.assertIn('New Author', names)
+
+    def test_genre_list_is_cached_independently_of_books(self):
+        url = reverse('genre-list')
+        self.client.get(url)
+
+        self.book.save()
+
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+    def test_conditional_get_returns_not_modified(self):
+        url = reverse('api_library_fund')
+        response = self.client.get(url)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.book.save()
+        modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(modified.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(modified['ETag'], response['ETag'])
+
+    def test_authenticated_book_detail_is_not_cached(self):
+        url = reverse('api_book-detail', kwargs={'book_id': self.book.id})
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.client.get(url)
+
+        BorrowRequest.objects.create(book=self.book, borrower=self.user)
+
+        self.assertIsNotNone(self.client.get(url).data['borrow_request'])
+
+
+class BookSearchTests(APITestCase):
+
+    def setUp(self):
+        self.tolkien = Author.objects.create(name='Tolkien')
+        self.fantasy = Genre.objects.create(name='Fantasy')
+
+        self.hobbit = self.create_book('The Hobbit', 'A hobbit goes on an adventure.', 'Allen', '0000000000001')
+        self.hobbit.authors.add(self.tolkien)
+        self.hobbit.genres.add(self.fantasy)
+        self.cookbook = self.create_book('Cooking Basics', 'Recipes, including one a hobbit would enjoy.', 'Penguin',
+                                         '0000000000002')
+        self.atlas = self.create_book('World Atlas', 'Maps of the world.', 'Penguin', '0000000000003')
+
+        self.url = reverse('book-search')
+
+    def create_book(self, title, summary, publisher, isbn):
+        return Book.objects.create(title=title, summary=summary, isbn=isbn, published_date='2023-01-01',
+                                   publisher=publisher)
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book['id'] for book in response.data['results']]
+
+    def test_title_match_ranks_above_summary_match(self):
+        self.assertEqual(self.search(q='hobbit'), [self.hobbit.id, self.cookbook.id])
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.search(q='hob'), [self.hobbit.id, self.cookbook.id])
+
+    def test_all_words_must_match(self):
+        self.assertEqual(self.search(q='world penguin'), [self.atlas.id])
+
+    def test_author_genre_and_publisher_are_searchable(self):
+        self.assertEqual(self.search(q='tolkien'), [self.hobbit.id])
+        self.assertEqual(self.search(q='fantasy'), [self.hobbit.id])
+        self.assertCountEqual(self.search(q='penguin'), [self.cookbook.id, self.atlas.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.atlas.title = 'Sky Atlas'
+        self.atlas.save()
+        self.assertEqual(self.search(q='sky'), [self.atlas.id])
+
+        self.tolkien.name = 'Ronald'
+        self.tolkien.save()
+        self.assertEqual(self.search(q='ronald'), [self.hobbit.id])
+
+        self.fantasy.delete()
+        self.assertEqual(self.search(q='fantasy'), [])
+
+        self.atlas.delete()
+        self.assertEqual(self.search(q='sky'), [])
+
+    def test_pagination(self):
+        response = self.client.get(self.url, {'q': 'hobbit', 'limit': 1})
+        self.assertEqual([book['id'] for book in response.data['results']], [self.hobbit.id])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([book['id'] for book in response.data['results']], [self.cookbook.id])
+        self.assertIsNone(response.data['next'])
+
+    def test_empty_query_is_rejected(self):
+        response = self.client.get(self.url, {'q': '  '})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_inverted_index_backend_matches_fts(self):
+        backend = search.InvertedIndexBackend()
+        backend.index(Book.objects.values_list('pk', flat=True))
+
+        self.assertEqual(backend.search(['hobbit'], limit=10, offset=0), [self.hobbit.id, self.cookbook.id])
+        self.assertEqual(backend.search(['hob'], limit=10, offset=0), [self.hobbit.id, self.cookbook.id])
+        self.assertEqual(backend.search(['world', 'penguin'], limit=10, offset=0), [self.atlas.id])
+        self.assertEqual(backend.search(['hobbit'], limit=1, offset=1), [self.cookbook.id])
+
+
+class BorrowRequestBulkTransitionTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.staff_user = User.objects.create_user(username='staffuser', password='password123', is_staff=True)
+        self.url = reverse('borrowrequest-bulk')
+
+        self.books = [
+            Book.objects.create(title=f'Book {i}', summary='Summary', isbn=f'{i:013d}', published_date='2023-01-01',
+                                publisher='Publisher')
+            for i in range(3)
+        ]
+        self.requests = [BorrowRequest.objects.create(book=book, borrower=self.user) for book in self.books]
+
+    def test_staff_can_apply_transitions_in_bulk(self):
+        self.client.force_authenticate(self.staff_user)
+
+        response = self.client.post(self.url, [
+            {'id': self.requests[0].id, 'action': 'approve', 'due_date': '2030-01-01'},
+            {'id': self.requests[1].id, 'action': 'decline'},
+            {'id': self.requests[2].id, 'action': 'complete'},
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['ok'] for result in response.data['results']], [True, True, False])
+        self.assertEqual(response.data['results'][2]['error'], 'Only collected requests can be completed.')
+        self.assertEqual(
+            list(BorrowRequest.objects.order_by('pk').values_list('status', flat=True)),
+            [BorrowRequest.APPROVED, BorrowRequest.DECLINED, BorrowRequest.PENDING],
+        )
+
+    def test_non_staff_cannot_use_bulk(self):
+        self.client.force_authenticate(self.user)
+
+        response = self.client.post(self.url, [{'id': self.requests[0].id, 'action': 'approve'}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_malformed_items_are_reported_per_item(self):
+        self.client.force_authenticate(self.staff_user)
+
+        response = self.client.post(self.url, [{'id': self.requests[0].id, 'action': 'approve'}, {'action': 'approve'}],
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('id', response.data[1])
+        self.assertEqual(BorrowRequest.objects.filter(status=BorrowRequest.APPROVED).count(), 0)
+
+
+class OverdueBorrowRequestTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.other_user = User.objects.create_user(username='otheruser', password='password123')
+        self.staff_user = User.objects.create_user(username='staffuser', password='password123', is_staff=True)
+        self.url = reverse('borrowrequest-overdue')
+
+        due_date = timezone.now() - timedelta(days=1)
+        self.loans = []
+        for index, borrower in enumerate([self.user, self.other_user, self.user]):
+            book = Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                       published_date='2023-01-01', publisher='Publisher')
+            self.loans.append(BorrowRequest.objects.create(
+                book=book, borrower=borrower, status=BorrowRequest.COLLECTED, due_date=due_date,
+                overdue=index < 2,
+            ))
+
+    def test_lists_only_flagged_loans(self):
+        self.client.force_authenticate(self.staff_user)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in response.data['results']], [self.loans[0].id, self.loans[1].id])
+
+    def test_borrowers_see_only_their_own_loans(self):
+        self.client.force_authenticate(self.user)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual([item['id'] for item in response.data['results']], [self.loans[0].id])
+
+
+class ExportTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        self.author = Author.objects.create(name='Author')
+        self.genre = Genre.objects.create(name='Genre')
+        self.books = []
+        for index in range(3):
+            book = Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                       published_date='2023-01-01', publisher='Publisher')
+            self.books.append(book)
+        self.books[0].authors.add(self.author)
+        self.books[0].genres.add(self.genre)
+        self.books[2].authors.add(self.author)
+        BorrowRequest.objects.create(book=self.books[0], borrower=self.user)
+        BorrowRequest.objects.create(book=self.books[1], borrower=self.staff, status=BorrowRequest.COMPLETE)
+
+    def authenticate(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+
+    def read(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.is_async)
+        return b''.join(response.streaming_content).decode()
+
+    def test_books_jsonl_merges_relations(self):
+        self.authenticate(self.user)
+
+        lines = [json.loads(line) for line in self.read(reverse('api_export_books')).splitlines()]
+
+        self.assertEqual([book['id'] for book in lines], [book.id for book in self.books])
+        self.assertEqual([book['authors'] for book in lines], [[self.author.id], [], [self.author.id]])
+        self.assertEqual([book['genres'] for book in lines], [[self.genre.id], [], []])
+        self.assertEqual(lines[0]['published_date'], '2023-01-01')
+
+    def test_borrow_history_csv_is_scoped_to_the_borrower(self):
+        self.authenticate(self.user)
+
+        rows = list(csv.DictReader(StringIO(self.read(reverse('api_export_borrow_history')))))
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['book_title'], rows[0]['borrower'], rows[0]['status']), ('Book 0', 'reader', 'Pending'))
+
+    def test_staff_export_all_borrow_history(self):
+        self.authenticate(self.staff)
+
+        rows = list(csv.DictReader(StringIO(self.read(reverse('api_export_borrow_history')))))
+
+        self.assertEqual([row['status'] for row in rows], ['Pending', 'Complete'])
+
+    async def test_asgi_exports_stream_from_async_generators(self):
+        token = await Token.objects.acreate(user=self.staff)
+        headers = {'Authorization': f'Token {token.key}'}
+
+        response = await self.async_client.get(reverse('api_export_books'), headers=headers)
+        self.assertTrue(response.is_async)
+        stream = aiter(response.streaming_content)
+        first = json.loads(await anext(stream))
+        self.assertEqual((first['id'], first['authors'], first['genres']),
+                         (self.books[0].id, [self.author.id], [self.genre.id]))
+        rest = [json.loads(line) async for line in stream]
+        self.assertEqual([book['authors'] for book in rest], [[], [self.author.id]])
+
+        response = await self.async_client.get(reverse('api_export_borrow_history'), headers=headers)
+        self.assertTrue(response.is_async)
+        stream = aiter(response.streaming_content)
+        self.assertEqual((await anext(stream)).decode().split(',')[:3], ['id', 'book_id', 'book_title'])
+        rows = list(csv.reader([line.decode() async for line in stream]))
+        self.assertEqual([row[5] for row in rows], ['Pending', 'Complete'])
+
+    def test_exports_require_authentication(self):
+        for url in (reverse('api_export_books'), reverse('api_export_borrow_history')):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class CatalogueBulkTests(APITestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.staff).key)
+        self.client.get(reverse('api_home'))
+        self.author = Author.objects.create(name='Author')
+        self.genre = Genre.objects.create(name='Genre')
+        self.existing = Book.objects.create(title='Existing', summary='Summary', isbn='0000000000001',
+                                            published_date='2023-01-01', publisher='Publisher')
+        self.existing.authors.add(self.author)
+        self.url = reverse('book-bulk')
+
+    def book(self, index, **fields):
+        return dict({
+            'title': f'Book {index}', 'summary': 'word ' * 40, 'isbn': f'{9000 + index:013d}',
+            'published_date': '2023-01-01', 'publisher': 'Publisher',
+            'authors': [self.author.id], 'genres': [self.genre.id],
+        }, **fields)
+
+    def test_create_reports_errors_per_item(self):
+        payload = [
+            self.book(1),
+            self.book(2, isbn=self.existing.isbn),
+            self.book(3, authors=[self.author.id, 999999]),
+            self.book(4, isbn=f'{9000 + 1:013d}'),
+            self.book(5, published_date='2999-01-01'),
+        ]
+
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([result['ok'] for result in results], [True, False, False, False, False])
+        self.assertIn('isbn', results[1]['errors'])
+        self.assertIn('authors', results[2]['errors'])
+        self.assertIn('isbn', results[3]['errors'])
+        self.assertIn('published_date', results[4]['errors'])
+        book = Book.objects.get(pk=results[0]['id'])
+        self.assertEqual(list(book.authors.all()), [self.author])
+        self.assertTrue(book.summary_excerpt.endswith('...'))
+        self.assertEqual(search.search_books('book 1', limit=10), [book.pk])
+
+    def test_create_query_count_does_not_depend_on_size(self):
+        def count(payload):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(self.url, payload, format='json')
+            self.assertTrue(all(result['ok'] for result in response.data['results']))
+            return len(context.captured_queries)
+
+        self.assertEqual(count([self.book(index) for index in range(2)]),
+                         count([self.book(index) for index in range(10, 30)]))
+
+    def test_partial_update(self):
+        other = Author.objects.create(name='Other')
+
+        response = self.client.patch(self.url, [
+            {'id': self.existing.id, 'summary': 'New summary', 'authors': [other.id]},
+            {'id': 999999, 'title': 'Missing'},
+            {'id': self.existing.id, 'title': 'Twice'},
+        ], format='json')
+
+        results = response.data['results']
+        self.assertEqual([result['ok'] for result in results], [True, False, False])
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.title, self.existing.summary_excerpt), ('Existing', 'New summary'))
+        self.assertEqual(list(self.existing.authors.all()), [other])
+
+    def test_update_may_keep_its_own_isbn(self):
+        response = self.client.patch(self.url, [{'id': self.existing.id, 'isbn': self.existing.isbn}],
+                                     format='json')
+
+        self.assertTrue(response.data['results'][0]['ok'])
+
+    def test_delete(self):
+        services.request_borrow(self.existing, self.staff)
+
+        response = self.client.delete(self.url, [self.existing.id, 999999], format='json')
+
+        self.assertEqual([result['ok'] for result in response.data['results']], [True, False])
+        self.assertFalse(Book.objects.exists())
+        self.assertEqual(search.search_books('existing', limit=10), [])
+        self.assertEqual(UserLoanStats.objects.get(user=self.staff).pending, 0)
+
+    def test_deleting_authors_reindexes_their_books(self):
+        self.assertEqual(search.search_books('author', limit=10), [self.existing.pk])
+        admin = User.objects.create_superuser(username='admin', password='password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=admin).key)
+
+        response = self.client.delete(reverse('author-bulk'), [self.author.id], format='json')
+
+        self.assertEqual([result['ok'] for result in response.data['results']], [True])
+        self.assertEqual(search.search_books('author', limit=10), [])
+        self.assertFalse(self.existing.authors.exists())
+
+    def test_rejects_oversized_payload(self):
+        with mock.patch.object(BookViewSet, 'bulk_max_items', 2):
+            response = self.client.post(self.url, [self.book(index) for index in range(3)], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Book.objects.exclude(pk=self.existing.pk).exists())
+
+    def test_author_bulk_requires_staff_and_invalidates_cache(self):
+        get_catalogue_cache().clear()
+        authors_url = reverse('author-list')
+        self.assertEqual(len(self.client.get(authors_url).data['results']), 1)
+
+        response = self.client.post(reverse('author-bulk'), [{'name': 'New'}, {'bio': 'No name'}], format='json')
+
+        self.assertEqual([result['ok'] for result in response.data['results']], [True, False])
+        self.assertEqual(len(self.client.get(authors_url).data['results']), 2)
+
+        reader = User.objects.create_user(username='reader', password='password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=reader).key)
+        response = self.client.post(reverse('genre-bulk'), [{'name': 'Genre'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class LoanStatsApiTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.other = User.objects.create_user(username='other', password='password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+        self.client.get(reverse('api_home'))
+        self.books = [
+            Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                published_date='2023-01-01', publisher='Publisher', borrow_count=count)
+            for index, count in enumerate([3, 9, 5])
+        ]
+        UserLoanStats.objects.create(user=self.user, active_loans=1, loans=4)
+        history.get_summary_cache().clear()
+
+    def summary(self, user, **counts):
+        return dict({
+            'user': user.id, 'active_loans': 0, 'loans': 0, 'pending': 0, 'approved': 0, 'collected': 0,
+            'complete': 0, 'declined': 0, 'next_due_date': None,
+        }, **counts)
+
+    def test_own_stats_are_served_from_cache(self):
+        url = reverse('api_user_loan_stats', kwargs={'user_id': self.user.id})
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data, response.data)
+
+        self.assertEqual(response.data, self.summary(self.user, active_loans=1, loans=4))
+
+    def test_other_users_stats_are_hidden(self):
+        response = self.client.get(reverse('api_user_loan_stats', kwargs={'user_id': self.other.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_staff_see_any_users_stats(self):
+        self.user.is_staff = True
+        self.user.save()
+
+        response = self.client.get(reverse('api_user_loan_stats', kwargs={'user_id': self.other.id}))
+
+        self.assertEqual(response.data, self.summary(self.other))
+
+    def test_popular_books(self):
+        response = self.client.get(reverse('book-popular'), {'limit': 2})
+
+        self.assertEqual([book['id'] for book in response.data], [self.books[1].id, self.books[2].id])
+        self.assertEqual(response.data[0]['borrow_count'], 9)
+
+
+class CirculationAnalyticsTests(APITestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.staff).key)
+        self.genre = Genre.objects.create(name='Poetry')
+        self.url = reverse('api_analytics')
+        self.day = timezone.now().date() - timedelta(days=10)
+        CirculationRollup.objects.bulk_create([
+            CirculationRollup(dimension='total', key_id=0, day=self.day, loans=3, completed=2,
+                              loan_time=timedelta(days=5)),
+            CirculationRollup(dimension='total', key_id=0, day=self.day + timedelta(days=1), loans=1),
+            CirculationRollup(dimension='genre', key_id=self.genre.id, day=self.day, loans=2),
+        ])
+
+    def test_daily_totals_within_range(self):
+        response = self.client.get(self.url, {'start': self.day.isoformat(), 'end': self.day.isoformat()})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [
+            {'period': self.day, 'loans': 3, 'completed': 2, 'average_loan_days': 2.5},
+        ])
+
+    def test_ranking_by_dimension(self):
+        response = self.client.get(self.url, {'dimension': 'genre', 'granularity': 'total'})
+
+        self.assertEqual(response.data['results'], [
+            {'key_id': self.genre.id, 'name': 'Poetry', 'loans': 2, 'completed': 0, 'average_loan_days': None},
+        ])
+
+    def test_rejects_inverted_range(self):
+        response = self.client.get(self.url, {'start': '2024-02-01', 'end': '2024-01-01'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_requires_staff(self):
+        reader = User.objects.create_user(username='reader', password='password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=reader).key)
+
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ConditionalGetTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+        self.client.get(reverse('api_home'))
+        self.author = Author.objects.create(name='Author')
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='0000000000001',
+                                        published_date='2023-01-01', publisher='Publisher')
+        self.book.authors.add(self.author)
+
+    def revalidate(self, url, response, queries=None):
+        with self.assertNumQueries(queries) if queries is not None else CaptureQueriesContext(connection):
+            return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_borrow_request_poll_is_answered_before_serialization(self):
+        borrow_request = services.request_borrow(self.book, self.user)
+        url = reverse('borrowrequest-detail', kwargs={'pk': borrow_request.pk})
+        first = self.client.get(url)
+
+        self.assertEqual(self.revalidate(url, first, queries=1).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        services.transition(borrow_request, 'approve')
+        changed = self.revalidate(url, first)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertEqual(changed.data['status'], BorrowRequest.APPROVED)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    def test_other_users_borrow_request_is_still_hidden(self):
+        borrow_request = BorrowRequest.objects.create(book=self.book, borrower=self.staff)
+
+        response = self.client.get(reverse('borrowrequest-detail', kwargs={'pk': borrow_request.pk}))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_book_version_moves_with_relation_changes(self):
+        url = reverse('book-detail', kwargs={'pk': self.book.pk})
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first, queries=1).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.book.authors.add(Author.objects.create(name='Second'))
+
+        self.assertEqual(self.revalidate(url, first).status_code, status.HTTP_200_OK)
+
+    def test_if_modified_since(self):
+        url = reverse('book-detail', kwargs={'pk': self.book.pk})
+        first = self.client.get(url)
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_book_detail_tracks_the_users_borrow_request(self):
+        url = reverse('api_book-detail', kwargs={'book_id': self.book.pk})
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first, queries=1).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        services.request_borrow(self.book, self.user)
+
+        changed = self.revalidate(url, first)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(changed.data['borrow_request'])
+
+
+class BorrowRequestEventTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='0000000000001',
+                                        published_date='2023-01-01', publisher='Publisher')
+        self.borrow_request = services.request_borrow(self.book, self.user)
+        self.url = reverse('api_borrow_request_events')
+
+    def approve(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            services.transition(self.borrow_request, 'approve')
+
+    async def test_stream_pushes_transitions(self):
+        response = await self.async_client.get(self.url, headers={'Authorization': f'Token {self.token.key}'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+
+        snapshot = await anext(stream)
+        self.assertTrue(snapshot.startswith(b'event: snapshot\n'))
+        self.assertEqual(json.loads(snapshot.split(b'data: ')[1]), {
+            'borrow_requests': [{'id': self.borrow_request.pk, 'book': self.book.pk, 'status': BorrowRequest.PENDING}],
+        })
+
+        await sync_to_async(self.approve)()
+        event = await asyncio.wait_for(anext(stream), timeout=5)
+        self.assertTrue(event.startswith(b'event: status\n'))
+        self.assertEqual(json.loads(event.split(b'data: ')[1]), {
+            'id': self.borrow_request.pk, 'book': self.book.pk, 'status': BorrowRequest.APPROVED,
+        })
+
+        # The ASGI handler cancels the response when the client disconnects.
+        reader = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.01)
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+        self.assertEqual(len(events.hub), 0)
+
+    async def test_stream_requires_a_valid_token(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = await self.async_client.get(self.url, headers={'Authorization': 'Token invalid'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_browsers_authenticate_with_their_session(self):
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await anext(stream)).startswith(b'event: snapshot\n'))
+        reader = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.01)
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+        self.assertEqual(len(events.hub), 0)
+
+    def test_streams_are_refused_outside_asgi(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    def test_events_reach_only_the_borrower_from_any_thread(self):
+        other = User.objects.create_user(username='other', password='password123')
+        changes = [(self.borrow_request.pk, self.user.pk, self.book.pk, BorrowRequest.APPROVED)]
+
+        async def listen():
+            mine, theirs = events.hub.subscribe(self.user.pk), events.hub.subscribe(other.pk)
+            try:
+                await asyncio.to_thread(borrow_requests_changed.send, sender=BorrowRequest, changes=changes)
+                return await mine.next(timeout=5), await theirs.next(timeout=0.01)
+            finally:
+                events.hub.unsubscribe(mine)
+                events.hub.unsubscribe(theirs)
+
+        received, missed = asyncio.run(listen())
+
+        self.assertEqual(received, {'id': self.borrow_request.pk, 'book': self.book.pk, 'status': BorrowRequest.APPROVED})
+        self.assertIsNone(missed)
+
+    def test_idle_subscribers_are_cheap(self):
+        count = 5000
+
+        async def subscribe():
+            tracemalloc.start()
+            baseline = tracemalloc.take_snapshot()
+            subscriptions = [events.hub.subscribe(user_id) for user_id in range(-count, 0)]
+            waiting = [asyncio.create_task(subscription.next(timeout=60)) for subscription in subscriptions]
+            await asyncio.sleep(0)
+            used = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, 'filename'))
+            tracemalloc.stop()
+
+            events.hub.publish(-1, {'id': 1})
+            self.assertEqual(await waiting[-1], {'id': 1})
+            for task in waiting[:-1]:
+                task.cancel()
+            for subscription in subscriptions:
+                events.hub.unsubscribe(subscription)
+            return used
+
+        used = asyncio.run(subscribe())
+
+        # A waiting subscriber, including the task standing in for its connection, stays around a few KB.
+        self.assertLess(used / count, 4096)
+        self.assertEqual(len(events.hub), 0)
+
+
+class AsyncViewTests(APITestCase):
+    """The async handler variants, called in async mode the way the ASGI application serves them."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        author = Author.objects.create(name='Author')
+        self.books = []
+        for index in range(3):
+            book = Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'000000000000{index}',
+                                       published_date='2023-01-01', publisher='Publisher')
+            book.authors.add(author)
+            self.books.append(book)
+        self.borrow_request = services.request_borrow(self.books[0], self.user)
+        self.factory = APIRequestFactory()
+
+    def call(self, view, path, authenticated=True, **kwargs):
+        headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'} if authenticated else {}
+        response = async_to_sync(view)(self.factory.get(path, **headers), **kwargs)
+        return response.render()
+
+    def sync_get(self, path, authenticated=True):
+        if authenticated:
+            self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = self.client.get(path)
+        get_catalogue_cache().clear()
+        return response
+
+    def test_library_fund_pages_match_the_sync_view(self):
+        view = LibraryFundView.as_view(asynchronous=True)
+        url = reverse('api_library_fund') + '?page_size=2'
+        expected = self.sync_get(url, authenticated=False)
+
+        response = self.call(view, url, authenticated=False)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, expected.data)
+        following = self.call(view, response.data['next'], authenticated=False)
+        self.assertEqual([book['id'] for book in following.data['results']], [self.books[2].pk])
+
+    def test_book_detail_matches_the_sync_view_and_revalidates(self):
+        view = BookDetailView.as_view(asynchronous=True)
+        url = reverse('api_book-detail', kwargs={'book_id': self.books[0].pk})
+        expected = self.sync_get(url)
+
+        response = self.call(view, url, book_id=self.books[0].pk)
+
+        self.assertEqual(response.data, expected.data)
+        self.assertEqual(response.data['borrow_request']['id'], self.borrow_request.pk)
+        self.assertEqual(response['ETag'], expected['ETag'])
+        request = self.factory.get(
+            url, HTTP_AUTHORIZATION=f'Token {self.token.key}', HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(async_to_sync(view)(request, book_id=self.books[0].pk).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        missing = self.call(view, '/api/bookdetail/0/', book_id=0)
+        self.assertEqual(missing.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_history_and_author_list(self):
+        history = BorrowRequestHistoryView.as_view(asynchronous=True)
+        response = self.call(history, reverse('api_borrow_history'))
+        self.assertEqual([row['book'] for row in response.data['results']], [self.books[0].pk])
+        self.assertEqual(self.call(history, reverse('api_borrow_history'), authenticated=False).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+        authors = AuthorViewSet.as_view({'get': 'list'}, asynchronous=True)
+        response = self.call(authors, reverse('author-list'))
+        self.assertEqual([author['name'] for author in response.data['results']], ['Author'])
+
+    def test_cached_tokens_authenticate_without_a_lookup(self):
+        view = BorrowRequestHistoryView.as_view(asynchronous=True)
+        self.call(view, reverse('api_borrow_history'))
+
+        with mock.patch.object(ExpiringTokenAuthentication, 'authenticate_credentials', side_effect=AssertionError):
+            response = self.call(view, reverse('api_borrow_history'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_subclasses_overriding_the_sync_handler_keep_it(self):
+        view = BorrowHistoryExportView(asynchronous=True)
+
+        self.assertIsNone(view.get_async_handler(view.get))
+        self.assertIsNotNone(BorrowRequestHistoryView().get_async_handler(BorrowRequestHistoryView().get))
+
+
+class MetricsTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        registry.clear()
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.get(reverse('api_home'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api_borrow_history'))
+        count = len(queries)
+        self.client.get(reverse('api_borrow_history'))
+        self.client.get('/api/no-such-page/')
+
+        totals = registry.collect()
+        self.assertEqual(totals['api_borrow_history'].count, 2)
+        self.assertEqual(totals['api_borrow_history'].queries, 2 * count)
+        self.assertEqual(totals['<unresolved>'].count, 1)
+        self.assertRegex(response['Server-Timing'],
+                         rf'^db;dur=[\d.]+;desc="{count} queries", total;dur=[\d.]+$')
+
+    def test_queries_made_from_other_threads_are_counted(self):
+        async def get():
+            return await self.async_client.get(reverse('api_borrow_history'),
+                                               headers={'authorization': f'Token {self.token.key}'})
+
+        response = async_to_sync(get)()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(registry.collect()['api_borrow_history'].queries, 0)
+
+    def test_shards_are_merged(self):
+        metrics = MetricsRegistry(buckets=(0.1, 1))
+        metrics.record('view', 0.05, 2, 0.01)
+        thread = threading.Thread(target=metrics.record, args=('view', 2, 3, 0.5))
+        thread.start()
+        thread.join()
+
+        series = metrics.collect()['view']
+        self.assertEqual((series.count, series.queries, series.buckets), (2, 5, [1, 0, 1]))
+        self.assertIn('http_request_duration_seconds_bucket{view="view",le="1"} 1', metrics.render())
+        self.assertIn('http_request_duration_seconds_bucket{view="view",le="+Inf"} 2', metrics.render())
+
+    def test_exited_threads_are_folded_into_one_total(self):
+        metrics = MetricsRegistry(buckets=(0.1, 1))
+        metrics.record('view', 0.05, 1, 0.01)
+        for _ in range(50):
+            thread = threading.Thread(target=metrics.record, args=('view', 2, 1, 0.5))
+            thread.start()
+            thread.join()
+
+        self.assertLessEqual(len(metrics._shards), 2)
+        series = metrics.collect()['view']
+        self.assertEqual((series.count, series.queries, series.buckets), (51, 51, [1, 0, 50]))
+
+    def test_metrics_are_for_staff(self):
+        self.client.get(reverse('api_home'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        local_tokens.clear()
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('http_request_duration_seconds_count{view="api_home"} 1', response.content.decode())
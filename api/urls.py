@@ -1,6 +1,7 @@
 from django.urls import path, include
 from .views import RegisterView, LoginView, LogoutView, HomePageView, BorrowRequestHistoryView, BookViewSet, \
-    AuthorViewSet, GenreViewSet, LibraryFundView, BorrowRequestViewSet, BookDetailView
+    AuthorViewSet, GenreViewSet, LibraryFundView, BorrowRequestViewSet, BookDetailView, BookExportView, \
+    BorrowHistoryExportView, UserLoanStatsView, CirculationAnalyticsView, BorrowRequestEventsView, HoldView
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
@@ -15,7 +16,14 @@ urlpatterns = [
     path('logout/', LogoutView.as_view(), name='api_logout'),
     path('home/', HomePageView.as_view(), name='api_home'),
     path('borrow-history/', BorrowRequestHistoryView.as_view(), name='api_borrow_history'),
+    path('users/<int:user_id>/loan-stats/', UserLoanStatsView.as_view(), name='api_user_loan_stats'),
+    path('analytics/', CirculationAnalyticsView.as_view(), name='api_analytics'),
+    path('export/books.jsonl', BookExportView.as_view(), name='api_export_books'),
+    path('export/borrow-history.csv', BorrowHistoryExportView.as_view(), name='api_export_borrow_history'),
+    # Listed before the router, whose borrow request detail route would otherwise match it.
+    path('borrow-requests/events/', BorrowRequestEventsView.as_view(), name='api_borrow_request_events'),
     path('', include(router.urls)),
     path('library/', LibraryFundView.as_view(), name='api_library_fund'),
     path('bookdetail/<int:book_id>/', BookDetailView.as_view(), name='api_book-detail'),
+    path('holds/<int:book_id>/', HoldView.as_view(), name='api_hold'),
 ]
@@ -1,12 +1,34 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import OuterRef, Subquery
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.views import View
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
 from rest_framework.authtoken.views import ObtainAuthToken
-from rest_framework.permissions import IsAuthenticated, AllowAny, IsAuthenticatedOrReadOnly
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAuthenticatedOrReadOnly, IsAdminUser
+from rest_framework.settings import api_settings
+from . import cache, events
+from .asyncviews import AsyncListModelMixin, AsyncViewMixin
+from .bulk import BulkModelMixin
+from .exports import astream_books_jsonl, astream_borrow_history_csv, stream_books_jsonl, stream_borrow_history_csv
+from .pagination import IdCursorPagination, BorrowRequestCursorPagination, OverdueCursorPagination, \
+    SearchPagination, AnalyticsPagination
 from .permissions import IsAdminOrReadOnly
-from .serializers import RegisterSerializer, BorrowRequestSerializer, BookSerializer, AuthorSerializer, GenreSerializer, BookStockSerializer, BorrowRequestHistorySerializer
+from .serializers import RegisterSerializer, BorrowRequestSerializer, BookSerializer, AuthorSerializer, GenreSerializer, BookStockSerializer, BorrowRequestHistorySerializer, \
+    BorrowRequestTransitionSerializer, UserLoanStatsSerializer, CirculationQuerySerializer, HoldSerializer
 from rest_framework import generics, status, viewsets
-from myapp.models import BorrowRequest, Book, Author, Genre
+from rest_framework.decorators import action
+from myapp import analytics, history, inventory
+from myapp.search import index_books, search_books, tokenize
+from myapp.services import BorrowError, borrow_or_hold, delete_request, hold_position, transition, bulk_transition
+from myapp.models import BorrowRequest, Book, Author, Genre, Hold, make_summary_excerpt
+from myapp.signals import books_changed, delete_books, delete_relations, relations_changed
 from rest_framework.response import Response
 
 
@@ -43,34 +65,140 @@ class HomePageView(APIView):
         return Response({'message': 'Welcome to the home page!'}, status=status.HTTP_200_OK)
 
 
-class BorrowRequestHistoryView(generics.ListAPIView):
+class BorrowRequestHistoryView(AsyncListModelMixin, generics.ListAPIView):
     serializer_class = BorrowRequestHistorySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = BorrowRequestCursorPagination
 
     def get_queryset(self):
         user = self.request.user
         if user.is_staff or user.is_superuser:
-            return BorrowRequest.objects.all()
+            return BorrowRequest.objects.select_related('book')
         else:
-            return BorrowRequest.objects.filter(borrower=user)
+            return BorrowRequest.objects.filter(borrower=user).select_related('book')
 
+    async def aget(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
 
-class LibraryFundView(APIView):
-    permission_classes = [IsAuthenticatedOrReadOnly]
+
+class UserLoanStatsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, user_id):
+        if user_id != request.user.id and not (request.user.is_staff or request.user.is_superuser):
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        summary = history.get_summary(user_id)
+        if summary is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(UserLoanStatsSerializer(summary).data, status=status.HTTP_200_OK)
+
+
+class CirculationAnalyticsView(APIView):
+    permission_classes = [IsAdminUser]
 
     def get(self, request):
-        books = Book.objects.all()
-        serialized_books = BookStockSerializer(books, many=True)
+        query = CirculationQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        paginator = AnalyticsPagination()
+        rows = paginator.paginate_queryset(analytics.circulation(**query.validated_data), request, view=self)
+        response = paginator.get_paginated_response(analytics.describe(query.validated_data['dimension'], rows))
+        response.data['up_to'] = analytics.rolled_up_to()
+        return response
+
+
+def _under_asgi(request):
+    """Whether ``request`` came in through the ASGI handler, which sends async iterators without buffering them."""
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+class BorrowHistoryExportView(BorrowRequestHistoryView):
+    def get(self, request):
+        stream = astream_borrow_history_csv if _under_asgi(request) else stream_borrow_history_csv
+        response = StreamingHttpResponse(stream(self.get_queryset()), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="borrow-history.csv"'
+        return response
+
+
+class BookExportView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        stream = astream_books_jsonl if _under_asgi(request) else stream_books_jsonl
+        response = StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="books.jsonl"'
+        return response
+
+
+def _authenticate(request, authentication_classes):
+    """Return the user a plain Django request authenticates as with ``authentication_classes``, or None."""
+    authenticators = [authentication_class() for authentication_class in authentication_classes]
+    user = Request(request, authenticators=authenticators).user
+    return user if user.is_authenticated else None
+
+
+class BorrowRequestEventsView(View):
+    """
+    Server-sent events for the caller's borrow requests, as an async view for the ASGI application.
+
+    The stream opens with a ``snapshot`` of the caller's open requests and then sends a ``status`` event for
+    every transition, so clients can drop polling. Browsers' ``EventSource`` cannot send an ``Authorization``
+    header, so the session is accepted as well as a token. Under WSGI a stream would tie up a worker thread for
+    ``EVENTS_MAX_AGE``, so it is refused there with a 501.
+    """
+    authentication_classes = [SessionAuthentication, *api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+
+    async def get(self, request):
+        if not _under_asgi(request):
+            return JsonResponse({'detail': 'Event streams are only served by the ASGI application.'},
+                                status=status.HTTP_501_NOT_IMPLEMENTED)
+        try:
+            user = await sync_to_async(_authenticate)(request, self.authentication_classes)
+        except AuthenticationFailed as exc:
+            return JsonResponse({'detail': str(exc.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+        if user is None:
+            return JsonResponse({'detail': 'Authentication required.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # Subscribe before reading the snapshot, so a change made in between is sent rather than lost.
+        subscription = events.hub.subscribe(user.pk)
+        try:
+            snapshot = await sync_to_async(events.open_requests)(user)
+        except BaseException:
+            events.hub.unsubscribe(subscription)
+            raise
+        response = StreamingHttpResponse(
+            events.stream(subscription, snapshot, settings.EVENTS_HEARTBEAT, settings.EVENTS_MAX_AGE),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class LibraryFundView(AsyncViewMixin, APIView):
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = IdCursorPagination
 
-        for book in serialized_books.data:
-            if book['available']:
-                book['availability_status'] = 'Available'
-            else:
-                book['availability_status'] = 'Not Available'
+    def get_books(self, request):
+        books = Book.objects.for_listing().defer('summary')
+        available = request.query_params.get('available')
+        if available is not None:
+            books = books.filter(available_count__gt=0) if available.lower() in ('1', 'true') \
+                else books.filter(available_count=0)
+        return books
 
-            book['summary'] = ' '.join(book['summary'].split()[:30]) + '...' if len(book['summary'].split()) > 30 else book['summary']
+    @cache.cache_catalogue_response(cache.BOOKS)
+    def get(self, request):
+        paginator = self.pagination_class()
+        books = paginator.paginate_queryset(self.get_books(request), request, view=self)
+        serialized_books = BookStockSerializer(books, many=True)
+        return paginator.get_paginated_response(serialized_books.data)
 
-        return Response(serialized_books.data, status=status.HTTP_200_OK)
+    @cache.cache_catalogue_response(cache.BOOKS)
+    async def aget(self, request):
+        paginator = self.pagination_class()
+        books = await paginator.apaginate_queryset(self.get_books(request), request, view=self)
+        return paginator.get_paginated_response(BookStockSerializer(books, many=True).data)
 
     def post(self, request):
         if not request.user.is_authenticated:
@@ -83,18 +211,12 @@ class LibraryFundView(APIView):
         except Book.DoesNotExist:
             return Response({"detail": "Book not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        if not book.available:
-            return Response({"detail": "Book is not available right now."}, status=status.HTTP_400_BAD_REQUEST)
-
-        borrow_request = BorrowRequest.objects.create(
-            book=book,
-            borrower=request.user,
-            status=BorrowRequest.PENDING,
-            request_date=timezone.now()
-        )
-
-        book.available = False
-        book.save()
+        try:
+            borrow_request, hold = borrow_or_hold(book, request.user)
+        except BorrowError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if hold is not None:
+            return _hold_response(hold)
 
         return Response({
             "detail": "Borrow request created.",
@@ -102,28 +224,99 @@ class LibraryFundView(APIView):
         }, status=status.HTTP_201_CREATED)
 
 
-class BookDetailView(APIView):
+def _hold_response(hold):
+    """202 for a borrow that joined the hold queue: the request is accepted and served when a copy is back."""
+    hold.position = hold_position(hold)
+    return Response({
+        "detail": "Every copy is out; you are in the hold queue.",
+        "hold": HoldSerializer(hold).data,
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+class HoldView(APIView):
+    """The signed-in user's place in the hold queue of a book; DELETE leaves the queue."""
+    permission_classes = [IsAuthenticated]
+
+    def get_hold(self, request, book_id):
+        return Hold.objects.filter(book_id=book_id, user=request.user).first()
+
+    def get(self, request, book_id):
+        hold = self.get_hold(request, book_id)
+        if hold is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        hold.position = hold_position(hold)
+        return Response(HoldSerializer(hold).data, status=status.HTTP_200_OK)
+
+    def delete(self, request, book_id):
+        hold = self.get_hold(request, book_id)
+        if hold is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        hold.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def _detail_versions(view, request, pk):
+    try:
+        version = view.get_queryset().filter(pk=pk).values_list('updated_at', flat=True).first()
+    except (TypeError, ValueError):
+        return None
+    return None if version is None else [version]
+
+
+def _book_detail_version_query(request, book_id):
+    # Anonymous responses are served by the catalogue cache, which validates them with its own ETags.
+    if not request.user.is_authenticated:
+        return None
+    borrow_request = BorrowRequest.objects.filter(book=OuterRef('pk'), borrower=request.user).order_by('pk')
+    return Book.objects.filter(pk=book_id).annotate(
+        borrow_request_version=Subquery(borrow_request.values('updated_at')[:1]),
+    ).values_list('updated_at', 'borrow_request_version')
+
+
+def _book_detail_versions(view, request, book_id):
+    query = _book_detail_version_query(request, book_id)
+    return None if query is None else query.first()
+
+
+async def _abook_detail_versions(view, request, book_id):
+    query = _book_detail_version_query(request, book_id)
+    return None if query is None else await query.afirst()
+
+
+class BookDetailView(AsyncViewMixin, APIView):
     permission_classes = [IsAuthenticatedOrReadOnly]
 
+    @cache.conditional_on_versions(_book_detail_versions)
+    @cache.cache_catalogue_response(cache.book_namespace, anonymous_only=True)
     def get(self, request, book_id):
         try:
-            book = Book.objects.get(id=book_id)
+            book = Book.objects.for_listing().get(id=book_id)
         except Book.DoesNotExist:
             return Response({"detail": "Book not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        book_serializer = BookSerializer(book)
-
-        user_borrow_request = None
+        borrow_request = None
         if request.user.is_authenticated:
             borrow_request = BorrowRequest.objects.filter(book=book, borrower=request.user).first()
-            if borrow_request:
-                user_borrow_request = BorrowRequestSerializer(borrow_request).data
+        return self.detail_response(book, borrow_request)
 
+    @cache.conditional_on_versions(_abook_detail_versions)
+    @cache.cache_catalogue_response(cache.book_namespace, anonymous_only=True)
+    async def aget(self, request, book_id):
+        try:
+            book = await Book.objects.for_listing().aget(id=book_id)
+        except Book.DoesNotExist:
+            return Response({"detail": "Book not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        borrow_request = None
+        if request.user.is_authenticated:
+            borrow_request = await BorrowRequest.objects.filter(book=book, borrower=request.user).afirst()
+        return self.detail_response(book, borrow_request)
+
+    def detail_response(self, book, borrow_request):
         response_data = {
-            'book': book_serializer.data,
-            'borrow_request': user_borrow_request,
+            'book': BookSerializer(book).data,
+            'borrow_request': BorrowRequestSerializer(borrow_request).data if borrow_request else None,
         }
-
         return Response(response_data, status=status.HTTP_200_OK)
 
     def post(self, request, book_id):
@@ -138,18 +331,12 @@ class BookDetailView(APIView):
         action = request.data.get('action')
 
         if action == 'borrow':
-            existing_request = BorrowRequest.objects.filter(book=book, borrower=request.user, status__in=[BorrowRequest.PENDING, BorrowRequest.APPROVED]).first()
-            if existing_request:
-                return Response({"detail": "You already have a pending or approved request for this book."}, status=status.HTTP_400_BAD_REQUEST)
-
-            borrow_request = BorrowRequest.objects.create(
-                book=book,
-                borrower=request.user,
-                status=BorrowRequest.PENDING,
-                request_date=timezone.now()
-            )
-            book.available = False
-            book.save()
+            try:
+                borrow_request, hold = borrow_or_hold(book, request.user)
+            except BorrowError as exc:
+                return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+            if hold is not None:
+                return _hold_response(hold)
 
             return Response({"detail": "Borrow request created.", "request_id": borrow_request.id}, status=status.HTTP_201_CREATED)
 
@@ -158,8 +345,10 @@ class BookDetailView(APIView):
             if not borrow_request:
                 return Response({"detail": "No approved request found for this book."}, status=status.HTTP_400_BAD_REQUEST)
 
-            borrow_request.status = BorrowRequest.COLLECTED
-            borrow_request.save()
+            try:
+                transition(borrow_request, 'collect')
+            except BorrowError as exc:
+                return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
             return Response({"detail": "Book collected successfully."}, status=status.HTTP_200_OK)
 
@@ -167,8 +356,8 @@ class BookDetailView(APIView):
             return Response({"detail": "Invalid action."}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.all()
+class BookViewSet(BulkModelMixin, viewsets.ModelViewSet):
+    queryset = Book.objects.for_listing()
     serializer_class = BookSerializer
     permission_classes = [IsAuthenticated]
 
@@ -178,66 +367,142 @@ class BookViewSet(viewsets.ModelViewSet):
     def perform_update(self, serializer):
         serializer.save()
 
+    @cache.conditional_on_versions(_detail_versions)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def prepare_bulk_instance(self, instance, attrs):
+        # Set the version explicitly so updates that only replace authors or genres still move it.
+        instance.updated_at = timezone.now()
+        if 'summary' not in attrs:
+            return ('updated_at',)
+        instance.summary_excerpt = make_summary_excerpt(instance.summary)
+        return ('summary_excerpt', 'updated_at')
+
+    def bulk_written(self, ids):
+        # New books get their first copy, as myapp.signals.shelve_new_book does for saved ones.
+        inventory.add_copies(Book.objects.filter(pk__in=ids, copies__isnull=True).values_list('pk', flat=True))
+        index_books(ids)
+        books_changed.send(sender=Book, book_ids=ids)
+
+    def perform_bulk_delete(self, queryset):
+        delete_books(queryset)
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticatedOrReadOnly])
+    def popular(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), settings.API_MAX_PAGE_SIZE)
+        except ValueError:
+            return Response({"detail": "Limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+        books = Book.objects.for_listing().order_by('-borrow_count', 'id')[:max(limit, 1)]
+        return Response(self.get_serializer(books, many=True).data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticatedOrReadOnly])
+    def search(self, request):
+        query = request.query_params.get('q', '')
+        if not tokenize(query):
+            return Response({"detail": "Search query is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = SearchPagination()
+        book_ids = paginator.paginate_hits(
+            lambda limit, offset: search_books(query, limit=limit, offset=offset), request
+        )
+        books = Book.objects.for_listing().defer('summary').in_bulk(book_ids)
+        serializer = BookStockSerializer([books[book_id] for book_id in book_ids if book_id in books], many=True)
+        return paginator.get_paginated_response(serializer.data)
+
 
-class AuthorViewSet(viewsets.ModelViewSet):
+class AuthorViewSet(AsyncListModelMixin, BulkModelMixin, viewsets.ModelViewSet):
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
     permission_classes = [IsAdminOrReadOnly]
 
+    def bulk_written(self, ids):
+        relations_changed.send(sender=Author, ids=ids)
 
-class GenreViewSet(viewsets.ModelViewSet):
+    def perform_bulk_delete(self, queryset):
+        delete_relations(queryset)
+
+    @cache.cache_catalogue_response(cache.AUTHORS)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache.cache_catalogue_response(cache.AUTHORS)
+    async def alist(self, request, *args, **kwargs):
+        return await super().alist(request, *args, **kwargs)
+
+
+class GenreViewSet(AsyncListModelMixin, BulkModelMixin, viewsets.ModelViewSet):
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = [IsAdminOrReadOnly]
 
+    def bulk_written(self, ids):
+        relations_changed.send(sender=Genre, ids=ids)
+
+    def perform_bulk_delete(self, queryset):
+        delete_relations(queryset)
+
+    @cache.cache_catalogue_response(cache.GENRES)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache.cache_catalogue_response(cache.GENRES)
+    async def alist(self, request, *args, **kwargs):
+        return await super().alist(request, *args, **kwargs)
+
 
 class BorrowRequestViewSet(viewsets.ModelViewSet):
     queryset = BorrowRequest.objects.all()
     serializer_class = BorrowRequestSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = BorrowRequestCursorPagination
 
     def get_queryset(self):
         if self.request.user.is_staff or self.request.user.is_superuser:
             return BorrowRequest.objects.all()
         return BorrowRequest.objects.filter(borrower=self.request.user)
 
-    def perform_create(self, serializer):
-        serializer.save(borrower=self.request.user)
+    @cache.conditional_on_versions(_detail_versions)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            borrow_request, hold = borrow_or_hold(serializer.validated_data['book'], request.user)
+        except BorrowError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if hold is not None:
+            return _hold_response(hold)
+        return Response(self.get_serializer(borrow_request).data, status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        delete_request(instance)
 
     def update(self, request, *args, **kwargs):
         borrow_request = self.get_object()
         action = request.data.get('action')
 
-        if action == 'approve':
-            if borrow_request.status != BorrowRequest.PENDING:
-                return Response({"error": "Only pending requests can be approved."}, status=status.HTTP_400_BAD_REQUEST)
-            borrow_request.status = BorrowRequest.APPROVED
-            borrow_request.approval_date = timezone.now()
-            borrow_request.due_date = request.data.get('due_date')
-            borrow_request.book.available = False
-            borrow_request.book.save()
-
-        elif action == 'collect':
-            if borrow_request.status != BorrowRequest.APPROVED:
-                return Response({"error": "Only approved requests can be collected."},
-                                status=status.HTTP_400_BAD_REQUEST)
-            borrow_request.status = BorrowRequest.COLLECTED
-
-        elif action == 'complete':
-            if borrow_request.status != BorrowRequest.COLLECTED:
-                return Response({"error": "Only collected requests can be completed."},
-                                status=status.HTTP_400_BAD_REQUEST)
-            borrow_request.status = BorrowRequest.COMPLETE
-            borrow_request.complete_date = timezone.now()
-            borrow_request.book.available = True
-            borrow_request.book.save()
-
-        elif action == 'decline':
-            if borrow_request.status != BorrowRequest.PENDING:
-                return Response({"error": "Only pending requests can be declined."}, status=status.HTTP_400_BAD_REQUEST)
-            borrow_request.status = BorrowRequest.DECLINED
-        else:
-            return Response({"error": "Unknown action."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            borrow_request = transition(borrow_request, action, due_date=request.data.get('due_date'))
+        except BorrowError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
-        borrow_request.save()
         return Response(BorrowRequestSerializer(borrow_request).data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], pagination_class=OverdueCursorPagination)
+    def overdue(self, request):
+        queryset = self.get_queryset().filter(status=BorrowRequest.COLLECTED, overdue=True)
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk(self, request):
+        serializer = BorrowRequestTransitionSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=settings.API_BULK_MAX_ITEMS,
+        )
+        serializer.is_valid(raise_exception=True)
+        results = bulk_transition(serializer.validated_data)
+        return Response({'results': results}, status=status.HTTP_200_OK)
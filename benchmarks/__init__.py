@@ -0,0 +1,17 @@
+"""
+Load tests and micro-benchmarks for the library.
+
+``benchmarks.data`` fills the configured database with a synthetic, seeded library of a given size, and
+``benchmarks.scenarios`` drives the real URLconf in-process with Django's test client. ``benchmarks.runner`` runs
+each scenario in its own process inside a transaction that is rolled back, so every run starts from the same
+data, and writes throughput, latency percentiles, query counts and peak RSS to JSON, which ``compare`` checks
+against a stored baseline::
+
+    python -m benchmarks generate --rows 100000
+    python -m benchmarks run --output results.json
+    python -m benchmarks compare baseline.json results.json
+    python -m benchmarks clear
+
+Generated rows are tagged with ``benchmarks.data.PREFIX``; a scratch copy of the database is the better home
+for the larger scales.
+"""
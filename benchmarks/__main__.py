@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Library load tests.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='Create synthetic benchmark data.')
+    generate.add_argument('--rows', type=int, default=100_000, help='Approximate number of rows to create.')
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--batch-size', type=int, default=5000)
+    generate.add_argument('--replace', action='store_true', help='Delete existing benchmark data first.')
+
+    commands.add_parser('clear', help='Delete the benchmark data.')
+
+    run = commands.add_parser('run', help='Run scenarios and write their results as JSON.')
+    run.add_argument('--scenario', action='append', dest='scenarios', help='Scenario to run; repeatable.')
+    run.add_argument('--requests', type=int, help='Measured requests per scenario.')
+    run.add_argument('--warmup', type=int, help='Unmeasured requests before them.')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', help='Write the results here instead of to stdout.')
+    run.add_argument('--in-process', action='store_true', help='Run every scenario in this process.')
+    run.add_argument('--child', help=argparse.SUPPRESS)
+
+    compare = commands.add_parser('compare', help='Flag regressions of a run against a baseline.')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--tolerance', type=float, default=0.1,
+                         help='Allowed relative slowdown of throughput, latency and RSS (default 0.1).')
+    compare.add_argument('--query-tolerance', type=float, default=0.0,
+                         help='Allowed relative growth of queries per request (default 0).')
+
+    options = parser.parse_args(argv)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+    import django
+    django.setup()
+    from . import data, runner
+
+    if options.command == 'compare':
+        return compare_results(options)
+
+    def progress(model, count):
+        print(f'{model._meta.label}: {count}', file=sys.stderr)
+
+    if options.command == 'generate':
+        if data.exists():
+            if not options.replace:
+                parser.error('benchmark data already exists; pass --replace to regenerate it')
+            data.clear(progress)
+        sizes = data.generate(options.rows, seed=options.seed, batch_size=options.batch_size, progress=progress)
+        print(', '.join(f'{model._meta.label}={count}' for model, count in sizes.items()))
+    elif options.command == 'clear':
+        data.clear(progress)
+    else:
+        requests = options.requests or runner.DEFAULT_REQUESTS
+        warmup = runner.DEFAULT_WARMUP if options.warmup is None else options.warmup
+        if options.child:
+            print(json.dumps(runner.run_scenario(options.child, requests, warmup, options.seed)))
+            return 0
+        unknown = set(options.scenarios or ()) - set(runner.SCENARIOS)
+        if unknown:
+            parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}; choose from {", ".join(runner.SCENARIOS)}')
+        results = runner.run(options.scenarios, requests, warmup, options.seed, in_process=options.in_process)
+        text = json.dumps(results, indent=2)
+        if options.output:
+            with open(options.output, 'w') as output:
+                output.write(text + '\n')
+        else:
+            print(text)
+    return 0
+
+
+def compare_results(options):
+    from .runner import compare
+
+    with open(options.baseline) as baseline, open(options.current) as current:
+        rows = compare(json.load(baseline), json.load(current), options.tolerance, options.query_tolerance)
+
+    def number(value):
+        return '-' if value is None else f'{value:.2f}'
+
+    print(f'{"scenario":<22}{"metric":<22}{"baseline":>12}{"current":>12}{"change":>10}')
+    for name, metric, old, new, change, regressed in rows:
+        change = '-' if change is None else f'{change:+.1%}'
+        print(f'{name:<22}{metric:<22}{number(old):>12}{number(new):>12}{change:>10}'
+              f'{"  REGRESSION" if regressed else ""}')
+    regressions = sum(row[-1] for row in rows)
+    print(f'{regressions} regression(s)')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
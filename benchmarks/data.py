@@ -0,0 +1,188 @@
+"""
+Synthetic library data.
+
+``generate(rows)`` creates about ``rows`` authors, genres, books and borrow requests, plus the users borrowing
+them, in the proportions of ``SHARES``. Everything is derived from ``seed``, so the same arguments give the same
+library. Rows are written ``batch_size`` at a time with ``bulk_create`` and read back by their ``PREFIX`` tag,
+like the catalogue importer does, and the denormalized counters, loan summaries and search index are rebuilt
+once at the end.
+
+Every book has one to ``MAX_COPIES`` copies. Borrow requests follow the rules the services enforce: open
+requests are for distinct books and hold their first copy, and a few heavy borrowers own a large share of the
+history.
+"""
+import random
+import time
+from array import array
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from myapp import search, services
+from myapp.models import Author, Book, BorrowRequest, Copy, Genre, make_summary_excerpt
+from myapp.signals import books_changed, relations_changed
+
+PREFIX = 'bench-'
+LIBRARIAN = f'{PREFIX}librarian'
+PASSWORD = 'bench-password'
+
+# Share of ``rows`` per model; genres get the remainder, at least MIN_GENRES.
+SHARES = {User: 0.025, Author: 0.07, Book: 0.3, BorrowRequest: 0.6}
+MIN_GENRES = 10
+# Of the borrow requests, the share still open (pending, approved or collected).
+OPEN_SHARE = 0.15
+MAX_COPIES = 3
+
+WORDS = (
+    'river', 'shadow', 'garden', 'winter', 'empire', 'silver', 'machine', 'harbour', 'letters', 'forest',
+    'signal', 'orchard', 'atlas', 'ember', 'glass', 'lantern', 'memory', 'north', 'paper', 'quiet', 'salt',
+    'thunder', 'voyage', 'willow', 'stone', 'island', 'mirror', 'comet', 'archive', 'frontier',
+)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _ids(queryset):
+    return array('q', queryset.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=10000))
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def counts(rows):
+    """The number of rows ``generate(rows)`` creates per model."""
+    sizes = {model: max(int(rows * share), 1) for model, share in SHARES.items()}
+    sizes[Genre] = max(rows - sum(sizes.values()), MIN_GENRES)
+    return sizes
+
+
+def exists():
+    return Book.objects.filter(publisher=PREFIX).exists()
+
+
+def generate(rows, seed=0, batch_size=5000, progress=None):
+    """Create a library of about ``rows`` rows; ``progress(model, created)`` is called after every batch."""
+    rng = random.Random(seed)
+    sizes = counts(rows)
+    now = timezone.now()
+
+    def write(model, objects):
+        created = 0
+        for chunk in _chunks(objects, batch_size):
+            with transaction.atomic():
+                model.objects.bulk_create(chunk)
+            created += len(chunk)
+            if progress:
+                progress(model, created)
+
+    User.objects.create_user(username=LIBRARIAN, password=PASSWORD, is_staff=True)
+    write(User, (User(username=f'{PREFIX}{index}', password='!') for index in range(sizes[User])))
+    write(Author, (Author(name=f'{PREFIX}{_words(rng, 2)} {index}') for index in range(sizes[Author])))
+    write(Genre, (Genre(name=f'{PREFIX}{rng.choice(WORDS)} {index}') for index in range(sizes[Genre])))
+
+    def books():
+        for index in range(sizes[Book]):
+            summary = _words(rng, rng.randint(20, 80))
+            yield Book(
+                title=_words(rng, rng.randint(1, 4)).title(), summary=summary,
+                summary_excerpt=make_summary_excerpt(summary), isbn=f'7{index:012d}',
+                published_date=(now - timedelta(days=rng.randint(0, 36500))).date(), publisher=PREFIX,
+            )
+
+    write(Book, books())
+
+    user_ids = _ids(User.objects.filter(username__startswith=PREFIX).exclude(username=LIBRARIAN))
+    author_ids = _ids(Author.objects.filter(name__startswith=PREFIX))
+    genre_ids = _ids(Genre.objects.filter(name__startswith=PREFIX))
+    book_ids = _ids(Book.objects.filter(publisher=PREFIX))
+
+    def links(through, column, related_ids, most):
+        for book_id in book_ids:
+            for related_id in set(rng.choice(related_ids) for _ in range(rng.randint(1, most))):
+                yield through(book_id=book_id, **{column: related_id})
+
+    write(Book.authors.through, links(Book.authors.through, 'author_id', author_ids, 3))
+    write(Book.genres.through, links(Book.genres.through, 'genre_id', genre_ids, 2))
+    write(Copy, (Copy(book_id=book_id) for book_id in book_ids for _ in range(rng.randint(1, MAX_COPIES))))
+
+    open_count = min(int(sizes[BorrowRequest] * OPEN_SHARE), len(book_ids) // 2)
+    open_books = rng.sample(range(len(book_ids)), open_count)
+    first_copies = {}
+    copies = Copy.objects.filter(book__publisher=PREFIX).order_by('pk').values_list('pk', 'book_id')
+    for copy_id, book_id in copies.iterator(chunk_size=10000):
+        first_copies.setdefault(book_id, copy_id)
+    held = {Copy.RESERVED: [], Copy.ON_LOAN: []}
+
+    def borrower():
+        # Squaring skews the choice towards the first users, who end up with long histories.
+        return user_ids[int(len(user_ids) * rng.random() ** 2)]
+
+    def borrow_requests():
+        for index in range(sizes[BorrowRequest]):
+            if index < open_count:
+                book_id = book_ids[open_books[index]]
+                status = rng.choices(BorrowRequest.OPEN_STATUSES, weights=(60, 15, 25))[0]
+                requested = now - timedelta(hours=rng.uniform(1, 24 * 14))
+            else:
+                book_id = rng.choice(book_ids)
+                status = rng.choices((BorrowRequest.COMPLETE, BorrowRequest.DECLINED), weights=(80, 20))[0]
+                requested = now - timedelta(hours=rng.uniform(24 * 14, 24 * 730))
+            borrow_request = BorrowRequest(book_id=book_id, borrower_id=borrower(), status=status,
+                                           request_date=requested)
+            if index < open_count:
+                borrow_request.copy_id = first_copies[book_id]
+                copy_status = Copy.ON_LOAN if status == BorrowRequest.COLLECTED else Copy.RESERVED
+                held[copy_status].append(borrow_request.copy_id)
+            if status in (BorrowRequest.APPROVED, BorrowRequest.COLLECTED, BorrowRequest.COMPLETE):
+                borrow_request.approval_date = requested + timedelta(hours=rng.uniform(1, 72))
+                borrow_request.due_date = borrow_request.approval_date + timedelta(days=14)
+            if status == BorrowRequest.COMPLETE:
+                borrow_request.complete_date = borrow_request.approval_date + timedelta(days=rng.uniform(1, 20))
+            yield borrow_request
+
+    write(BorrowRequest, borrow_requests())
+
+    for status, copy_ids in held.items():
+        for chunk in _chunks(sorted(copy_ids), batch_size):
+            Copy.objects.filter(pk__in=chunk).update(status=status)
+    # Also brings every Book.available_count in line with the copies.
+    services.rebuild_loan_stats(batch_size=batch_size)
+    search.rebuild_index()
+    for chunk in _chunks(book_ids, batch_size):
+        books_changed.send(sender=Book, book_ids=chunk)
+    relations_changed.send(sender=Author, ids=list(author_ids))
+    relations_changed.send(sender=Genre, ids=list(genre_ids))
+    return sizes
+
+
+def clear(progress=None):
+    """Delete everything ``generate`` created."""
+    started = time.perf_counter()
+    steps = (
+        (BorrowRequest, BorrowRequest.objects.filter(borrower__username__startswith=PREFIX)),
+        (Book, Book.objects.filter(publisher=PREFIX)),
+        (Author, Author.objects.filter(name__startswith=PREFIX)),
+        (Genre, Genre.objects.filter(name__startswith=PREFIX)),
+        (User, User.objects.filter(username__startswith=PREFIX)),
+    )
+    for model, queryset in steps:
+        ids = _ids(queryset)
+        for chunk in _chunks(ids, 5000):
+            with transaction.atomic():
+                model.objects.filter(pk__in=chunk).delete()
+        if progress:
+            progress(model, len(ids))
+    search.rebuild_index()
+    return time.perf_counter() - started
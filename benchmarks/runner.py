@@ -0,0 +1,291 @@
+"""
+Running scenarios and comparing results.
+
+``run_scenario`` runs one scenario in this process with ``DEBUG`` off so queries are not logged. ``run``
+starts a fresh process per scenario so that each one's peak RSS is its own. ``compare`` checks a run against
+a baseline.
+
+A single-client scenario runs inside a transaction that is rolled back, so its writes are never committed and
+``on_commit`` work such as event publishing is not part of its timings. A scenario with several clients runs
+them in threads, each on its own connection, committing as a real server would; the borrow requests, holds
+and tokens the run created for the benchmark users are deleted afterwards.
+
+Query counts come from the ``Server-Timing`` header of ``mysite.metrics.MetricsMiddleware``.
+"""
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from myapp.models import Author, Book, BorrowRequest, Genre, Hold
+
+from . import data
+from .scenarios import SCENARIOS, Library
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+HOST = 'localhost'
+DEFAULT_REQUESTS = 500
+DEFAULT_WARMUP = 50
+
+# metric -> whether a higher value is better
+METRICS = {
+    'throughput': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'queries_per_request': False,
+    'peak_rss_kb': False,
+    'errors': False,
+}
+
+
+def _queries(response):
+    # e.g. 'db;dur=1.2;desc="3 queries", total;dur=4.5'
+    timing = response.get('Server-Timing', '')
+    _, found, rest = timing.partition('desc="')
+    return int(rest.split(' ', 1)[0]) if found else 0
+
+
+def _percentile(values, fraction):
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)] * 1000 if values else None
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class Session:
+    """
+    Issues requests for a scenario and records them. The first ``warmup`` requests are not recorded, and the
+    scenario is ``done`` once ``requests`` more have been.
+    """
+
+    def __init__(self, requests=DEFAULT_REQUESTS, warmup=DEFAULT_WARMUP):
+        self.requests = requests
+        self.warmup = warmup
+        self.issued = 0
+        self.latencies = []
+        self.queries = 0
+        self.errors = 0
+        self.statuses = Counter()
+        self.started = None
+        self.finished = None
+        self._clients = {}
+
+    @property
+    def done(self):
+        return len(self.latencies) >= self.requests
+
+    def client(self, user=None):
+        """A client for ``user``, signed in with both a session and an API token, or an anonymous one."""
+        key = user.pk if user else None
+        if key not in self._clients:
+            client = Client(SERVER_NAME=HOST)
+            if user is not None:
+                client.force_login(user)
+                client.defaults['HTTP_AUTHORIZATION'] = f'Token {Token.objects.get_or_create(user=user)[0].key}'
+            self._clients[key] = client
+        return self._clients[key]
+
+    def get(self, path, user=None, expect=(200,)):
+        return self._call(self.client(user).get, path, expect)
+
+    def post(self, path, payload, user=None, expect=(200,)):
+        return self._call(self.client(user).post, path, expect, data=payload, content_type='application/json')
+
+    def _call(self, method, path, expect, **kwargs):
+        recording = self.issued >= self.warmup
+        started = time.perf_counter()
+        if recording and self.started is None:
+            self.started = started
+        response = method(path, **kwargs)
+        finished = time.perf_counter()
+        self.issued += 1
+        if recording:
+            self.finished = finished
+            self.latencies.append(finished - started)
+            self.queries += _queries(response)
+            self.statuses[response.status_code] += 1
+            self.errors += response.status_code not in expect
+        return response
+
+    @classmethod
+    def merge(cls, sessions):
+        """One session holding the recorded requests of all ``sessions``, for the summary of a concurrent run."""
+        merged = cls(sum(session.requests for session in sessions), sum(session.warmup for session in sessions))
+        for session in sessions:
+            merged.latencies.extend(session.latencies)
+            merged.queries += session.queries
+            merged.errors += session.errors
+            merged.statuses.update(session.statuses)
+        started = [session.started for session in sessions if session.started is not None]
+        finished = [session.finished for session in sessions if session.finished is not None]
+        merged.started, merged.finished = min(started, default=None), max(finished, default=None)
+        return merged
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        elapsed = (self.finished - self.started) if latencies else 0
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'statuses': {str(code): count for code, count in sorted(self.statuses.items())},
+            'seconds': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0,
+            'p50_ms': _percentile(latencies, 0.5),
+            'p95_ms': _percentile(latencies, 0.95),
+            'p99_ms': _percentile(latencies, 0.99),
+            'max_ms': latencies[-1] * 1000 if latencies else None,
+            'queries': self.queries,
+            'queries_per_request': self.queries / len(latencies) if latencies else 0,
+        }
+
+
+def _clear_caches():
+    for alias in settings.CACHES:
+        caches[alias].clear()
+
+
+def run_scenario(name, requests=DEFAULT_REQUESTS, warmup=DEFAULT_WARMUP, seed=0, clients=None):
+    """
+    Run scenario ``name`` here with ``clients`` concurrent clients (the scenario's own number by default) and
+    return its summary; the database is left as it was.
+    """
+    clients = clients or SCENARIOS[name].clients
+    _clear_caches()
+    try:
+        with override_settings(DEBUG=False, ALLOWED_HOSTS=[HOST]):
+            if clients == 1:
+                session = Session(requests, warmup)
+                with transaction.atomic():
+                    SCENARIOS[name](session, Library(), random.Random(f'{seed}:{name}'))
+                    transaction.set_rollback(True)
+            else:
+                session = _run_concurrently(name, requests, warmup, seed, clients)
+    finally:
+        _clear_caches()
+    return dict(session.summary(), clients=clients, peak_rss_kb=peak_rss_kb())
+
+
+def _run_concurrently(name, requests, warmup, seed, clients):
+    """Run ``clients`` copies of scenario ``name`` in threads, with real commits, and clean up after them."""
+    library = Library()
+    marks = {model: model.objects.aggregate(last=Max('pk'))['last'] or 0 for model in (BorrowRequest, Hold)}
+    started = timezone.now()
+    sessions = [
+        Session(math.ceil(requests / clients), math.ceil(warmup / clients)) for _ in range(clients)
+    ]
+    start = threading.Barrier(clients)
+    failures = []
+
+    def client(index):
+        try:
+            start.wait()
+            SCENARIOS[name](sessions[index], library, random.Random(f'{seed}:{name}:{index}'))
+        except BaseException as exc:
+            failures.append(exc)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        _clean_up(marks, started)
+    if failures:
+        raise failures[0]
+    return Session.merge(sessions)
+
+
+def _clean_up(marks, started):
+    """Delete what a concurrent run committed for the benchmark users, holds first so none is promoted."""
+    Hold.objects.filter(pk__gt=marks[Hold], user__username__startswith=data.PREFIX).delete()
+    # Deleting the requests one by one runs the receivers that release their copies and update the summaries.
+    BorrowRequest.objects.filter(pk__gt=marks[BorrowRequest], borrower__username__startswith=data.PREFIX).delete()
+    Token.objects.filter(user__username__startswith=data.PREFIX, created__gte=started).delete()
+
+
+def describe(requests, warmup, seed):
+    return {
+        'created': timezone.now().isoformat(),
+        'requests': requests,
+        'warmup': warmup,
+        'seed': seed,
+        'rows': {
+            model._meta.label: model.objects.count() for model in (User, Author, Genre, Book, BorrowRequest)
+        },
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+    }
+
+
+def run(names=None, requests=DEFAULT_REQUESTS, warmup=DEFAULT_WARMUP, seed=0, in_process=False):
+    """Run ``names`` (all scenarios by default), each in a process of its own unless ``in_process``."""
+    results = {'meta': describe(requests, warmup, seed), 'scenarios': {}}
+    for name in names or SCENARIOS:
+        if in_process:
+            results['scenarios'][name] = run_scenario(name, requests, warmup, seed)
+            continue
+        command = [
+            sys.executable, '-m', 'benchmarks', 'run', '--child', name, '--requests', str(requests),
+            '--warmup', str(warmup), '--seed', str(seed),
+        ]
+        completed = subprocess.run(command, cwd=settings.BASE_DIR, capture_output=True, text=True)
+        if completed.returncode:
+            raise RuntimeError(f'{name} failed:\n{completed.stderr}')
+        results['scenarios'][name] = json.loads(completed.stdout.strip().splitlines()[-1])
+    return results
+
+
+def compare(baseline, current, tolerance=0.1, query_tolerance=0.0):
+    """
+    Return ``(scenario, metric, baseline, current, change, regressed)`` rows for every metric of ``METRICS``
+    found in both results. A metric regressed if it got worse by more than ``tolerance`` (a fraction of the
+    baseline), ``query_tolerance`` for the query count; any new error is a regression, as is a missing scenario.
+    """
+    rows = []
+    for name, before in baseline['scenarios'].items():
+        after = current['scenarios'].get(name)
+        if after is None:
+            rows.append((name, 'missing', None, None, None, True))
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (math.inf if new > old else 0.0)
+            worse = -change if higher_is_better else change
+            if metric == 'errors':
+                regressed = new > old
+            elif metric == 'queries_per_request':
+                regressed = worse > query_tolerance
+            else:
+                regressed = worse > tolerance
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
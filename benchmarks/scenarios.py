@@ -0,0 +1,122 @@
+"""
+Scripted load scenarios.
+
+Each scenario is a function of ``(session, library, rng)`` that keeps issuing requests through ``session`` until
+``session.done``, choosing what to do from ``rng`` so a run is repeatable. ``library`` gives access to the data
+``benchmarks.data`` generated. Scenarios register themselves in ``SCENARIOS`` with ``@scenario``; those
+registered with ``clients=N`` are run by ``N`` threads at once, each with its own session, rng and database
+connection, so they measure contention (see ``benchmarks.runner``).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.utils import timezone
+
+from myapp.models import Book, BorrowRequest
+
+from . import data
+
+SCENARIOS = {}
+# Users taking part in the scenarios that need a signed-in reader.
+READERS = 50
+# Requests per bulk call in approval_batch, about a screenful for a librarian.
+APPROVAL_BATCH = 25
+
+
+def scenario(function=None, *, clients=1):
+    if function is None:
+        return lambda function: scenario(function, clients=clients)
+    function.clients = clients
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+class Library:
+    """The generated data, as the scenarios need it."""
+
+    def __init__(self):
+        self.book_ids = data._ids(Book.objects.filter(publisher=data.PREFIX))
+        if not self.book_ids:
+            raise LookupError('No benchmark data; run "python -m benchmarks generate" first.')
+        self.librarian = User.objects.get(username=data.LIBRARIAN)
+        readers = User.objects.filter(username__startswith=data.PREFIX).exclude(pk=self.librarian.pk)
+        # Users are created in order and the generator favours the first ones, whose histories are the longest.
+        self.readers = list(readers.order_by('pk')[:READERS])
+        self.words = data.WORDS
+
+    def pending_ids(self):
+        return list(
+            BorrowRequest.objects.filter(borrower__username__startswith=data.PREFIX, status=BorrowRequest.PENDING)
+            .order_by('pk').values_list('pk', flat=True)
+        )
+
+
+@scenario
+def catalogue_browse(session, library, rng):
+    """Anonymous readers paging through the library and opening books, authors, genres and searches."""
+    next_page = None
+    while not session.done:
+        roll = rng.random()
+        if roll < 0.4:
+            page = session.get(next_page or reverse('api_library_fund') + '?page_size=50').json()
+            # Readers give up after a few pages and start over.
+            next_page = page['next'] if rng.random() < 0.8 else None
+        elif roll < 0.6:
+            session.get(reverse('api_book-detail', kwargs={'book_id': rng.choice(library.book_ids)}))
+        elif roll < 0.7:
+            session.get(reverse('author-list'))
+        elif roll < 0.8:
+            session.get(reverse('genre-list'))
+        elif roll < 0.9:
+            session.get(reverse('book-search') + f'?q={rng.choice(library.words)}')
+        else:
+            session.get(reverse('book-popular') + '?limit=20')
+
+
+@scenario(clients=8)
+def borrow_storm(session, library, rng):
+    """
+    Many readers asking for random books at once; most books are free, some were just taken. Every client
+    commits its borrows, so claims really compete for copies and the on-commit work runs.
+    """
+    while not session.done:
+        session.post(reverse('api_library_fund'), {'book_id': rng.choice(library.book_ids)},
+                     user=rng.choice(library.readers), expect=(201, 202, 400))
+
+
+@scenario
+def approval_batch(session, library, rng):
+    """
+    A librarian working through the pending requests with bulk approvals and declines. A single-client latency
+    probe: it changes existing requests, which only the rollback of a one-client run can undo.
+    """
+    pending = library.pending_ids()
+    rng.shuffle(pending)
+    due_date = (timezone.now() + timedelta(days=14)).isoformat()
+    size = min(APPROVAL_BATCH, settings.API_BULK_MAX_ITEMS)
+    while not session.done and pending:
+        batch, pending = pending[:size], pending[size:]
+        items = [
+            {'id': pk, 'action': 'approve', 'due_date': due_date} if rng.random() < 0.8
+            else {'id': pk, 'action': 'decline'}
+            for pk in batch
+        ]
+        session.post(reverse('borrowrequest-bulk'), items, user=library.librarian)
+
+
+@scenario
+def history_pagination(session, library, rng):
+    """Heavy borrowers reading their history through the API cursors and the paginated page."""
+    heavy = library.readers[:5]
+    while not session.done:
+        user = rng.choice(heavy)
+        if rng.random() < 0.5:
+            path = reverse('api_borrow_history') + '?page_size=50'
+            for _ in range(rng.randint(1, 10)):
+                if session.done or path is None:
+                    break
+                path = session.get(path, user=user).json()['next']
+        else:
+            session.get(reverse('borrow_history') + f'?page={rng.randint(1, 3)}', user=user, expect=(200, 404))
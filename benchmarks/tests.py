@@ -0,0 +1,78 @@
+from django.test import TestCase, TransactionTestCase
+
+from myapp import history, services
+from myapp.models import Book, BorrowRequest, Copy, Hold, UserLoanStats
+from . import data, runner
+
+
+class BenchmarkTests(TestCase):
+
+    def setUp(self):
+        self.sizes = data.generate(2000, seed=1)
+
+    def test_generated_data_follows_the_borrowing_rules(self):
+        self.assertEqual(Book.objects.filter(publisher=data.PREFIX).count(), self.sizes[Book])
+        self.assertEqual(BorrowRequest.objects.count(), self.sizes[BorrowRequest])
+        open_requests = BorrowRequest.objects.filter(status__in=BorrowRequest.OPEN_STATUSES)
+        self.assertEqual(open_requests.values('book').distinct().count(), open_requests.count())
+        self.assertFalse(open_requests.filter(copy=None).exists())
+        self.assertEqual(open_requests.values('copy').distinct().count(), open_requests.count())
+        held = Copy.objects.filter(status__in=(Copy.RESERVED, Copy.ON_LOAN))
+        self.assertEqual(held.count(), open_requests.count())
+        self.assertEqual(services.rebuild_loan_stats(), (0, UserLoanStats.objects.count()))
+
+    def test_scenarios_leave_the_data_untouched(self):
+        requests = set(BorrowRequest.objects.values_list('pk', 'status'))
+
+        for name in runner.SCENARIOS:
+            with self.subTest(scenario=name):
+                # One client, so the run stays inside this test's transaction and is rolled back.
+                result = runner.run_scenario(name, requests=5, warmup=1, clients=1)
+                # approval_batch stops early once the pending requests run out.
+                self.assertIn(result['requests'], range(1, 6))
+                self.assertEqual(result['errors'], 0)
+                self.assertGreater(result['queries'], 0)
+
+        self.assertEqual(set(BorrowRequest.objects.values_list('pk', 'status')), requests)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'scenarios': {
+            'browse': {'throughput': 100, 'p99_ms': 10, 'queries_per_request': 2, 'errors': 0},
+            'borrow': {'throughput': 100},
+        }}
+        current = {'scenarios': {'browse': {'throughput': 95, 'p99_ms': 12, 'queries_per_request': 3, 'errors': 0}}}
+
+        rows = runner.compare(baseline, current, tolerance=0.1)
+
+        self.assertEqual([(name, metric) for name, metric, *_, regressed in rows if regressed],
+                         [('browse', 'p99_ms'), ('browse', 'queries_per_request'), ('borrow', 'missing')])
+
+
+class ConcurrentBenchmarkTests(TransactionTestCase):
+    """Runs against the file-backed test database, where the clients' writers wait for each other."""
+
+    def setUp(self):
+        data.generate(500, seed=1)
+
+    def snapshot(self):
+        return {
+            'requests': set(BorrowRequest.objects.values_list('pk', 'status', 'copy_id')),
+            'copies': set(Copy.objects.values_list('pk', 'status')),
+            'books': set(Book.objects.values_list('pk', 'available_count', 'borrow_count')),
+            'summaries': set(UserLoanStats.objects.values_list()),
+            'status_counts': history.status_counts(),
+        }
+
+    def test_concurrent_clients_commit_and_are_cleaned_up(self):
+        before = self.snapshot()
+
+        result = runner.run_scenario('borrow_storm', requests=30, warmup=3, clients=3)
+
+        self.assertEqual((result['clients'], result['errors']), (3, 0))
+        self.assertGreaterEqual(result['requests'], 30)
+        self.assertIn('201', result['statuses'])
+        self.assertFalse(Hold.objects.exists())
+        # The delete receivers put back every copy and counter the run moved, so nothing is left to rebuild.
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(services.rebuild_loan_stats()[0], 0)
+        self.assertEqual(self.snapshot(), before)
@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.models import User
 from .models import Author, Genre, Book
+from . import inventory
 from django.utils import timezone
 
 
@@ -35,11 +36,12 @@ class GenreForm(forms.ModelForm):
 
 class BookForm(forms.ModelForm):
     published_date = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}))
+    copies = forms.IntegerField(min_value=0, initial=1, help_text='Copies in circulation.')
 
     class Meta:
         model = Book
         fields = [
-            'title', 'summary', 'isbn', 'available', 'published_date', 'publisher',
+            'title', 'summary', 'isbn', 'published_date', 'publisher',
             'genres', 'authors',
         ]
         widgets = {
@@ -48,6 +50,11 @@ class BookForm(forms.ModelForm):
             'authors': forms.CheckboxSelectMultiple(),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.fields['copies'].initial = inventory.in_circulation(self.instance.pk)
+
     def clean_published_date(self):
         published_date = self.cleaned_data.get('published_date')
         if published_date > timezone.now().date():
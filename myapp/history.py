@@ -0,0 +1,159 @@
+"""
+Per-user borrow history summaries.
+
+``UserLoanStats`` holds each user's request counts per status, active loans, loans and next due date.
+``record`` applies a batch of status changes to it with a single UPDATE, so the summary is maintained incrementally
+as requests are created, transitioned and deleted instead of being recomputed from the history. ``get_summary``
+serves it from the ``LOAN_SUMMARY_CACHE_ALIAS`` cache, and ``record`` forgets the summaries it changes.
+
+The same pass adds the changes to ``BorrowStatusCount``, the library-wide count of requests per status, with
+one more UPDATE of a single stripe, so ``status_counts`` reads the librarian queue's totals from a fixed
+handful of rows however many users there are.
+"""
+import random
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Case, Count, F, Min, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Greatest
+
+from .models import BorrowRequest, BorrowStatusCount, UserLoanStats
+
+SUMMARY_FIELDS = (
+    'active_loans', 'loans', 'pending', 'approved', 'collected', 'complete', 'declined', 'next_due_date',
+)
+
+
+def get_summary_cache():
+    return caches[settings.LOAN_SUMMARY_CACHE_ALIAS]
+
+
+def _cache_key(user_id):
+    return f'loan-summary:{user_id}'
+
+
+def _fields(status):
+    fields = [UserLoanStats.STATUS_FIELDS[status]]
+    if status in BorrowRequest.ACTIVE_LOAN_STATUSES:
+        fields.append('active_loans')
+    if status in BorrowRequest.LOAN_STATUSES:
+        fields.append('loans')
+    return fields
+
+
+def next_due_date():
+    """Subquery for the earliest due date among the active loans of the ``user_id`` row."""
+    loans = BorrowRequest.objects.filter(
+        borrower=OuterRef('user_id'), status__in=BorrowRequest.ACTIVE_LOAN_STATUSES,
+    ).order_by().values('borrower').annotate(next_due_date=Min('due_date'))
+    return Subquery(loans.values('next_due_date'))
+
+
+def record(changes):
+    """
+    Apply ``changes``, ``(borrower_id, old_status, new_status)`` triples where ``None`` stands for a request
+    being created or deleted, to the borrowers' summaries. Call it after the borrow requests were written.
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    status_deltas = Counter()
+    users, created_for, due_dates_moved = set(), set(), set()
+    for user_id, old, new in changes:
+        users.add(user_id)
+        for status, sign in ((old, -1), (new, 1)):
+            if status is not None:
+                status_deltas[status] += sign
+                for field in _fields(status):
+                    deltas[field][user_id] += sign
+        if new is not None:
+            created_for.add(user_id)
+        if (old in BorrowRequest.ACTIVE_LOAN_STATUSES) != (new in BorrowRequest.ACTIVE_LOAN_STATUSES):
+            due_dates_moved.add(user_id)
+    if not users:
+        return
+
+    updates = {}
+    for field, counts in deltas.items():
+        whens = [When(user_id=user_id, then=Value(delta)) for user_id, delta in counts.items() if delta]
+        if whens:
+            updates[field] = Greatest(F(field) + Case(*whens, default=Value(0)), Value(0))
+    if due_dates_moved:
+        updates['next_due_date'] = Case(
+            When(user_id__in=due_dates_moved, then=next_due_date()), default=F('next_due_date'),
+        )
+
+    # Rows are only created for users gaining a request: deleting a user deletes their requests, and their
+    # summary must not be recreated on the way out.
+    if created_for:
+        UserLoanStats.objects.bulk_create([UserLoanStats(user_id=user_id) for user_id in created_for],
+                                          ignore_conflicts=True)
+    if updates:
+        UserLoanStats.objects.filter(user_id__in=users).update(**updates)
+    _count_statuses(status_deltas)
+    forget(users)
+
+
+def _count_statuses(status_deltas):
+    """Add ``status_deltas`` to one randomly picked stripe of ``BorrowStatusCount``, in one UPDATE."""
+    status_deltas = {status: delta for status, delta in status_deltas.items() if delta}
+    if not status_deltas:
+        return
+    stripe = random.randrange(BorrowStatusCount.STRIPES)
+    delta = Case(*(When(status=status, then=Value(count)) for status, count in status_deltas.items()),
+                 default=Value(0))
+    stripes = BorrowStatusCount.objects.filter(stripe=stripe, status__in=list(status_deltas))
+    if stripes.update(count=F('count') + delta) < len(status_deltas):
+        # The stripes are created by migration, but a flushed table (as in TransactionTestCase) has none.
+        present = set(stripes.values_list('status', flat=True))
+        BorrowStatusCount.objects.bulk_create(
+            [BorrowStatusCount(status=status, stripe=stripe, count=count)
+             for status, count in status_deltas.items() if status not in present],
+            ignore_conflicts=True,
+        )
+
+
+def rebuild_status_counts():
+    """Recompute ``BorrowStatusCount`` from the borrow requests, the totals going to each status's first stripe."""
+    totals = dict(BorrowRequest.objects.order_by().values('status').annotate(count=Count('pk'))
+                  .values_list('status', 'count'))
+    BorrowStatusCount.objects.all().delete()
+    BorrowStatusCount.objects.bulk_create(
+        BorrowStatusCount(status=status, stripe=stripe, count=totals.get(status, 0) if stripe == 0 else 0)
+        for status in UserLoanStats.STATUS_FIELDS for stripe in range(BorrowStatusCount.STRIPES)
+    )
+
+
+def forget(user_ids):
+    """Drop cached summaries now and again once the transaction commits, like the catalogue cache does."""
+    keys = [_cache_key(user_id) for user_id in user_ids]
+    get_summary_cache().delete_many(keys)
+    transaction.on_commit(lambda: get_summary_cache().delete_many(keys))
+
+
+def get_summary(user_id):
+    """Return the summary of ``user_id`` as a dict, or ``None`` if there is no such user."""
+    cache = get_summary_cache()
+    summary = cache.get(_cache_key(user_id))
+    if summary is not None:
+        return summary
+
+    row = UserLoanStats.objects.filter(user_id=user_id).values(*SUMMARY_FIELDS).first()
+    if row is None:
+        if not User.objects.filter(pk=user_id).exists():
+            return None
+        row = {field: UserLoanStats._meta.get_field(field).get_default() for field in SUMMARY_FIELDS}
+    summary = {'user': user_id, **row}
+    cache.set(_cache_key(user_id), summary, timeout=settings.LOAN_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+
+def status_counts():
+    """Return ``{status: number of borrow requests}`` over all users, added up from the status stripes."""
+    counts = dict.fromkeys(UserLoanStats.STATUS_FIELDS, 0)
+    counts.update(
+        BorrowStatusCount.objects.order_by().values('status').annotate(total=Sum('count'))
+        .values_list('status', 'total')
+    )
+    return counts
@@ -0,0 +1,247 @@
+"""
+Bulk catalogue import.
+
+Records are streamed from CSV, JSON Lines or a simple MARC-like tagged format and written ``batch_size`` at a
+time: authors and genres are resolved through in-memory name to id maps, books are upserted on ``isbn`` with
+one ``bulk_create`` and their author and genre links are replaced with one more per relation. Each batch runs
+in its own transaction, so an interrupted import keeps the batches it finished and can simply be re-run.
+"""
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import inventory, search
+from .models import Author, Book, Genre, make_summary_excerpt
+from .signals import books_changed, relations_changed
+
+BOOK_FIELDS = ('title', 'summary', 'isbn', 'published_date', 'publisher')
+UPDATE_FIELDS = ('title', 'summary', 'summary_excerpt', 'published_date', 'publisher', 'updated_at')
+LIST_SEPARATOR = ';'
+# Messages kept for the first rejected records; the rest are only counted, so bad input costs no memory.
+MAX_ERRORS = 100
+
+# Tags understood by the MARC-like reader; repeated tags accumulate for authors and genres.
+MARC_TAGS = {
+    '020': 'isbn',
+    '100': 'authors',
+    '700': 'authors',
+    '245': 'title',
+    '260': 'publisher',
+    '362': 'published_date',
+    '520': 'summary',
+    '650': 'genres',
+    '655': 'genres',
+}
+
+
+def _text(name, value):
+    """A field value as text. JSON numbers are taken as written, so a numeric ISBN or year still imports."""
+    if value is None:
+        return ''
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValidationError(f'Invalid {name}: expected text, got {type(value).__name__}.')
+    return str(value).strip()
+
+
+def _split(name, value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(LIST_SEPARATOR)
+    elif not isinstance(value, list):
+        raise ValidationError(f'Invalid {name}: expected a list or a {LIST_SEPARATOR!r}-separated string.')
+    names = (_text(name, item) for item in value)
+    return [item for item in names if item]
+
+
+def read_csv(stream):
+    """Yield ``(line, record)`` pairs from CSV with a header row; authors and genres are ``;``-separated."""
+    reader = csv.DictReader(stream)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def read_jsonl(stream):
+    """Yield ``(line, record)`` pairs from one JSON object per line; authors and genres may be lists."""
+    for line, text in enumerate(stream, start=1):
+        if text.strip():
+            try:
+                yield line, json.loads(text)
+            except ValueError as exc:
+                yield line, exc
+
+
+def read_marc(stream):
+    """
+    Yield ``(line, record)`` pairs from a tagged format with one ``TAG value`` field per line and blank lines
+    between records, e.g. ``245 The Hobbit``. See ``MARC_TAGS`` for the tags that are read.
+    """
+    record, start = {}, None
+    for line, text in enumerate(stream, start=1):
+        text = text.rstrip('\n')
+        if not text.strip():
+            if record:
+                yield start, record
+            record, start = {}, None
+            continue
+        start = start or line
+        name = MARC_TAGS.get(text[:3])
+        value = text[4:].strip()
+        if name in ('authors', 'genres'):
+            record.setdefault(name, []).append(value)
+        elif name:
+            record[name] = value
+    if record:
+        yield start, record
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'marc': read_marc}
+
+
+@dataclass
+class ImportStats:
+    processed: int = 0
+    created: int = 0
+    updated: int = 0
+    skipped: int = 0
+    # ``(line, message)`` for the first ``max_errors`` skipped records.
+    errors: list = field(default_factory=list)
+    max_errors: int = MAX_ERRORS
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def rate(self):
+        return self.processed / max(time.perf_counter() - self.started, 1e-9)
+
+    @property
+    def errors_left_out(self):
+        return self.skipped - len(self.errors)
+
+    def add_error(self, line, message):
+        self.skipped += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, message))
+
+
+def _clean(record):
+    if isinstance(record, Exception):
+        raise ValidationError(f'Invalid record: {record}')
+    if not isinstance(record, dict):
+        raise ValidationError(f'Invalid record: expected an object, got {type(record).__name__}.')
+    values = {name: _text(name, record.get(name)) for name in BOOK_FIELDS}
+    for name in ('title', 'isbn', 'published_date', 'publisher'):
+        if not values[name]:
+            raise ValidationError(f'Missing {name}.')
+    for name in BOOK_FIELDS:
+        model_field = Book._meta.get_field(name)
+        values[name] = model_field.to_python(values[name])
+        model_field.run_validators(values[name])
+    return values, _split('authors', record.get('authors')), _split('genres', record.get('genres'))
+
+
+class _NameMap:
+    """Name to id map for ``Author`` or ``Genre`` that creates missing rows in bulk."""
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = {}
+        for pk, name in model.objects.order_by('-pk').values_list('pk', 'name').iterator():
+            self.ids[name] = pk
+
+    def resolve(self, names):
+        missing = [name for name in dict.fromkeys(names) if name not in self.ids]
+        if missing:
+            self.model.objects.bulk_create(self.model(name=name) for name in missing)
+            # Read the ids back rather than relying on bulk_create returning them, which not every backend does.
+            created = self.model.objects.filter(name__in=missing).order_by('-pk').values_list('pk', 'name')
+            created_ids = []
+            for pk, name in created:
+                self.ids[name] = pk
+                created_ids.append(pk)
+            relations_changed.send(sender=self.model, ids=created_ids)
+        return self.ids
+
+
+class CatalogueImporter:
+    def __init__(self, batch_size=1000, progress=None, max_errors=MAX_ERRORS):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.authors = _NameMap(Author)
+        self.genres = _NameMap(Genre)
+        self.stats = ImportStats(max_errors=max_errors)
+
+    def run(self, rows):
+        batch = {}
+        for line, record in rows:
+            self.stats.processed += 1
+            try:
+                values, authors, genres = _clean(record)
+            except ValidationError as exc:
+                self.stats.add_error(line, ' '.join(exc.messages))
+                continue
+            # A later record for the same ISBN replaces an earlier one in the same batch.
+            batch.pop(values['isbn'], None)
+            batch[values['isbn']] = (values, authors, genres)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = {}
+        if batch:
+            self._write(batch)
+        return self.stats
+
+    def _write(self, batch):
+        with transaction.atomic():
+            author_ids = self.authors.resolve(name for _, authors, _ in batch.values() for name in authors or ())
+            genre_ids = self.genres.resolve(name for _, _, genres in batch.values() for name in genres or ())
+
+            existing = set(Book.objects.filter(isbn__in=batch).values_list('isbn', flat=True))
+            Book.objects.bulk_create(
+                [
+                    Book(summary_excerpt=make_summary_excerpt(values['summary']), **values)
+                    for values, _, _ in batch.values()
+                ],
+                update_conflicts=True,
+                unique_fields=['isbn'],
+                update_fields=UPDATE_FIELDS,
+            )
+            book_ids = dict(Book.objects.filter(isbn__in=batch).values_list('isbn', 'pk'))
+            inventory.add_copies(book_id for isbn, book_id in book_ids.items() if isbn not in existing)
+
+            self._replace_links(Book.authors.through, 'author_id', author_ids, book_ids, batch, position=1)
+            self._replace_links(Book.genres.through, 'genre_id', genre_ids, book_ids, batch, position=2)
+
+            search.index_books(book_ids.values())
+            books_changed.send(sender=Book, book_ids=list(book_ids.values()))
+
+        self.stats.created += len(batch) - len(existing)
+        self.stats.updated += len(existing)
+        if self.progress:
+            self.progress(self.stats)
+
+    @staticmethod
+    def _replace_links(through, column, related_ids, book_ids, batch, position):
+        """Replace the links of every book whose record listed this relation; others keep theirs."""
+        listed = {isbn: entry[position] for isbn, entry in batch.items() if entry[position] is not None}
+        if not listed:
+            return
+        through.objects.filter(book_id__in=[book_ids[isbn] for isbn in listed]).delete()
+        through.objects.bulk_create(
+            [
+                through(book_id=book_ids[isbn], **{column: related_ids[name]})
+                for isbn, names in listed.items()
+                for name in dict.fromkeys(names)
+            ],
+            batch_size=5000,
+        )
+
+
+def import_catalogue(rows, batch_size=1000, progress=None, max_errors=MAX_ERRORS):
+    """
+    Import ``(line, record)`` pairs from one of ``READERS`` and return an ``ImportStats`` holding the messages of
+    the first ``max_errors`` skipped records.
+    """
+    return CatalogueImporter(batch_size=batch_size, progress=progress, max_errors=max_errors).run(rows)
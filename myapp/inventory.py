@@ -0,0 +1,151 @@
+"""
+Book copies and the cached ``Book.available_count``.
+
+Every copy is its own row, so claiming one is a conditional UPDATE of a single free copy: requests for a popular
+title pick among its first ``CLAIM_SPREAD`` free copies at random and mostly go after different rows, and a
+claim that loses a race simply tries another copy. Batches claim with ``claim_copies``, a few queries for any
+number of copies.
+
+``available_count`` is a cache of the free copies. Copies added or withdrawn are counted at once, but claims and
+returns are counted once the transaction that moved the copies commits, in a short UPDATE of their own, so a
+claim never holds the book row and concurrent claims on a popular title do not queue behind each other. Code
+that must know the free copies inside a transaction counts them with ``free_copies``. If a process dies between
+the commit and the count update, the count is off until ``recount`` (or ``myapp.services.rebuild_loan_stats``)
+rebuilds it from the copies.
+
+These functions only write rows; ``myapp.services`` wraps them in transactions and sends ``books_changed``.
+"""
+import random
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Book, Copy
+
+CLAIM_SPREAD = 8
+CLAIM_ATTEMPTS = 3
+
+
+def _apply_counts(book_counts):
+    """Add ``book_counts[book_id]`` (negative to take away) to the ``available_count`` of each book, in one UPDATE."""
+    delta = Case(*(When(pk=book_id, then=Value(count)) for book_id, count in book_counts.items()), default=Value(0))
+    Book.objects.filter(pk__in=list(book_counts)).update(
+        available_count=Greatest(F('available_count') + delta, Value(0)),
+    )
+
+
+def _count_available(book_counts):
+    """``_apply_counts`` once the current transaction commits, for copies moved by circulation."""
+    book_counts = {book_id: count for book_id, count in book_counts.items() if count}
+    if book_counts:
+        # robust: the copies are already committed, and recount repairs a count that failed to follow them.
+        transaction.on_commit(partial(_apply_counts, book_counts), robust=True)
+
+
+def free_copies(book_ids):
+    """``{book_id: free copies}`` for those of ``book_ids`` with any, read from the copies themselves."""
+    return dict(
+        Copy.objects.filter(book_id__in=book_ids, status=Copy.AVAILABLE)
+        .order_by().values('book_id').annotate(count=Count('pk')).values_list('book_id', 'count')
+    )
+
+
+def available_copies():
+    """Subquery counting the free copies of the ``pk`` book row."""
+    copies = (
+        Copy.objects.filter(book=OuterRef('pk'), status=Copy.AVAILABLE)
+        .order_by().values('book').annotate(count=Count('pk')).values('count')
+    )
+    return Coalesce(Subquery(copies), 0)
+
+
+def recount(book_ids=None):
+    """Recompute ``available_count`` from the copies, for ``book_ids`` or every book."""
+    books = Book.objects.all() if book_ids is None else Book.objects.filter(pk__in=book_ids)
+    return books.update(available_count=available_copies())
+
+
+def add_copies(book_ids, count=1):
+    """Put ``count`` new copies of each of ``book_ids`` on the shelf."""
+    book_ids = list(book_ids)
+    if not book_ids or not count:
+        return
+    Copy.objects.bulk_create([Copy(book_id=book_id) for book_id in book_ids for _ in range(count)],
+                             batch_size=5000)
+    # Stocking is rare and not contended, so it is counted straight away, like withdrawals.
+    _apply_counts({book_id: count for book_id in book_ids})
+
+
+def withdraw_copies(book_id, count):
+    """Take up to ``count`` free copies of ``book_id`` out of circulation; returns how many were withdrawn."""
+    copy_ids = list(
+        Copy.objects.filter(book_id=book_id, status=Copy.AVAILABLE).values_list('pk', flat=True)[:count]
+    )
+    withdrawn = Copy.objects.filter(pk__in=copy_ids, status=Copy.AVAILABLE).update(status=Copy.WITHDRAWN)
+    if withdrawn:
+        _apply_counts({book_id: -withdrawn})
+    return withdrawn
+
+
+def in_circulation(book_id):
+    return Copy.objects.filter(book_id=book_id).exclude(status=Copy.WITHDRAWN).count()
+
+
+def claim_copy(book_id):
+    """Reserve a free copy of ``book_id`` and return its id, or ``None`` if every copy is taken."""
+    free = Copy.objects.filter(book_id=book_id, status=Copy.AVAILABLE)
+    for _ in range(CLAIM_ATTEMPTS):
+        candidates = list(free.values_list('pk', flat=True)[:CLAIM_SPREAD])
+        if not candidates:
+            return None
+        copy_id = random.choice(candidates)
+        if Copy.objects.filter(pk=copy_id, status=Copy.AVAILABLE).update(status=Copy.RESERVED):
+            _count_available({book_id: -1})
+            return copy_id
+    return None
+
+
+def claim_copies(book_ids):
+    """
+    Reserve a free copy for every entry of ``book_ids``, which may list a book more than once, in a fixed number
+    of queries. Returns the copy ids in the same order, ``None`` where the book had no free copy left.
+    """
+    book_ids = list(book_ids)
+    free = defaultdict(list)
+    # Locking the free copies, where the database can, keeps concurrent claims off them until this commits.
+    copies = Copy.objects.select_for_update(skip_locked=True).filter(
+        book_id__in=set(book_ids), status=Copy.AVAILABLE,
+    ).order_by('pk').values_list('pk', 'book_id')
+    for copy_id, book_id in copies:
+        free[book_id].append(copy_id)
+    claimed = [free[book_id].pop(0) if free[book_id] else None for book_id in book_ids]
+    taken = Counter(book_id for book_id, copy_id in zip(book_ids, claimed) if copy_id is not None)
+    if taken:
+        Copy.objects.filter(pk__in=[copy_id for copy_id in claimed if copy_id is not None]).update(
+            status=Copy.RESERVED,
+        )
+        _count_available({book_id: -count for book_id, count in taken.items()})
+    return claimed
+
+
+def move_copies(copies, status):
+    """
+    Set ``status`` on ``copies``, ``(copy_id, book_id)`` pairs, adjusting ``available_count`` for copies that
+    leave or return to the shelf.
+    """
+    copies = [(copy_id, book_id) for copy_id, book_id in copies if copy_id is not None]
+    if not copies:
+        return
+    copy_ids = [copy_id for copy_id, _ in copies]
+    # Copies already in the target status are left alone and not counted twice.
+    moved = list(
+        Copy.objects.filter(pk__in=copy_ids).filter(~Q(status=status)).values_list('pk', 'book_id', 'status')
+    )
+    Copy.objects.filter(pk__in=[copy_id for copy_id, _, _ in moved]).update(status=status)
+    counts = Counter()
+    for _, book_id, previous in moved:
+        counts[book_id] += (status == Copy.AVAILABLE) - (previous == Copy.AVAILABLE)
+    _count_available(counts)
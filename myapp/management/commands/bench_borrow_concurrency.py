@@ -0,0 +1,99 @@
+import random
+import threading
+import time
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+from myapp import inventory
+from myapp.models import Book, BorrowRequest
+from myapp.services import BorrowError, request_borrow
+
+PREFIX = 'bench-borrow-'
+
+
+class Command(BaseCommand):
+    help = (
+        'Hammer request_borrow from many threads and verify that no copy is reserved twice. '
+        'Runs against the configured database and removes its fixtures afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--books', type=int, default=8, help='Number of contended books.')
+        parser.add_argument('--copies', type=int, default=1, help='Copies of each book.')
+        parser.add_argument('--attempts', type=int, default=20, help='Borrow attempts per thread.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.cleanup()
+        User.objects.bulk_create(User(username=f'{PREFIX}{index}') for index in range(options['threads']))
+        users = list(User.objects.filter(username__startswith=PREFIX).order_by('pk'))
+        Book.objects.bulk_create(
+            Book(title=f'{PREFIX}{index}', summary='', isbn=f'9{index:012d}', published_date='2000-01-01',
+                 publisher=PREFIX)
+            for index in range(options['books'])
+        )
+        books = list(Book.objects.filter(publisher=PREFIX).order_by('pk'))
+        inventory.add_copies([book.pk for book in books], options['copies'])
+
+        outcomes = Counter()
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(users))
+
+        def worker(user, seed):
+            rng = random.Random(seed)
+            barrier.wait()
+            try:
+                for _ in range(options['attempts']):
+                    book = rng.choice(books)
+                    try:
+                        request_borrow(Book(pk=book.pk), user)
+                        outcome = 'reserved'
+                    except BorrowError:
+                        outcome = 'rejected'
+                    except OperationalError:
+                        outcome = 'lock_timeout'
+                    with lock:
+                        outcomes[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(user, options['seed'] + index))
+            for index, user in enumerate(users)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        per_copy = Counter(
+            BorrowRequest.objects.filter(book__in=books).values_list('copy_id', flat=True)
+        )
+        double_allocations = sum(1 for copy_id, count in per_copy.items() if copy_id is None or count > 1)
+        attempts = sum(outcomes.values())
+
+        self.stdout.write(
+            f'{attempts} attempts on {len(books)} books of {options["copies"]} copies from {len(users)} threads in {elapsed:.2f}s '
+            f'({attempts / elapsed:.0f} attempts/s)'
+        )
+        self.stdout.write(', '.join(f'{name}={count}' for name, count in sorted(outcomes.items())))
+        try:
+            if double_allocations:
+                raise CommandError(f'{double_allocations} copies were allocated more than once.')
+            if outcomes['reserved'] != sum(per_copy.values()):
+                raise CommandError(
+                    f'{outcomes["reserved"]} borrows succeeded but {sum(per_copy.values())} requests were saved.'
+                )
+            self.stdout.write(self.style.SUCCESS('No double allocations.'))
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        Book.objects.filter(publisher=PREFIX).delete()
+        User.objects.filter(username__startswith=PREFIX).delete()
@@ -0,0 +1,209 @@
+import asyncio
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from myapp import inventory
+from myapp.models import Author, Book, BorrowRequest
+
+PREFIX = 'bench-deploy-'
+HOST = 'localhost'
+
+
+def _summary(deployment, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        return latencies[max(math.ceil(fraction * len(latencies)) - 1, 0)] * 1000 if latencies else None
+
+    return {
+        'deployment': deployment,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def run_wsgi(paths, token, concurrency, requests):
+    """Drive the WSGI application from ``concurrency`` threads, as a threaded WSGI server would."""
+    from django.db import connection
+    from mysite.wsgi import application
+
+    def call(path):
+        path, _, query = path.partition('?')
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+            'SERVER_NAME': HOST, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': HOST,
+            'HTTP_AUTHORIZATION': f'Token {token}', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+            'wsgi.url_scheme': 'http', 'wsgi.version': (1, 0), 'wsgi.multithread': True,
+            'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        statuses = []
+        started = time.perf_counter()
+        body = application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return time.perf_counter() - started, statuses[0].startswith(('200', '304'))
+
+    def worker(index):
+        results = [call(paths[(index + step) % len(paths)]) for step in range(index, requests, concurrency)]
+        connection.close()
+        return results
+
+    for path in paths:
+        call(path)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = [result for batch in pool.map(worker, range(concurrency)) for result in batch]
+    elapsed = time.perf_counter() - started
+    return _summary('wsgi', [latency for latency, _ in results], sum(not ok for _, ok in results), elapsed)
+
+
+def run_asgi(paths, token, concurrency, requests):
+    """Drive the ASGI application from ``concurrency`` concurrent clients on one event loop."""
+    from mysite.asgi import application
+
+    async def call(path):
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+            'headers': [(b'host', HOST.encode()), (b'authorization', f'Token {token}'.encode())],
+            'client': ('127.0.0.1', 0), 'server': (HOST, 80),
+        }
+        requested = False
+        finished = asyncio.Event()
+        statuses = []
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+            elif not message.get('more_body'):
+                finished.set()
+
+        started = time.perf_counter()
+        await application(scope, receive, send)
+        return time.perf_counter() - started, statuses[0] in (200, 304)
+
+    async def main():
+        for path in paths:
+            await call(path)
+
+        async def worker(index):
+            return [await call(paths[(index + step) % len(paths)]) for step in range(index, requests, concurrency)]
+
+        started = time.perf_counter()
+        batches = await asyncio.gather(*(worker(index) for index in range(concurrency)))
+        return [result for batch in batches for result in batch], time.perf_counter() - started
+
+    results, elapsed = asyncio.run(main())
+    return _summary('asgi', [latency for latency, _ in results], sum(not ok for _, ok in results), elapsed)
+
+
+RUNNERS = {'wsgi': run_wsgi, 'asgi': run_asgi}
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare throughput and latency of the read-heavy API views under the WSGI application (sync views, '
+        'one thread per request) and the ASGI application (async views). Each deployment runs in its own '
+        'process against the configured database; fixtures are removed afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=32, help='Concurrent clients.')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per deployment.')
+        parser.add_argument('--books', type=int, default=200)
+        parser.add_argument('--deployment', choices=sorted(RUNNERS), help='Internal: run one deployment.')
+        parser.add_argument('--paths', help='Internal: JSON list of paths to request.')
+        parser.add_argument('--token', help='Internal: API token to send.')
+
+    def handle(self, *args, **options):
+        if options['deployment']:
+            runner = RUNNERS[options['deployment']]
+            paths = json.loads(options['paths'])
+            result = runner(paths, options['token'], options['concurrency'], options['requests'])
+            self.stdout.write(json.dumps(result))
+            return
+
+        self.cleanup()
+        try:
+            paths, token = self.setup_fixtures(options['books'])
+            results = [self.run_deployment(deployment, paths, token, options) for deployment in ('wsgi', 'asgi')]
+        finally:
+            self.cleanup()
+
+        self.stdout.write(
+            f'{options["requests"]} requests per deployment from {options["concurrency"]} clients over '
+            f'{len(paths)} endpoints'
+        )
+        self.stdout.write(f'{"deployment":<12}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result["deployment"]:<12}{result["throughput"]:>10.0f}{result["p50_ms"]:>10.2f}'
+                f'{result["p99_ms"]:>10.2f}{result["errors"]:>8}'
+            )
+
+    def setup_fixtures(self, count):
+        user = User.objects.create_user(username=f'{PREFIX}reader')
+        author = Author.objects.create(name=f'{PREFIX}author')
+        Book.objects.bulk_create(
+            Book(title=f'{PREFIX}{index}', summary='', summary_excerpt='', isbn=f'8{index:012d}',
+                 published_date='2000-01-01', publisher=PREFIX)
+            for index in range(count)
+        )
+        books = list(Book.objects.filter(publisher=PREFIX).order_by('pk'))
+        inventory.add_copies(book.pk for book in books)
+        Book.authors.through.objects.bulk_create(Book.authors.through(book=book, author=author) for book in books)
+        BorrowRequest.objects.bulk_create(BorrowRequest(book=book, borrower=user) for book in books[:20])
+        token = Token.objects.create(user=user).key
+        paths = [
+            '/api/library/',
+            '/api/library/?available=true',
+            '/api/authors/',
+            '/api/genres/',
+            f'/api/bookdetail/{books[0].pk}/',
+            '/api/borrow-history/',
+        ]
+        return paths, token
+
+    def run_deployment(self, deployment, paths, token, options):
+        command = [
+            sys.executable, sys.argv[0], 'bench_deployments', '--deployment', deployment,
+            '--paths', json.dumps(paths), '--token', token,
+            '--concurrency', str(options['concurrency']), '--requests', str(options['requests']),
+        ]
+        env = dict(os.environ, API_ASYNC_VIEWS='1' if deployment == 'asgi' else '0')
+        completed = subprocess.run(command, env=env, capture_output=True, text=True)
+        if completed.returncode:
+            raise CommandError(f'{deployment} run failed:\n{completed.stderr}')
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def cleanup(self):
+        BorrowRequest.objects.filter(borrower__username__startswith=PREFIX).delete()
+        Book.objects.filter(publisher=PREFIX).delete()
+        Author.objects.filter(name__startswith=PREFIX).delete()
+        User.objects.filter(username__startswith=PREFIX).delete()
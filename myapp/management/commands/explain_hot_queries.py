@@ -0,0 +1,144 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from myapp.models import Book, BorrowRequest
+
+# Indexes the hot-path migration replaced: the plain foreign key indexes.
+BASELINE_INDEXES = {
+    BorrowRequest: [
+        models.Index(fields=['book'], name='baseline_borrow_book_idx'),
+        models.Index(fields=['borrower'], name='baseline_borrow_borrower_idx'),
+    ],
+}
+TUNED_INDEXES = {
+    Book: ['book_available_idx'],
+    BorrowRequest: ['borrow_book_borrower_idx', 'borrow_history_idx', 'borrow_request_date_idx'],
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate a throwaway dataset and print EXPLAIN output and timings for the hot BorrowRequest and Book '
+        'queries with the tuned indexes and with the baseline foreign key indexes. Everything runs in one '
+        'transaction that is rolled back, so the database is left untouched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Borrow requests to generate.')
+        parser.add_argument('--books', type=int, default=None, help='Books to generate (default: rows / 10).')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20, help='Timed executions per query.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # SQLite only lets the schema editor run inside a transaction if foreign key checks were turned
+        # off before it started.
+        connection.disable_constraint_checking()
+        try:
+            with transaction.atomic():
+                self.generate(options)
+                self.report('tuned indexes', options['repeat'])
+                self.swap_to_baseline()
+                self.report('baseline indexes', options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            connection.enable_constraint_checking()
+
+    def generate(self, options):
+        rng = random.Random(options['seed'])
+        book_count = options['books'] or max(options['rows'] // 10, 1)
+        started = time.perf_counter()
+
+        User.objects.bulk_create(
+            (User(username=f'explain-{index}') for index in range(options['users'])), batch_size=5000,
+        )
+        self.user_ids = list(User.objects.filter(username__startswith='explain-').values_list('pk', flat=True))
+        Book.objects.bulk_create(
+            (
+                Book(title=f'Book {index}', summary='', isbn=f'8{index:012d}', published_date='2000-01-01',
+                     publisher='Explain', available_count=int(rng.random() < 0.7))
+                for index in range(book_count)
+            ),
+            batch_size=5000,
+        )
+        self.book_ids = list(Book.objects.filter(publisher='Explain').values_list('pk', flat=True))
+
+        now = timezone.now()
+        statuses = [status for status, _ in BorrowRequest.STATUS_CHOICES if status not in BorrowRequest.ACTIVE_LOAN_STATUSES]
+        BorrowRequest.objects.bulk_create(
+            (
+                BorrowRequest(
+                    book_id=rng.choice(self.book_ids),
+                    borrower_id=rng.choice(self.user_ids),
+                    status=rng.choice(statuses),
+                    request_date=now - timedelta(minutes=rng.randrange(5 * 365 * 24 * 60)),
+                )
+                for _ in range(options['rows'])
+            ),
+            batch_size=5000,
+        )
+        self.analyze()
+        self.stdout.write(
+            f'Generated {options["rows"]} borrow requests, {book_count} books and {options["users"]} users '
+            f'in {time.perf_counter() - started:.1f}s.'
+        )
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def swap_to_baseline(self):
+        with connection.schema_editor(atomic=False) as editor:
+            for model, names in TUNED_INDEXES.items():
+                for index in model._meta.indexes:
+                    if index.name in names:
+                        editor.remove_index(model, index)
+            for model, indexes in BASELINE_INDEXES.items():
+                for index in indexes:
+                    editor.add_index(model, index)
+        self.analyze()
+
+    def hot_queries(self):
+        book_id, user_id = self.book_ids[len(self.book_ids) // 2], self.user_ids[len(self.user_ids) // 2]
+        return {
+            'book detail: request by book and borrower': (
+                BorrowRequest.objects.filter(book_id=book_id, borrower_id=user_id).order_by('pk')[:1]
+            ),
+            'borrow: open request check': (
+                BorrowRequest.objects.filter(
+                    book_id=book_id, borrower_id=user_id, status__in=BorrowRequest.OPEN_STATUSES,
+                ).values('pk')[:1]
+            ),
+            'history: borrower page': (
+                BorrowRequest.objects.filter(borrower_id=user_id).order_by('-request_date', '-id')[:50]
+            ),
+            'history: staff page': BorrowRequest.objects.order_by('-request_date', '-id')[:50],
+            'catalogue: available books page': (
+                Book.objects.filter(available_count__gt=0).order_by('id').values('pk')[:50]
+            ),
+        }
+
+    def report(self, label, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {label} =='))
+        for name, queryset in self.hot_queries().items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            self.stdout.write(self.style.MIGRATE_LABEL(f'{name}: median {timings[len(timings) // 2] * 1000:.3f} ms'))
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f'    {line}')
@@ -0,0 +1,55 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.importers import MAX_ERRORS, READERS, import_catalogue
+
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.mrk': 'marc', '.marc': 'marc'}
+
+
+class Command(BaseCommand):
+    help = (
+        'Import books from a CSV, JSON Lines or MARC-like tagged file, upserting on ISBN. Authors and genres '
+        'are matched by name and created when missing. Use "-" to read from standard input.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(READERS), help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--max-errors', type=int, default=MAX_ERRORS,
+                            help='Skipped records to report by line; the rest are only counted.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or EXTENSIONS.get(os.path.splitext(path)[1].lower())
+        if file_format is None:
+            raise CommandError('Cannot tell the format from the file name; pass --format.')
+
+        if path == '-':
+            stats = self.run(sys.stdin, file_format, options)
+        else:
+            try:
+                with open(path, newline='', encoding='utf-8') as stream:
+                    stats = self.run(stream, file_format, options)
+            except OSError as exc:
+                raise CommandError(exc)
+
+        for line, message in stats.errors:
+            self.stderr.write(f'Line {line}: {message}')
+        if stats.errors_left_out:
+            self.stderr.write(f'... and {stats.errors_left_out} more errors.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {stats.created + stats.updated} books ({stats.created} created, {stats.updated} updated, '
+            f'{stats.skipped} skipped) at {stats.rate:.0f} rows/s.'
+        ))
+
+    def run(self, stream, file_format, options):
+        return import_catalogue(
+            READERS[file_format](stream), batch_size=options['batch_size'], progress=self.report,
+            max_errors=options['max_errors'],
+        )
+
+    def report(self, stats):
+        self.stdout.write(f'{stats.processed} rows read, {stats.rate:.0f} rows/s')
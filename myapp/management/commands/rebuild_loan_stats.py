@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from myapp.services import rebuild_loan_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-book borrow counts and per-user loan counters from the borrow requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        books, users = rebuild_loan_stats(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Corrected {books} book counts; rebuilt stats for {users} users.'))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from myapp import analytics
+
+
+class Command(BaseCommand):
+    help = 'Fold borrow requests approved or completed since the last run into the circulation rollups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=float, default=analytics.DEFAULT_LAG.total_seconds(),
+                            help='Seconds of the most recent history to leave for the next run.')
+        parser.add_argument('--window-days', type=int, default=analytics.DEFAULT_WINDOW.days,
+                            help='Days of history folded per transaction.')
+        parser.add_argument('--rebuild', action='store_true', help='Drop the rollups and start from scratch.')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            analytics.reset_circulation()
+        windows = analytics.rollup_circulation(
+            lag=timedelta(seconds=options['lag']), window=timedelta(days=options['window_days']),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {windows} windows; rollups are current up to {analytics.rolled_up_to()}.'
+        ))
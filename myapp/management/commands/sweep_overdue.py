@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from myapp.services import mark_overdue
+
+
+class Command(BaseCommand):
+    help = 'Flag collected loans that are past their due date as overdue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help='Keep sweeping until interrupted.')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between sweeps with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            flagged = mark_overdue(batch_size=options['batch_size'])
+            self.stdout.write(f'Flagged {flagged} overdue loans.')
+            if not options['loop']:
+                return
+            close_old_connections()
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.1 on 2026-10-17 05:49
+
+from django.db import migrations, models
+
+# Frozen copy of myapp.models.make_summary_excerpt as of this migration.
+SUMMARY_EXCERPT_WORDS = 30
+
+
+def make_summary_excerpt(summary):
+    words = summary.split()
+    if len(words) > SUMMARY_EXCERPT_WORDS:
+        return ' '.join(words[:SUMMARY_EXCERPT_WORDS]) + '...'
+    return summary
+
+
+def fill_summary_excerpts(apps, schema_editor):
+    Book = apps.get_model('myapp', 'Book')
+    batch = []
+    for book in Book.objects.only('id', 'summary').iterator(chunk_size=2000):
+        book.summary_excerpt = make_summary_excerpt(book.summary)
+        batch.append(book)
+        if len(batch) == 2000:
+            Book.objects.bulk_update(batch, ['summary_excerpt'])
+            batch = []
+    if batch:
+        Book.objects.bulk_update(batch, ['summary_excerpt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='summary_excerpt',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(fill_summary_excerpts, migrations.RunPython.noop),
+    ]
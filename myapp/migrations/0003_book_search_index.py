@@ -0,0 +1,85 @@
+# Generated by Django 5.1.1 on 2026-10-17 05:52
+
+import re
+from collections import Counter
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Frozen copies of the myapp.search constants and tokenizer as of this migration.
+FTS_TABLE = 'myapp_book_fts'
+FIELD_WEIGHTS = {'title': 10, 'summary': 1, 'authors': 5, 'genres': 3, 'publisher': 2}
+MAX_TERM_LENGTH = 64
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"title, summary, authors, genres, publisher, "
+            f"tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, summary, authors, genres, publisher) "
+            f"SELECT b.id, b.title, b.summary, "
+            f"(SELECT group_concat(a.name, ' ') FROM myapp_book_authors ba "
+            f"JOIN myapp_author a ON a.id = ba.author_id WHERE ba.book_id = b.id), "
+            f"(SELECT group_concat(g.name, ' ') FROM myapp_book_genres bg "
+            f"JOIN myapp_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), "
+            f"b.publisher FROM myapp_book b"
+        )
+        return
+
+    Book = apps.get_model('myapp', 'Book')
+    BookSearchTerm = apps.get_model('myapp', 'BookSearchTerm')
+    postings = []
+    for book in Book.objects.prefetch_related('authors', 'genres').iterator(chunk_size=500):
+        document = {
+            'title': book.title,
+            'summary': book.summary,
+            'authors': ' '.join(author.name for author in book.authors.all()),
+            'genres': ' '.join(genre.name for genre in book.genres.all()),
+            'publisher': book.publisher,
+        }
+        weights = Counter()
+        for field, text in document.items():
+            for token in tokenize(text):
+                weights[token] += FIELD_WEIGHTS[field]
+        postings.extend(BookSearchTerm(term=term, book_id=book.pk, weight=weight) for term, weight in weights.items())
+        if len(postings) >= 5000:
+            BookSearchTerm.objects.bulk_create(postings)
+            postings = []
+    BookSearchTerm.objects.bulk_create(postings)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0002_book_summary_excerpt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='myapp.book')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'book'], name='book_search_term_idx', opclasses=['varchar_pattern_ops', 'int8_ops'])],
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
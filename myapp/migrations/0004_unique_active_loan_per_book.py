@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-17 05:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_book_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='borrowrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', [2, 3])), fields=('book',), name='unique_active_loan_per_book'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_unique_active_loan_per_book'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='borrowrequest',
+            index=models.Index(condition=models.Q(('overdue', False), ('status', 3)), fields=['due_date'], name='borrow_overdue_sweep_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='borrowrequest',
+            index=models.Index(condition=models.Q(('overdue', True), ('status', 3)), fields=['due_date', 'id'], name='borrow_overdue_idx'),
+        ),
+    ]
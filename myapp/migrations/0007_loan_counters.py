@@ -0,0 +1,62 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery
+
+COLLECTED, COMPLETE, APPROVED = 3, 4, 2
+
+
+def fill_loan_counters(apps, schema_editor):
+    Book = apps.get_model('myapp', 'Book')
+    BorrowRequest = apps.get_model('myapp', 'BorrowRequest')
+    UserLoanStats = apps.get_model('myapp', 'UserLoanStats')
+
+    loans = (
+        BorrowRequest.objects.filter(book=OuterRef('pk'), status__in=[COLLECTED, COMPLETE])
+        .order_by().values('book').annotate(count=Count('pk')).values('count')
+    )
+    Book.objects.filter(borrow_requests__status__in=[COLLECTED, COMPLETE]).update(borrow_count=Subquery(loans))
+
+    totals = BorrowRequest.objects.order_by('borrower_id').values('borrower_id').annotate(
+        active_loans=Count('pk', filter=Q(status__in=[APPROVED, COLLECTED])),
+        loans=Count('pk', filter=Q(status__in=[COLLECTED, COMPLETE])),
+    )
+    UserLoanStats.objects.bulk_create(
+        (
+            UserLoanStats(user_id=row['borrower_id'], active_loans=row['active_loans'], loans=row['loans'])
+            for row in totals.iterator(chunk_size=2000)
+        ),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('myapp', '0006_hot_path_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserLoanStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='loan_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('active_loans', models.PositiveIntegerField(default=0)),
+                ('loans', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='borrow_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['-borrow_count', 'id'], name='book_popular_idx'),
+        ),
+        migrations.RunPython(fill_loan_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:24
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0007_loan_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('position', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CirculationRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('total', 'Total'), ('book', 'Book'), ('author', 'Author'), ('genre', 'Genre')], max_length=8)),
+                ('key_id', models.BigIntegerField()),
+                ('day', models.DateField()),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('loan_time', models.DurationField(default=datetime.timedelta)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'day', 'key_id'), name='unique_circulation_rollup')],
+            },
+        ),
+    ]
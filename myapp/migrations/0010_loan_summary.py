@@ -0,0 +1,67 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:48
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Q
+
+PENDING, APPROVED, COLLECTED, COMPLETE, DECLINED = 1, 2, 3, 4, 5
+STATUS_FIELDS = {PENDING: 'pending', APPROVED: 'approved', COLLECTED: 'collected', COMPLETE: 'complete',
+                 DECLINED: 'declined'}
+
+
+def fill_loan_summaries(apps, schema_editor):
+    BorrowRequest = apps.get_model('myapp', 'BorrowRequest')
+    UserLoanStats = apps.get_model('myapp', 'UserLoanStats')
+
+    active = Q(status__in=[APPROVED, COLLECTED])
+    totals = BorrowRequest.objects.order_by('borrower_id').values('borrower_id').annotate(
+        active_loans=Count('pk', filter=active),
+        loans=Count('pk', filter=Q(status__in=[COLLECTED, COMPLETE])),
+        next_due_date=Min('due_date', filter=active),
+        **{field: Count('pk', filter=Q(status=status)) for status, field in STATUS_FIELDS.items()},
+    )
+    UserLoanStats.objects.all().delete()
+    UserLoanStats.objects.bulk_create(
+        (UserLoanStats(user_id=row.pop('borrower_id'), **row) for row in totals.iterator(chunk_size=2000)),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0009_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userloanstats',
+            name='approved',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userloanstats',
+            name='collected',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userloanstats',
+            name='complete',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userloanstats',
+            name='declined',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userloanstats',
+            name='next_due_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userloanstats',
+            name='pending',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_loan_summaries, migrations.RunPython.noop),
+    ]
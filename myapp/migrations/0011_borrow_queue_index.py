@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-17 07:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0010_loan_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='borrowrequest',
+            index=models.Index(fields=['status', 'request_date', 'id'], name='borrow_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.1.1 on 2026-10-17 07:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+PENDING, APPROVED, COLLECTED = 1, 2, 3
+AVAILABLE, RESERVED, ON_LOAN, WITHDRAWN = 1, 2, 3, 4
+
+
+def create_copies(apps, schema_editor):
+    """Give every book the one copy it stood for, held by the open request that held the book, if any."""
+    Book = apps.get_model('myapp', 'Book')
+    BorrowRequest = apps.get_model('myapp', 'BorrowRequest')
+    Copy = apps.get_model('myapp', 'Copy')
+
+    # A collected loan holds the book over an approval, and an approval over a pending request.
+    holders = {}
+    open_requests = BorrowRequest.objects.filter(status__in=[PENDING, APPROVED, COLLECTED]).order_by('-status', 'pk')
+    for pk, book_id, status in open_requests.values_list('pk', 'book_id', 'status').iterator(chunk_size=2000):
+        holders.setdefault(book_id, (pk, status))
+
+    def status(book_id, available):
+        if book_id in holders:
+            return ON_LOAN if holders[book_id][1] == COLLECTED else RESERVED
+        # A book marked unavailable with no request holding it was taken off the shelf.
+        return AVAILABLE if available else WITHDRAWN
+
+    Copy.objects.bulk_create(
+        (
+            Copy(book_id=book_id, status=status(book_id, available))
+            for book_id, available in Book.objects.values_list('pk', 'available').iterator(chunk_size=2000)
+        ),
+        batch_size=2000,
+    )
+
+    holder_ids = [pk for pk, _ in holders.values()]
+    copy = Subquery(Copy.objects.filter(book=OuterRef('book')).values('pk')[:1])
+    for start in range(0, len(holder_ids), 2000):
+        BorrowRequest.objects.filter(pk__in=holder_ids[start:start + 2000]).update(copy=copy)
+
+    available = (
+        Copy.objects.filter(book=OuterRef('pk'), status=AVAILABLE)
+        .order_by().values('book').annotate(count=Count('pk')).values('count')
+    )
+    Book.objects.update(available_count=Coalesce(Subquery(available), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0011_borrow_queue_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Copy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(1, 'Available'), (2, 'Reserved'), (3, 'On loan'), (4, 'Withdrawn')], default=1)),
+                ('book', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='copies', to='myapp.book')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['book', 'status'], name='copy_book_status_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='borrowrequest',
+            name='copy',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='borrow_requests', to='myapp.copy'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='available_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(create_copies, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name='borrowrequest',
+            name='unique_active_loan_per_book',
+        ),
+        migrations.AddConstraint(
+            model_name='borrowrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', [1, 2, 3])), fields=('copy',), name='unique_open_request_per_copy'),
+        ),
+        migrations.RemoveIndex(
+            model_name='book',
+            name='book_available_idx',
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('available_count__gt', 0)), fields=['id'], name='book_available_idx'),
+        ),
+        migrations.RemoveField(
+            model_name='book',
+            name='available',
+        ),
+        migrations.RemoveField(
+            model_name='book',
+            name='borrower',
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.1 on 2026-10-17 07:59
+
+from django.db import migrations, models
+from django.db.models import Count
+
+STATUSES = (1, 2, 3, 4, 5)
+STRIPES = 16
+
+
+def fill_status_counts(apps, schema_editor):
+    """Create every status's stripes, with the current totals in the first."""
+    BorrowRequest = apps.get_model('myapp', 'BorrowRequest')
+    BorrowStatusCount = apps.get_model('myapp', 'BorrowStatusCount')
+
+    totals = dict(BorrowRequest.objects.order_by().values('status').annotate(count=Count('pk'))
+                  .values_list('status', 'count'))
+    BorrowStatusCount.objects.all().delete()
+    BorrowStatusCount.objects.bulk_create(
+        BorrowStatusCount(status=status, stripe=stripe, count=totals.get(status, 0) if stripe == 0 else 0)
+        for status in STATUSES for stripe in range(STRIPES)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0013_holds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BorrowStatusCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(1, 'Pending'), (2, 'Approved'), (3, 'Collected'), (4, 'Complete'), (5, 'Declined')])),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('status', 'stripe'), name='unique_borrow_status_stripe')],
+            },
+        ),
+        migrations.RunPython(fill_status_counts, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -18,20 +20,124 @@ class Genre(models.Model):
         return self.name
 
 
+SUMMARY_EXCERPT_WORDS = 30
+
+
+def make_summary_excerpt(summary):
+    words = summary.split()
+    if len(words) > SUMMARY_EXCERPT_WORDS:
+        return ' '.join(words[:SUMMARY_EXCERPT_WORDS]) + '...'
+    return summary
+
+
+class TimestampedQuerySet(models.QuerySet):
+    """Keeps ``updated_at`` current for queryset updates, which bypass ``auto_now``."""
+
+    def update(self, **kwargs):
+        kwargs.setdefault('updated_at', timezone.now())
+        return super().update(**kwargs)
+
+    def touch(self):
+        return self.update()
+
+
+class BookQuerySet(TimestampedQuerySet):
+    LISTING_FIELDS = (
+        'id', 'title', 'summary', 'summary_excerpt', 'isbn', 'available_count', 'published_date', 'publisher',
+        'borrow_count', 'updated_at',
+    )
+
+    def for_listing(self):
+        return self.only(*self.LISTING_FIELDS).prefetch_related(
+            models.Prefetch('authors', queryset=Author.objects.only('id', 'name')),
+            models.Prefetch('genres', queryset=Genre.objects.only('id', 'name')),
+        )
+
+
 class Book(models.Model):
     title = models.CharField(max_length=255)
     summary = models.TextField()
+    summary_excerpt = models.TextField(blank=True, editable=False)
     isbn = models.CharField(max_length=13, unique=True)
-    available = models.BooleanField(default=True)
+    # Number of copies on the shelf; kept in step with ``Copy.status`` by myapp.inventory.
+    available_count = models.PositiveIntegerField(default=0, editable=False)
     published_date = models.DateField()
     publisher = models.CharField(max_length=255)
     genres = models.ManyToManyField(Genre, related_name='books', blank=True)
     authors = models.ManyToManyField(Author, related_name='books')
-    borrower = models.OneToOneField(User, on_delete=models.SET_NULL, null=True, blank=True)
+    # Number of times the book was collected; kept in step by myapp.services.
+    borrow_count = models.PositiveIntegerField(default=0, editable=False)
+    # Version marker for conditional requests; also moved by queryset updates and relation changes.
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(available_count__gt=0), name='book_available_idx'),
+            models.Index(fields=['-borrow_count', 'id'], name='book_popular_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @property
+    def available(self):
+        return self.available_count > 0
+
+    @property
+    def availability_status(self):
+        return 'Available' if self.available else 'Not Available'
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if 'summary' not in self.get_deferred_fields():
+            self.summary_excerpt = make_summary_excerpt(self.summary)
+            if update_fields is not None and 'summary' in update_fields:
+                update_fields = {*update_fields, 'summary_excerpt'}
+        if update_fields:
+            kwargs['update_fields'] = {*update_fields, 'updated_at'}
+        super().save(*args, **kwargs)
+
+
+class Copy(models.Model):
+    """One physical copy of a book. Borrow requests hold a copy from the moment they are made until it is back."""
+    AVAILABLE = 1
+    RESERVED = 2
+    ON_LOAN = 3
+    WITHDRAWN = 4
+
+    STATUS_CHOICES = (
+        (AVAILABLE, 'Available'),
+        (RESERVED, 'Reserved'),
+        (ON_LOAN, 'On loan'),
+        (WITHDRAWN, 'Withdrawn'),
+    )
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='copies', db_index=False)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=AVAILABLE)
+
+    class Meta:
+        indexes = [
+            # Free copies of a book, looked up whenever one is claimed.
+            models.Index(fields=['book', 'status'], name='copy_book_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.book} #{self.pk} ({self.get_status_display()})"
+
+
+class BookSearchTerm(models.Model):
+    """Inverted-index posting used by catalogue search on databases without a native full-text engine."""
+    term = models.CharField(max_length=64)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='search_terms')
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'book'], name='book_search_term_idx', opclasses=['varchar_pattern_ops', 'int8_ops']),
+        ]
+
 
 class BorrowRequest(models.Model):
     PENDING = 1
@@ -48,14 +154,170 @@ class BorrowRequest(models.Model):
         (DECLINED, 'Declined'),
     )
 
-    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='borrow_requests')
-    borrower = models.ForeignKey(User, on_delete=models.CASCADE, related_name='borrow_requests')
+    OPEN_STATUSES = (PENDING, APPROVED, COLLECTED)
+    ACTIVE_LOAN_STATUSES = (APPROVED, COLLECTED)
+    # Requests whose book was handed to the borrower at some point.
+    LOAN_STATUSES = (COLLECTED, COMPLETE)
+
+    # action -> (required status, resulting status, error when the request is in any other status)
+    TRANSITIONS = {
+        'approve': (PENDING, APPROVED, 'Only pending requests can be approved.'),
+        'decline': (PENDING, DECLINED, 'Only pending requests can be declined.'),
+        'collect': (APPROVED, COLLECTED, 'Only approved requests can be collected.'),
+        'complete': (COLLECTED, COMPLETE, 'Only collected requests can be completed.'),
+    }
+
+    # Both foreign keys lead the composite indexes below, which serve their lookups as well.
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='borrow_requests', db_index=False)
+    borrower = models.ForeignKey(User, on_delete=models.CASCADE, related_name='borrow_requests', db_index=False)
+    # The copy held for the request while it is open; kept afterwards as a record of which copy was lent.
+    copy = models.ForeignKey(Copy, on_delete=models.SET_NULL, null=True, blank=True, related_name='borrow_requests')
     status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
     overdue = models.BooleanField(default=False)
     request_date = models.DateTimeField(default=timezone.now)
     approval_date = models.DateTimeField(null=True, blank=True)
     due_date = models.DateTimeField(null=True, blank=True)
     complete_date = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = TimestampedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # A copy is held by one open (pending, approved or collected) request at a time.
+            models.UniqueConstraint(
+                fields=['copy'], condition=models.Q(status__in=[1, 2, 3]), name='unique_open_request_per_copy',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['book', 'borrower', 'status'], name='borrow_book_borrower_idx'),
+            models.Index(fields=['borrower', '-request_date', '-id'], name='borrow_history_idx'),
+            models.Index(fields=['-request_date', '-id'], name='borrow_request_date_idx'),
+            # The librarian queue: requests in a few statuses, oldest first.
+            models.Index(fields=['status', 'request_date', 'id'], name='borrow_queue_idx'),
+            # Collected loans (status 3) the overdue sweeper still has to look at, and the ones it flagged.
+            models.Index(fields=['due_date'], condition=models.Q(status=3, overdue=False),
+                         name='borrow_overdue_sweep_idx'),
+            models.Index(fields=['due_date', 'id'], condition=models.Q(status=3, overdue=True),
+                         name='borrow_overdue_idx'),
+        ]
 
     def __str__(self):
         return f"{self.borrower} - {self.book.title} (Status: {self.get_status_display()})"
+
+    @property
+    def allowed_actions(self):
+        return [action for action, (source, _, _) in self.TRANSITIONS.items() if source == self.status]
+
+
+class Hold(models.Model):
+    """A user waiting for a copy of a book. Holds are served first come, first served, in ``id`` order."""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='holds', db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='holds', db_index=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            # Also serves the lookups of a user's holds.
+            models.UniqueConstraint(fields=['user', 'book'], name='unique_hold_per_user'),
+        ]
+        indexes = [
+            # The queue of a book, next in line first; also serves positions and the book foreign key.
+            models.Index(fields=['book', 'id'], name='hold_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} waiting for {self.book}"
+
+
+class UserLoanStats(models.Model):
+    """
+    Per-user borrow history summary kept in step by ``myapp.history``; ``rebuild_loan_stats`` recomputes it.
+    """
+    # BorrowRequest status -> the field counting the user's requests in it.
+    STATUS_FIELDS = {
+        BorrowRequest.PENDING: 'pending',
+        BorrowRequest.APPROVED: 'approved',
+        BorrowRequest.COLLECTED: 'collected',
+        BorrowRequest.COMPLETE: 'complete',
+        BorrowRequest.DECLINED: 'declined',
+    }
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='loan_stats')
+    active_loans = models.PositiveIntegerField(default=0)
+    loans = models.PositiveIntegerField(default=0)
+    pending = models.PositiveIntegerField(default=0)
+    approved = models.PositiveIntegerField(default=0)
+    collected = models.PositiveIntegerField(default=0)
+    complete = models.PositiveIntegerField(default=0)
+    declined = models.PositiveIntegerField(default=0)
+    # Earliest due date among the user's approved and collected loans.
+    next_due_date = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user} ({self.active_loans} active, {self.loans} total)"
+
+
+class BorrowStatusCount(models.Model):
+    """
+    Number of borrow requests in each status, kept in step by ``myapp.history``. Every status is spread over
+    ``STRIPES`` rows and each change writes one of them picked at random, so concurrent changes rarely wait for
+    the same row; a status's count is the sum of its stripes, any one of which may be negative.
+    """
+    STRIPES = 16
+
+    status = models.IntegerField(choices=BorrowRequest.STATUS_CHOICES)
+    stripe = models.PositiveSmallIntegerField()
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['status', 'stripe'], name='unique_borrow_status_stripe'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_status_display()} #{self.stripe}: {self.count}"
+
+
+class CirculationRollup(models.Model):
+    """
+    Circulation totals for one day and one book, author, genre or the whole library, filled incrementally by
+    ``myapp.analytics.rollup_circulation``. Loans count on their approval day and completed loans, with
+    their total duration, on their completion day.
+    """
+    TOTAL = 'total'
+    BOOK = 'book'
+    AUTHOR = 'author'
+    GENRE = 'genre'
+
+    DIMENSION_CHOICES = (
+        (TOTAL, 'Total'),
+        (BOOK, 'Book'),
+        (AUTHOR, 'Author'),
+        (GENRE, 'Genre'),
+    )
+
+    dimension = models.CharField(max_length=8, choices=DIMENSION_CHOICES)
+    # Id of the book, author or genre; 0 for the library total. Not a foreign key so history survives deletes.
+    key_id = models.BigIntegerField()
+    day = models.DateField()
+    loans = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    loan_time = models.DurationField(default=timedelta)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'day', 'key_id'], name='unique_circulation_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.dimension} {self.key_id} on {self.day}"
+
+
+class RollupWatermark(models.Model):
+    """How far ``name``'s rollups have read the borrow history."""
+    name = models.CharField(max_length=64, unique=True)
+    position = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} up to {self.position}"
@@ -0,0 +1,148 @@
+"""
+Full-text catalogue search over book titles, summaries, publishers and author and genre names.
+
+SQLite databases keep an FTS5 table in step with ``Book``; other databases fall back to the
+``BookSearchTerm`` inverted index. Both are maintained incrementally by the receivers in
+``myapp.signals`` and can be rebuilt with ``manage.py rebuild_search_index``.
+"""
+import re
+from collections import Counter
+
+from django.db import connection
+from django.db.models import Case, Max, Prefetch, Q, Sum, Value, When
+
+from .models import Author, Book, BookSearchTerm, Genre
+
+FTS_TABLE = 'myapp_book_fts'
+SEARCH_FIELDS = ('title', 'summary', 'authors', 'genres', 'publisher')
+FIELD_WEIGHTS = {'title': 10, 'summary': 1, 'authors': 5, 'genres': 3, 'publisher': 2}
+INDEX_BATCH_SIZE = 500
+MAX_TERM_LENGTH = 64
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in _TOKEN_RE.findall(text.lower())]
+
+
+def _batches(items, size=INDEX_BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _documents(book_ids):
+    books = Book.objects.filter(pk__in=book_ids).only('id', 'title', 'summary', 'publisher').prefetch_related(
+        Prefetch('authors', queryset=Author.objects.only('id', 'name')),
+        Prefetch('genres', queryset=Genre.objects.only('id', 'name')),
+    )
+    for book in books:
+        yield book.pk, {
+            'title': book.title,
+            'summary': book.summary,
+            'authors': ' '.join(author.name for author in book.authors.all()),
+            'genres': ' '.join(genre.name for genre in book.genres.all()),
+            'publisher': book.publisher,
+        }
+
+
+class FTS5Backend:
+    def remove(self, book_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(book_id,) for book_id in book_ids])
+
+    def index(self, book_ids):
+        for batch in _batches(book_ids):
+            rows = [
+                (book_id, *(document[field] for field in SEARCH_FIELDS))
+                for book_id, document in _documents(batch)
+            ]
+            self.remove(batch)
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f'INSERT INTO {FTS_TABLE} (rowid, {", ".join(SEARCH_FIELDS)}) VALUES (%s, %s, %s, %s, %s, %s)',
+                    rows,
+                )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    def search(self, tokens, limit, offset):
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        weights = ', '.join(str(float(FIELD_WEIGHTS[field])) for field in SEARCH_FIELDS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'ORDER BY bm25({FTS_TABLE}, {weights}), rowid LIMIT %s OFFSET %s',
+                [match, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndexBackend:
+    def remove(self, book_ids):
+        for batch in _batches(book_ids):
+            BookSearchTerm.objects.filter(book_id__in=batch).delete()
+
+    def index(self, book_ids):
+        for batch in _batches(book_ids):
+            postings = []
+            for book_id, document in _documents(batch):
+                weights = Counter()
+                for field, text in document.items():
+                    for token in tokenize(text):
+                        weights[token] += FIELD_WEIGHTS[field]
+                postings.extend(
+                    BookSearchTerm(term=term, book_id=book_id, weight=weight) for term, weight in weights.items()
+                )
+            self.remove(batch)
+            BookSearchTerm.objects.bulk_create(postings, batch_size=2000)
+
+    def clear(self):
+        BookSearchTerm.objects.all().delete()
+
+    def search(self, tokens, limit, offset):
+        prefixes = Q()
+        for token in tokens:
+            prefixes |= Q(term__startswith=token)
+        matched = {
+            f'matched_{position}': Max(Case(When(term__startswith=token, then=Value(1)), default=Value(0)))
+            for position, token in enumerate(tokens)
+        }
+        hits = (
+            BookSearchTerm.objects.filter(prefixes)
+            .values('book_id')
+            .annotate(score=Sum('weight'), **matched)
+            .filter(**{name: 1 for name in matched})
+            .order_by('-score', 'book_id')
+            .values_list('book_id', flat=True)
+        )
+        return list(hits[offset:offset + limit])
+
+
+def get_backend():
+    return FTS5Backend() if connection.vendor == 'sqlite' else InvertedIndexBackend()
+
+
+def index_books(book_ids):
+    get_backend().index(book_ids)
+
+
+def remove_books(book_ids):
+    get_backend().remove(book_ids)
+
+
+def rebuild_index():
+    backend = get_backend()
+    backend.clear()
+    backend.index(Book.objects.order_by('pk').values_list('pk', flat=True))
+
+
+def search_books(query, limit, offset=0):
+    """Return the ids of books matching every word of ``query`` as a prefix, best match first."""
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens:
+        return []
+    return get_backend().search(tokens, limit, offset)
@@ -0,0 +1,418 @@
+"""
+Borrow workflow transitions.
+
+Every transition runs in one transaction. A request holds one ``Copy`` of its book from the moment it is made
+until the copy is back; copies are claimed with a conditional UPDATE of a single free copy (see
+``myapp.inventory``) and the ``unique_open_request_per_copy`` constraint backs that up, so concurrent requests
+never get the same copy while requests for other copies, or other books, do not wait on each other.
+The status rules themselves live in ``BorrowRequest.TRANSITIONS``; ``bulk_transition`` is the only code
+that applies them, and it keeps ``Book.borrow_count`` and the ``myapp.history`` summaries in step as it goes.
+
+Users who find every copy out can join the book's hold queue with ``borrow_or_hold``. Whenever copies come
+back, ``promote_holds`` turns the first holds in line into pending requests in the same transaction, or once the
+delete commits for copies freed by deleting a request. While anyone is queued, nobody else claims a copy.
+"""
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import BigIntegerField, Case, Count, DateTimeField, Exists, F, Min, OuterRef, Q, Subquery, \
+    Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import history, inventory
+from .models import Book, BorrowRequest, Copy, Hold, UserLoanStats
+from .signals import books_changed, borrow_requests_changed
+
+
+class BorrowError(Exception):
+    default_message = 'The borrow request cannot be processed.'
+
+    def __init__(self, message=None):
+        super().__init__(message or self.default_message)
+
+
+class BookUnavailable(BorrowError):
+    default_message = 'Book is not available right now.'
+
+
+class DuplicateBorrowRequest(BorrowError):
+    default_message = 'You already have a pending or approved request for this book.'
+
+
+class InvalidTransition(BorrowError):
+    default_message = 'The borrow request is not in a state that allows this action.'
+
+
+# action -> the status its requests' copies move to
+COPY_STATUSES = {
+    'collect': Copy.ON_LOAN,
+    'complete': Copy.AVAILABLE,
+    'decline': Copy.AVAILABLE,
+}
+
+
+def _announce(changes):
+    """Send ``borrow_requests_changed`` for ``changes`` once the current transaction commits."""
+    if changes:
+        transaction.on_commit(partial(borrow_requests_changed.send, sender=BorrowRequest, changes=changes))
+
+
+def _add_counts(model, key, counts, field):
+    """Add ``counts[value]`` to ``field`` of the row whose ``key`` equals ``value``, for all rows in one UPDATE."""
+    delta = Case(*(When(**{key: value}, then=Value(count)) for value, count in counts.items()), default=Value(0))
+    model.objects.filter(**{f'{key}__in': list(counts)}).update(**{field: Greatest(F(field) + delta, Value(0))})
+
+
+def _count_loans(action, entries):
+    source, target, _ = BorrowRequest.TRANSITIONS[action]
+    if action == 'collect':
+        _add_counts(Book, 'pk', Counter(borrow_request.book_id for _, borrow_request, _ in entries), 'borrow_count')
+    history.record([(borrow_request.borrower_id, source, target) for _, borrow_request, _ in entries])
+
+
+def _borrow(book, user):
+    """
+    Create a pending request for ``book`` holding one of its free copies; ``None`` if they are all taken or other
+    users are queued for them.
+    """
+    if BorrowRequest.objects.filter(book=book, borrower=user, status__in=BorrowRequest.OPEN_STATUSES).exists():
+        raise DuplicateBorrowRequest()
+    # Free copies belong to the hold queue first; only its head may claim one directly.
+    first_in_line = Hold.objects.filter(book=book).order_by('pk').values_list('user_id', flat=True).first()
+    if first_in_line not in (None, user.pk):
+        return None
+    copy_id = inventory.claim_copy(book.pk)
+    if copy_id is None:
+        return None
+    borrow_request = BorrowRequest.objects.create(
+        book=book, borrower=user, copy_id=copy_id, status=BorrowRequest.PENDING, request_date=timezone.now(),
+    )
+    if first_in_line == user.pk:
+        # Served from the head of the queue, so the user no longer waits.
+        Hold.objects.filter(book=book, user=user).delete()
+    books_changed.send(sender=Book, book_ids=[book.pk])
+    _announce([(borrow_request.pk, user.pk, book.pk, borrow_request.status)])
+    if 'available_count' not in book.get_deferred_fields():
+        book.available_count = max(book.available_count - 1, 0)
+    return borrow_request
+
+
+def request_borrow(book, user):
+    """Create a pending request for ``book`` holding one of its free copies, unless they are all taken."""
+    with transaction.atomic():
+        borrow_request = _borrow(book, user)
+        if borrow_request is None:
+            raise BookUnavailable()
+    return borrow_request
+
+
+def borrow_or_hold(book, user):
+    """
+    Like ``request_borrow``, but a user who finds every copy out joins the book's hold queue instead, or keeps
+    their place in it. Returns ``(borrow_request, None)`` or ``(None, hold)``.
+    """
+    with transaction.atomic():
+        borrow_request = _borrow(book, user)
+        if borrow_request is not None:
+            return borrow_request, None
+        hold, _ = Hold.objects.get_or_create(book=book, user=user)
+        # A copy may have come back since the claim above with nobody queued to take it; serve the queue now.
+        for borrow_request_id, borrower_id, _, _ in promote_holds([book.pk]):
+            if borrower_id == user.pk:
+                return BorrowRequest.objects.get(pk=borrow_request_id), None
+    return None, hold
+
+
+def delete_request(borrow_request):
+    """Delete ``borrow_request``; the copy an open request held goes to the first hold in line straight away."""
+    with transaction.atomic():
+        borrow_request.delete()
+        promote_holds([borrow_request.book_id])
+
+
+def hold_position(hold):
+    """The 1-based place of ``hold`` in its book's queue, counted along ``hold_queue_idx``."""
+    return Hold.objects.filter(book_id=hold.book_id, pk__lte=hold.pk).count()
+
+
+def promote_holds(book_ids):
+    """
+    Turn the first holds in line for ``book_ids`` into pending requests, one for each free copy, and drop them
+    from the queue. Returns the new requests as ``(borrow_request_id, borrower_id, book_id, status)`` tuples.
+    """
+    # Holds of users who got a copy some other way since they queued would give them a second one.
+    Hold.objects.filter(book_id__in=book_ids).filter(
+        Exists(BorrowRequest.objects.filter(
+            book=OuterRef('book'), borrower=OuterRef('user'), status__in=BorrowRequest.OPEN_STATUSES,
+        ))
+    ).delete()
+    # Counted from the copies: available_count only catches up once this transaction commits.
+    waiting = Hold.objects.filter(book_id__in=book_ids).order_by().values_list('book_id', flat=True).distinct()
+    free = inventory.free_copies(waiting)
+    holds = []
+    for book_id, count in free.items():
+        # The head of the queue, read straight off hold_queue_idx.
+        queue = Hold.objects.filter(book_id=book_id).order_by('pk')
+        holds.extend(queue.values_list('pk', 'book_id', 'user_id')[:count])
+    if not holds:
+        return []
+
+    copy_ids = inventory.claim_copies(book_id for _, book_id, _ in holds)
+    served = [hold + (copy_id,) for hold, copy_id in zip(holds, copy_ids) if copy_id is not None]
+    now = timezone.now()
+    BorrowRequest.objects.bulk_create(
+        BorrowRequest(book_id=book_id, borrower_id=user_id, copy_id=copy_id, status=BorrowRequest.PENDING,
+                      request_date=now)
+        for _, book_id, user_id, copy_id in served
+    )
+    # bulk_create does not send post_save, which counts new requests everywhere else.
+    history.record([(user_id, None, BorrowRequest.PENDING) for _, _, user_id, _ in served])
+    Hold.objects.filter(pk__in=[hold_id for hold_id, _, _, _ in served]).delete()
+    # Read the ids back rather than relying on bulk_create returning them, which not every backend does.
+    promoted = list(
+        BorrowRequest.objects.filter(copy_id__in=[copy_id for _, _, _, copy_id in served], status=BorrowRequest.PENDING)
+        .values_list('pk', 'borrower_id', 'book_id', 'status')
+    )
+    books_changed.send(sender=Book, book_ids=list({book_id for _, book_id, _, _ in served}))
+    _announce(promoted)
+    return promoted
+
+
+# Transitions that free a book run before the ones that take one, so a batch may hand a returned book on.
+APPLY_ORDER = ('decline', 'complete', 'collect', 'approve')
+
+
+def _parse_due_date(value):
+    if value in (None, ''):
+        return None
+    due_date = BorrowRequest._meta.get_field('due_date').to_python(value)
+    if timezone.is_naive(due_date):
+        due_date = timezone.make_aware(due_date)
+    return due_date
+
+
+def _due_date_expression(entries):
+    whens = [When(pk=borrow_request.pk, then=Value(due_date)) for _, borrow_request, due_date in entries if due_date]
+    if not whens:
+        return None
+    return Case(*whens, default=None, output_field=DateTimeField())
+
+
+def _reject(result, code, message):
+    result.update(ok=False, code=code, error=message)
+
+
+def _claim_copies(entries):
+    """
+    Claim a copy for every entry that does not hold one yet, rejecting those whose book has none free. Returns
+    the entries left and the ``copy`` expression to save the claimed copies with, if any were claimed.
+    """
+    without = [entry for entry in entries if entry[1].copy_id is None]
+    copy_ids = inventory.claim_copies(borrow_request.book_id for _, borrow_request, _ in without)
+    claimed = {}
+    for (result, borrow_request, _), copy_id in zip(without, copy_ids):
+        if copy_id is None:
+            _reject(result, 'unavailable', 'The book is not available.')
+        else:
+            borrow_request.copy_id = claimed[borrow_request.pk] = copy_id
+    holding = [entry for entry in entries if entry[1].copy_id is not None]
+    if not claimed:
+        return holding, None
+    whens = [When(pk=pk, then=Value(copy_id)) for pk, copy_id in claimed.items()]
+    return holding, Case(*whens, default=F('copy'), output_field=BigIntegerField())
+
+
+def _update(entries, changes):
+    """Apply ``changes`` to every entry in one UPDATE, falling back to row by row if a loan conflicts."""
+    ids = [borrow_request.pk for _, borrow_request, _ in entries]
+    try:
+        with transaction.atomic():
+            BorrowRequest.objects.filter(pk__in=ids).update(**changes)
+        return entries
+    except IntegrityError:
+        pass
+
+    applied = []
+    for entry in entries:
+        result, borrow_request, due_date = entry
+        row_changes = dict(changes, due_date=due_date) if 'due_date' in changes else changes
+        try:
+            with transaction.atomic():
+                BorrowRequest.objects.filter(pk=borrow_request.pk).update(**row_changes)
+            applied.append(entry)
+        except IntegrityError:
+            _reject(result, 'unavailable', 'The book is not available.')
+    return applied
+
+
+def bulk_transition(items):
+    """
+    Apply many status transitions in one transaction using a few set-based UPDATEs.
+
+    ``items`` are dicts with ``id``, ``action`` and, for approvals, an optional ``due_date``. Returns one
+    result per item, in order, with ``ok`` set and ``code``/``error`` describing any rejection. Rejected
+    items do not prevent the others from being applied.
+    """
+    items = list(items)
+    results = [{'id': item['id'], 'action': item['action'], 'ok': False} for item in items]
+    now = timezone.now()
+
+    with transaction.atomic():
+        borrow_requests = BorrowRequest.objects.select_for_update().only(
+            'id', 'book_id', 'borrower_id', 'copy_id', 'status',
+        ).in_bulk(
+            {item['id'] for item in items}
+        )
+        accepted = defaultdict(list)
+        changed = []
+        seen = set()
+        for result, item in zip(results, items):
+            rule = BorrowRequest.TRANSITIONS.get(item['action'])
+            borrow_request = borrow_requests.get(item['id'])
+            if rule is None:
+                _reject(result, 'unknown_action', 'Unknown action.')
+            elif borrow_request is None:
+                _reject(result, 'not_found', 'Borrow request not found.')
+            elif borrow_request.pk in seen:
+                _reject(result, 'duplicate', 'Borrow request is listed more than once.')
+            elif borrow_request.status != rule[0]:
+                _reject(result, 'invalid_status', rule[2])
+            else:
+                try:
+                    due_date = _parse_due_date(item.get('due_date')) if item['action'] == 'approve' else None
+                except ValidationError:
+                    _reject(result, 'invalid_due_date', 'Due date has wrong format.')
+                    continue
+                seen.add(borrow_request.pk)
+                accepted[item['action']].append((result, borrow_request, due_date))
+
+        for action in APPLY_ORDER:
+            entries = accepted[action]
+            changes = {'status': BorrowRequest.TRANSITIONS[action][1]}
+            if action == 'approve':
+                # Requests made through request_borrow already hold a copy; others take one that is free now.
+                entries, copies = _claim_copies(entries)
+                changes.update(approval_date=now, due_date=_due_date_expression(entries))
+                if copies is not None:
+                    changes['copy'] = copies
+            if not entries:
+                continue
+            if action == 'complete':
+                changes['complete_date'] = now
+            entries = _update(entries, changes)
+            if not entries:
+                continue
+
+            _count_loans(action, entries)
+            book_ids = list({borrow_request.book_id for _, borrow_request, _ in entries})
+            if action in COPY_STATUSES:
+                inventory.move_copies(
+                    [(borrow_request.copy_id, borrow_request.book_id) for _, borrow_request, _ in entries],
+                    COPY_STATUSES[action],
+                )
+            books_changed.send(sender=Book, book_ids=book_ids)
+            if COPY_STATUSES.get(action) == Copy.AVAILABLE:
+                # Returned copies go to the holds first in line, ahead of any approvals later in the batch.
+                promote_holds(book_ids)
+            for result, borrow_request, _ in entries:
+                result['ok'] = True
+                changed.append(
+                    (borrow_request.pk, borrow_request.borrower_id, borrow_request.book_id, changes['status'])
+                )
+        _announce(changed)
+
+    return results
+
+
+def transition(borrow_request, action, due_date=None):
+    """Apply a single transition to ``borrow_request``, raising ``BorrowError`` if it is not allowed."""
+    result, = bulk_transition([{'id': borrow_request.pk, 'action': action, 'due_date': due_date}])
+    if not result['ok']:
+        error_class = BookUnavailable if result['code'] == 'unavailable' else InvalidTransition
+        raise error_class(result['error'])
+    borrow_request.refresh_from_db()
+    return borrow_request
+
+
+def set_copies(book, count):
+    """
+    Keep ``count`` copies of ``book`` in circulation, adding new ones or withdrawing free ones. Copies out on
+    loan are never withdrawn, so fewer may be taken away than asked; returns the number now in circulation.
+    """
+    with transaction.atomic():
+        current = inventory.in_circulation(book.pk)
+        if count > current:
+            inventory.add_copies([book.pk], count - current)
+            current = count
+        elif count < current:
+            current -= inventory.withdraw_copies(book.pk, current - count)
+        books_changed.send(sender=Book, book_ids=[book.pk])
+        promote_holds([book.pk])
+    return current
+
+
+def rebuild_loan_stats(batch_size=2000):
+    """
+    Recompute ``Book.borrow_count``, ``Book.available_count``, every ``UserLoanStats`` row and the
+    ``BorrowStatusCount`` stripes from the borrow requests and copies.
+
+    Only books whose counts drifted are written. Returns the number of books corrected and of users with stats.
+    """
+    loans = (
+        BorrowRequest.objects.filter(book=OuterRef('pk'), status__in=BorrowRequest.LOAN_STATUSES)
+        .order_by().values('book').annotate(count=Count('pk')).values('count')
+    )
+    actual = Coalesce(Subquery(loans), 0)
+    available = inventory.available_copies()
+    with transaction.atomic():
+        drifted = list(
+            Book.objects.alias(actual=actual, available=available)
+            .exclude(borrow_count=F('actual'), available_count=F('available')).values_list('pk', flat=True)
+        )
+        for start in range(0, len(drifted), batch_size):
+            Book.objects.filter(pk__in=drifted[start:start + batch_size]).update(
+                borrow_count=actual, available_count=available,
+            )
+        if drifted:
+            books_changed.send(sender=Book, book_ids=drifted)
+
+        history.forget(UserLoanStats.objects.values_list('user_id', flat=True).iterator(chunk_size=batch_size))
+        UserLoanStats.objects.all().delete()
+        active = Q(status__in=BorrowRequest.ACTIVE_LOAN_STATUSES)
+        totals = BorrowRequest.objects.order_by('borrower_id').values('borrower_id').annotate(
+            active_loans=Count('pk', filter=active),
+            loans=Count('pk', filter=Q(status__in=BorrowRequest.LOAN_STATUSES)),
+            next_due_date=Min('due_date', filter=active),
+            **{field: Count('pk', filter=Q(status=status)) for status, field in UserLoanStats.STATUS_FIELDS.items()},
+        )
+        stats = UserLoanStats.objects.bulk_create(
+            (
+                UserLoanStats(user_id=row.pop('borrower_id'), **row)
+                for row in totals.iterator(chunk_size=batch_size)
+            ),
+            batch_size=batch_size,
+        )
+        history.forget(row.user_id for row in stats)
+        history.rebuild_status_counts()
+    return len(drifted), len(stats)
+
+
+def mark_overdue(now=None, batch_size=1000):
+    """
+    Flag collected loans whose due date has passed, ``batch_size`` rows per transaction.
+
+    Safe to run repeatedly or from several workers: rows are only ever moved from not overdue to overdue.
+    Returns the number of loans flagged.
+    """
+    now = now or timezone.now()
+    due = BorrowRequest.objects.filter(status=BorrowRequest.COLLECTED, overdue=False, due_date__lt=now)
+    flagged = 0
+    while True:
+        with transaction.atomic():
+            batch = list(due.order_by('due_date').values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return flagged
+            flagged += due.filter(pk__in=batch).update(overdue=True)
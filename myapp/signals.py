@@ -0,0 +1,164 @@
+import contextvars
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from . import history, inventory, search
+from .models import Author, Book, BorrowRequest, Copy, Genre
+
+# Sent with ``book_ids`` after books change through queryset updates, which bypass post_save.
+books_changed = Signal()
+# Sent with Author or Genre as sender and the ``ids`` of rows created or updated in bulk, which bypasses post_save,
+# or no ids after ``delete_relations``.
+relations_changed = Signal()
+# Sent with BorrowRequest as sender and ``changes``, a list of ``(borrow_request_id, borrower_id, book_id, status)``
+# tuples, once the transaction that changed the statuses has committed.
+borrow_requests_changed = Signal()
+
+SEARCH_SOURCE_FIELDS = {'title', 'summary', 'publisher'}
+
+_bulk_delete = contextvars.ContextVar('bulk_delete', default=False)
+
+
+def in_bulk_delete():
+    """
+    Whether rows are being deleted by ``delete_books`` or ``delete_relations``, which do the work of the per-row
+    delete receivers once for the whole batch; those receivers return early while it is set.
+    """
+    return _bulk_delete.get()
+
+
+@contextmanager
+def _deleting_in_bulk():
+    token = _bulk_delete.set(True)
+    try:
+        yield
+    finally:
+        _bulk_delete.reset(token)
+
+
+def delete_books(queryset):
+    """Delete the books of ``queryset`` with a fixed number of queries however many there are."""
+    book_ids = list(queryset.values_list('pk', flat=True))
+    requests = BorrowRequest.objects.filter(book_id__in=book_ids).values_list('borrower_id', 'status')
+    changes = [(borrower_id, status, None) for borrower_id, status in requests]
+    with _deleting_in_bulk():
+        Book.objects.filter(pk__in=book_ids).delete()
+    # The books' copies went with them, so only the summaries and the index need to follow.
+    history.record(changes)
+    search.remove_books(book_ids)
+    books_changed.send(sender=Book, book_ids=book_ids)
+
+
+def delete_relations(queryset):
+    """Delete the authors or genres of ``queryset``, reindexing the books that listed them once for all."""
+    model = queryset.model
+    book_ids = list(
+        Book.objects.filter(**{f'{model.books.field.name}__in': queryset.values('pk')})
+        .order_by().values_list('pk', flat=True).distinct()
+    )
+    with _deleting_in_bulk():
+        queryset.delete()
+    Book.objects.filter(pk__in=book_ids).touch()
+    search.index_books(book_ids)
+    books_changed.send(sender=Book, book_ids=book_ids)
+    relations_changed.send(sender=model, ids=[])
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_SOURCE_FIELDS.intersection(update_fields):
+        return
+    search.index_books([instance.pk])
+
+
+@receiver(post_save, sender=Book)
+def shelve_new_book(sender, instance, created, raw=False, **kwargs):
+    # A new book comes with one copy; myapp.services.set_copies adds more.
+    if created and not raw:
+        inventory.add_copies([instance.pk])
+        instance.available_count = 1
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    if not in_bulk_delete():
+        search.remove_books([instance.pk])
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.genres.through)
+def reindex_book_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # The cleared books can no longer be read from the relation once post_clear fires.
+        instance._search_cleared_book_ids = list(instance.books.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        book_ids = [instance.pk]
+    elif action == 'post_clear':
+        book_ids = instance.__dict__.pop('_search_cleared_book_ids', [])
+    else:
+        book_ids = pk_set
+    # Relation changes do not save the book, but they change its representation.
+    Book.objects.filter(pk__in=book_ids).touch()
+    search.index_books(book_ids)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def reindex_relation_books(sender, instance, created, **kwargs):
+    if not created:
+        search.index_books(instance.books.values_list('pk', flat=True))
+
+
+@receiver(relations_changed)
+def reindex_bulk_relation_books(sender, ids, **kwargs):
+    search.index_books(Book.objects.filter(**{f'{sender.books.field.name}__in': ids}).values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def remember_relation_books(sender, instance, **kwargs):
+    if not in_bulk_delete():
+        instance._search_book_ids = list(instance.books.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def reindex_after_relation_delete(sender, instance, **kwargs):
+    book_ids = instance.__dict__.pop('_search_book_ids', None)
+    if book_ids:
+        Book.objects.filter(pk__in=book_ids).touch()
+        search.index_books(book_ids)
+
+
+@receiver(post_save, sender=BorrowRequest)
+def count_new_borrow_request(sender, instance, created, raw=False, **kwargs):
+    # Transitions are counted by myapp.services; creation can happen anywhere, so it is counted here.
+    if created and not raw:
+        history.record([(instance.borrower_id, None, instance.status)])
+
+
+@receiver(post_delete, sender=BorrowRequest)
+def uncount_deleted_borrow_request(sender, instance, **kwargs):
+    if in_bulk_delete():
+        return
+    history.record([(instance.borrower_id, instance.status, None)])
+    if instance.status in BorrowRequest.OPEN_STATUSES:
+        inventory.move_copies([(instance.copy_id, instance.book_id)], Copy.AVAILABLE)
+        # Served once the delete, and whatever cascaded with it, is committed, so no hold of a deleted user or
+        # book is promoted.
+        transaction.on_commit(partial(_serve_holds, instance.book_id), robust=True)
+
+
+def _serve_holds(book_id):
+    from .services import promote_holds
+
+    with transaction.atomic():
+        promote_holds([book_id])
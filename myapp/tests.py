@@ -1,8 +1,15 @@
-from datetime import date
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.urls import reverse
-from .models import Author, Book, BorrowRequest
+from . import analytics, history, importers, inventory, search, services
+from .models import Author, Book, BorrowRequest, BorrowStatusCount, CirculationRollup, Copy, Genre, Hold, UserLoanStats
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.models import Permission
 
@@ -140,7 +147,6 @@ class BorrowRequestTests(TestCase):
             title='Test Book',
             summary='Test summary',
             isbn='1234567890123',
-            available=True,
             published_date=date.today(),
             publisher='Test Publisher'
         )
@@ -203,7 +209,6 @@ class BookDetailViewTests(TestCase):
             title='Test Book',
             summary='This is a test book summary',
             isbn='1234567890123',
-            available=True,
             published_date=date.today(),
             publisher='Test Publisher'
         )
@@ -231,7 +236,8 @@ class BookDetailViewTests(TestCase):
     def test_create_borrow_request(self):
         self.client.login(username='testuser', password='password123')
 
-        response = self.client.post(reverse('book_detail', args=[self.book.pk]), {'borrow': True})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('book_detail', args=[self.book.pk]), {'borrow': True})
 
         self.assertEqual(response.status_code, 302)
 
@@ -264,8 +270,810 @@ class BookDetailViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
 
         borrow_request.refresh_from_db()
-        self.assertEqual(borrow_request.status, BorrowRequest.COMPLETE)
-        self.assertIsNotNone(borrow_request.complete_date)
+        self.assertEqual(borrow_request.status, BorrowRequest.COLLECTED)
+        self.assertIsNone(borrow_request.complete_date)
+
+
+class BookListQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.author = Author.objects.create(name='Author')
+        self.genre = Genre.objects.create(name='Genre')
+        self.book_count = 0
+
+    def add_books(self, count):
+        for _ in range(count):
+            self.book_count += 1
+            book = Book.objects.create(
+                title=f'Book {self.book_count}',
+                summary='Summary',
+                isbn=f'{self.book_count:013d}',
+                published_date=date.today(),
+                publisher='Publisher'
+            )
+            book.authors.add(self.author)
+            book.genres.add(self.genre)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_book_list_uses_constant_query_count(self):
+        url = reverse('book_list')
+        self.add_books(2)
+        small = self.count_queries(url)
+        self.add_books(10)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_book_detail_renders_relations_without_extra_queries(self):
+        self.client.login(username='testuser', password='password123')
+        self.add_books(1)
+        book = Book.objects.get()
+        url = reverse('book_detail', args=[book.pk])
+        few = self.count_queries(url)
+
+        book.authors.add(*[Author.objects.create(name=f'Extra {i}') for i in range(5)])
+        self.assertEqual(self.count_queries(url), few)
+
+
+class BookSummaryExcerptTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(
+            title='Test Book',
+            summary=' '.join(f'word{i}' for i in range(40)),
+            isbn='1234567890123',
+            published_date=date.today(),
+            publisher='Test Publisher'
+        )
+
+    def test_excerpt_is_stored_on_save(self):
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.summary_excerpt, ' '.join(f'word{i}' for i in range(30)) + '...')
+
+    def test_short_summary_is_kept_verbatim(self):
+        self.book.summary = 'A short summary.'
+        self.book.save(update_fields=['summary'])
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.summary_excerpt, 'A short summary.')
+
+    def test_book_list_renders_excerpt(self):
+        response = self.client.get(reverse('book_list'))
+        self.assertContains(response, 'word29...')
+        self.assertNotContains(response, 'word30')
+
+
+class BorrowServiceTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password123')
+        self.bob = User.objects.create_user(username='bob', password='password123')
+        self.book = Book.objects.create(
+            title='Test Book',
+            summary='Test summary',
+            isbn='1234567890123',
+            published_date=date.today(),
+            publisher='Test Publisher'
+        )
+        self.other_book = Book.objects.create(
+            title='Other Book',
+            summary='Test summary',
+            isbn='1234567890124',
+            published_date=date.today(),
+            publisher='Test Publisher'
+        )
+
+    def test_only_first_request_reserves_book(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            services.request_borrow(self.book, self.alice)
+
+        with self.assertRaises(services.BookUnavailable):
+            services.request_borrow(Book.objects.get(pk=self.book.pk), self.bob)
+
+        self.assertEqual(BorrowRequest.objects.filter(book=self.book).count(), 1)
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.available)
+
+        self.other_book.refresh_from_db()
+        self.assertTrue(self.other_book.available)
+
+    def test_duplicate_request_is_rejected(self):
+        BorrowRequest.objects.create(book=self.book, borrower=self.alice)
+
+        with self.assertRaises(services.DuplicateBorrowRequest):
+            services.request_borrow(self.book, self.alice)
+
+    def test_second_loan_for_same_book_is_rejected(self):
+        first = BorrowRequest.objects.create(book=self.book, borrower=self.alice)
+        second = BorrowRequest.objects.create(book=self.book, borrower=self.bob)
+        services.transition(first, 'approve')
+
+        with self.assertRaises(services.BookUnavailable):
+            services.transition(second, 'approve')
+
+        second.refresh_from_db()
+        self.assertEqual(second.status, BorrowRequest.PENDING)
+
+    def test_complete_releases_book(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            borrow_request = services.request_borrow(self.book, self.alice)
+            for action in ('approve', 'collect', 'complete'):
+                services.transition(borrow_request, action)
 
         self.book.refresh_from_db()
         self.assertTrue(self.book.available)
+
+    def test_decline_keeps_book_reserved_for_other_pending_requests(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            reserved = services.request_borrow(self.book, self.alice)
+        waiting = BorrowRequest.objects.create(book=self.book, borrower=self.bob)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            services.transition(waiting, 'decline')
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.available)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            services.transition(reserved, 'decline')
+        self.book.refresh_from_db()
+        self.assertTrue(self.book.available)
+
+    def test_transition_from_wrong_status_is_rejected(self):
+        borrow_request = BorrowRequest.objects.create(book=self.book, borrower=self.alice)
+
+        with self.assertRaises(services.InvalidTransition):
+            services.transition(borrow_request, 'collect')
+
+    def test_bulk_transition_reports_per_item_results(self):
+        first = BorrowRequest.objects.create(book=self.book, borrower=self.alice)
+        second = BorrowRequest.objects.create(book=self.book, borrower=self.bob)
+        other = BorrowRequest.objects.create(book=self.other_book, borrower=self.bob)
+
+        results = services.bulk_transition([
+            {'id': first.pk, 'action': 'approve', 'due_date': '2030-01-01'},
+            {'id': second.pk, 'action': 'approve'},
+            {'id': other.pk, 'action': 'collect'},
+            {'id': other.pk, 'action': 'decline'},
+            {'id': 9999, 'action': 'approve'},
+            {'id': first.pk, 'action': 'explode'},
+        ])
+
+        self.assertEqual(
+            [(result['ok'], result.get('code')) for result in results],
+            [(True, None), (False, 'unavailable'), (False, 'invalid_status'), (True, None),
+             (False, 'not_found'), (False, 'unknown_action')],
+        )
+        first.refresh_from_db()
+        self.assertEqual(first.status, BorrowRequest.APPROVED)
+        self.assertEqual(first.due_date.year, 2030)
+        other.refresh_from_db()
+        self.assertEqual(other.status, BorrowRequest.DECLINED)
+
+    def test_bulk_transition_can_return_and_reapprove_a_book(self):
+        loan = BorrowRequest.objects.create(book=self.book, borrower=self.alice, status=BorrowRequest.COLLECTED)
+        waiting = BorrowRequest.objects.create(book=self.book, borrower=self.bob)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            results = services.bulk_transition([
+                {'id': waiting.pk, 'action': 'approve'},
+                {'id': loan.pk, 'action': 'complete'},
+            ])
+
+        self.assertTrue(all(result['ok'] for result in results))
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.available)
+
+    def test_bulk_transition_uses_constant_query_count(self):
+        def run(count):
+            books = [
+                Book.objects.create(title=f'Bulk {count}-{i}', summary='', isbn=f'{count:03d}{i:010d}',
+                                    published_date=date.today(), publisher='P')
+                for i in range(count)
+            ]
+            requests = [BorrowRequest.objects.create(book=book, borrower=self.alice) for book in books]
+            with CaptureQueriesContext(connection) as context:
+                services.bulk_transition([{'id': request.pk, 'action': 'approve'} for request in requests])
+            return len(context.captured_queries)
+
+        self.assertEqual(run(2), run(20))
+
+
+class CopyInventoryTests(TestCase):
+    def setUp(self):
+        self.readers = [User.objects.create_user(username=f'reader{index}') for index in range(3)]
+        self.book = Book.objects.create(title='Test Book', summary='Test summary', isbn='1234567890123',
+                                        published_date=date.today(), publisher='Test Publisher')
+
+    def available_count(self):
+        return Book.objects.values_list('available_count', flat=True).get(pk=self.book.pk)
+
+    def test_new_book_has_one_copy(self):
+        self.assertEqual(self.book.available_count, 1)
+        self.assertEqual(list(self.book.copies.values_list('status', flat=True)), [Copy.AVAILABLE])
+
+    def test_each_borrower_gets_a_copy_of_their_own(self):
+        self.assertEqual(services.set_copies(self.book, 2), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = services.request_borrow(self.book, self.readers[0])
+            second = services.request_borrow(self.book, self.readers[1])
+        with self.assertRaises(services.BookUnavailable):
+            services.request_borrow(self.book, self.readers[2])
+
+        self.assertNotEqual(first.copy_id, second.copy_id)
+        self.assertEqual(self.available_count(), 0)
+
+        for action in ('approve', 'collect'):
+            services.transition(first, action)
+        self.assertEqual(Copy.objects.get(pk=first.copy_id).status, Copy.ON_LOAN)
+        with self.captureOnCommitCallbacks(execute=True):
+            services.transition(first, 'complete')
+        self.assertEqual(Copy.objects.get(pk=first.copy_id).status, Copy.AVAILABLE)
+        self.assertEqual(self.available_count(), 1)
+        services.request_borrow(self.book, self.readers[2])
+
+    def test_bulk_approval_claims_copies_for_requests_without_one(self):
+        services.set_copies(self.book, 2)
+        requests = [BorrowRequest.objects.create(book=self.book, borrower=reader) for reader in self.readers]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            results = services.bulk_transition([{'id': request.pk, 'action': 'approve'} for request in requests])
+
+        self.assertEqual([result.get('code') for result in results], [None, None, 'unavailable'])
+        copies = BorrowRequest.objects.filter(status=BorrowRequest.APPROVED).values_list('copy_id', flat=True)
+        self.assertEqual(len(set(copies) - {None}), 2)
+        self.assertEqual(self.available_count(), 0)
+
+    def test_copies_on_loan_are_not_withdrawn(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            services.request_borrow(self.book, self.readers[0])
+
+        self.assertEqual(services.set_copies(self.book, 0), 1)
+        self.assertEqual(services.set_copies(self.book, 3), 3)
+        self.assertEqual(self.available_count(), 2)
+
+    def test_deleting_an_open_request_frees_its_copy(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            borrow_request = services.request_borrow(self.book, self.readers[0])
+        self.assertEqual(self.available_count(), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            borrow_request.delete()
+
+        self.assertEqual(self.available_count(), 1)
+
+    def test_deleted_requests_hand_their_copy_to_the_queue(self):
+        services.request_borrow(self.book, self.readers[0])
+        services.borrow_or_hold(self.book, self.readers[1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BorrowRequest.objects.get(borrower=self.readers[0]).delete()
+
+        self.assertEqual(BorrowRequest.objects.get(borrower=self.readers[1]).status, BorrowRequest.PENDING)
+        self.assertFalse(Hold.objects.exists())
+
+    def test_free_copies_go_to_the_queue_before_new_borrowers(self):
+        services.request_borrow(self.book, self.readers[0])
+        services.borrow_or_hold(self.book, self.readers[1])
+        # Deleted without serving the queue, as if the process stopped before the commit callbacks ran.
+        BorrowRequest.objects.get(borrower=self.readers[0]).delete()
+
+        with self.assertRaises(services.BookUnavailable):
+            services.request_borrow(self.book, self.readers[2])
+        borrow_request, hold = services.borrow_or_hold(self.book, self.readers[2])
+
+        self.assertIsNone(borrow_request)
+        self.assertEqual(services.hold_position(hold), 1)
+        self.assertEqual(BorrowRequest.objects.get(borrower=self.readers[1]).status, BorrowRequest.PENDING)
+
+    def test_borrowing_from_the_head_of_the_queue_drops_the_hold(self):
+        services.request_borrow(self.book, self.readers[0])
+        services.borrow_or_hold(self.book, self.readers[1])
+        BorrowRequest.objects.get(borrower=self.readers[0]).delete()
+
+        services.request_borrow(self.book, self.readers[1])
+        services.set_copies(self.book, 2)
+
+        self.assertFalse(Hold.objects.exists())
+        self.assertEqual(BorrowRequest.objects.filter(borrower=self.readers[1]).count(), 1)
+        self.assertEqual(inventory.free_copies([self.book.pk]), {self.book.pk: 1})
+
+    def test_promotion_drops_holds_of_users_with_an_open_request(self):
+        services.request_borrow(self.book, self.readers[0])
+        for reader in self.readers[1:]:
+            services.borrow_or_hold(self.book, reader)
+        # Left behind by a request made some other way, such as the admin.
+        BorrowRequest.objects.create(book=self.book, borrower=self.readers[1])
+
+        services.set_copies(self.book, 2)
+
+        self.assertEqual(BorrowRequest.objects.get(borrower=self.readers[2]).status, BorrowRequest.PENDING)
+        self.assertEqual(BorrowRequest.objects.filter(borrower=self.readers[1]).count(), 1)
+        self.assertFalse(Hold.objects.exists())
+
+    def test_returned_copies_go_to_holds_in_order(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            loan = services.request_borrow(self.book, self.readers[0])
+        for action in ('approve', 'collect'):
+            services.transition(loan, action)
+        first = services.borrow_or_hold(self.book, self.readers[1])[1]
+        second = services.borrow_or_hold(self.book, self.readers[2])[1]
+        self.assertEqual([services.hold_position(first), services.hold_position(second)], [1, 2])
+        self.assertEqual(services.borrow_or_hold(self.book, self.readers[2])[1], second)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            services.transition(loan, 'complete')
+
+        promoted = BorrowRequest.objects.get(borrower=self.readers[1])
+        self.assertEqual((promoted.status, promoted.copy_id), (BorrowRequest.PENDING, loan.copy_id))
+        self.assertEqual(list(Hold.objects.values_list('user', flat=True)), [self.readers[2].pk])
+        self.assertEqual(services.hold_position(second), 1)
+        self.assertEqual(self.available_count(), 0)
+
+        services.transition(promoted, 'decline')
+        self.assertEqual(BorrowRequest.objects.get(borrower=self.readers[2]).copy_id, loan.copy_id)
+        self.assertFalse(Hold.objects.exists())
+
+    def test_promotion_reads_only_the_head_of_the_queue(self):
+        services.request_borrow(self.book, self.readers[0])
+        for reader in self.readers[1:]:
+            services.borrow_or_hold(self.book, reader)
+
+        with CaptureQueriesContext(connection) as context:
+            services.set_copies(self.book, 2)
+
+        self.assertEqual(BorrowRequest.objects.filter(status=BorrowRequest.PENDING).count(), 2)
+        self.assertEqual(Hold.objects.count(), 1)
+        queue_reads = [query['sql'] for query in context.captured_queries
+                       if query['sql'].startswith('SELECT') and '"myapp_hold"."user_id"' in query['sql']]
+        self.assertEqual(len(queue_reads), 1)
+        self.assertIn('LIMIT 1', queue_reads[0])
+
+    def test_claims_are_counted_once_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            services.request_borrow(self.book, self.readers[0])
+            self.assertEqual(self.available_count(), 1)
+            self.assertEqual(inventory.free_copies([self.book.pk]), {})
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.available_count(), 0)
+
+    def test_book_form_saves_the_book_and_its_copies_together(self):
+        librarian = User.objects.create_user(username='librarian', password='password', is_staff=True)
+        author = Author.objects.create(name='Author')
+        self.client.force_login(librarian)
+        form = {'title': 'New Book', 'summary': 'Summary', 'isbn': '9876543210123', 'published_date': '2023-01-01',
+                'publisher': 'Publisher', 'authors': [author.pk], 'copies': 3}
+
+        with mock.patch('myapp.views.set_copies', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            self.client.post(reverse('book_create'), form)
+        self.assertFalse(Book.objects.filter(isbn=form['isbn']).exists())
+
+        self.assertEqual(self.client.post(reverse('book_create'), form).status_code, 302)
+        self.assertEqual(inventory.in_circulation(Book.objects.get(isbn=form['isbn']).pk), 3)
+
+    def test_rebuild_loan_stats_fixes_available_count(self):
+        Book.objects.filter(pk=self.book.pk).update(available_count=5)
+
+        self.assertEqual(services.rebuild_loan_stats()[0], 1)
+        self.assertEqual(self.available_count(), 1)
+
+
+
+class LoanCounterTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password123')
+        self.bob = User.objects.create_user(username='bob', password='password123')
+        self.books = [
+            Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                published_date=date.today(), publisher='Publisher')
+            for index in range(2)
+        ]
+
+    def counters(self):
+        books = list(Book.objects.order_by('pk').values_list('borrow_count', flat=True))
+        users = {stats.user.username: (stats.active_loans, stats.loans) for stats in UserLoanStats.objects.all()}
+        return books, users
+
+    def lend(self, book, user):
+        borrow_request = services.request_borrow(book, user)
+        services.transition(borrow_request, 'approve')
+        services.transition(borrow_request, 'collect')
+        return borrow_request
+
+    def test_transitions_maintain_counters(self):
+        first = self.lend(self.books[0], self.alice)
+        self.assertEqual(self.counters(), ([1, 0], {'alice': (1, 1)}))
+
+        services.transition(first, 'complete')
+        self.lend(self.books[0], self.bob)
+        second = services.request_borrow(self.books[1], self.alice)
+        services.transition(second, 'decline')
+
+        self.assertEqual(self.counters(), ([2, 0], {'alice': (0, 1), 'bob': (1, 1)}))
+
+    def test_bulk_transition_counts_each_borrower(self):
+        requests = [services.request_borrow(book, self.alice) for book in self.books]
+        services.bulk_transition([{'id': borrow_request.pk, 'action': 'approve'} for borrow_request in requests])
+        services.bulk_transition([{'id': borrow_request.pk, 'action': 'collect'} for borrow_request in requests])
+
+        self.assertEqual(self.counters(), ([1, 1], {'alice': (2, 2)}))
+
+    def test_rebuild_corrects_drift(self):
+        self.lend(self.books[0], self.alice)
+        expected = self.counters()
+        Book.objects.update(borrow_count=7)
+        UserLoanStats.objects.update(loans=0)
+
+        out = StringIO()
+        call_command('rebuild_loan_stats', stdout=out)
+
+        self.assertEqual(self.counters(), expected)
+        self.assertIn('Corrected 2 book counts; rebuilt stats for 1 users.', out.getvalue())
+
+
+class BorrowHistorySummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.books = [
+            Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                published_date=date.today(), publisher='Publisher')
+            for index in range(3)
+        ]
+        self.soon = timezone.now() + timedelta(days=3)
+        self.later = timezone.now() + timedelta(days=10)
+        history.get_summary_cache().clear()
+
+    def counts(self):
+        summary = history.get_summary(self.user.pk)
+        return {field: summary[field] for field in ('pending', 'approved', 'collected', 'complete', 'declined')}
+
+    def test_transitions_update_the_summary(self):
+        first, second, third = (services.request_borrow(book, self.user) for book in self.books)
+        services.transition(first, 'approve', due_date=self.later.isoformat())
+        services.transition(second, 'approve', due_date=self.soon.isoformat())
+        services.transition(second, 'collect')
+        services.transition(third, 'decline')
+
+        self.assertEqual(self.counts(), {'pending': 0, 'approved': 1, 'collected': 1, 'complete': 0, 'declined': 1})
+        summary = history.get_summary(self.user.pk)
+        self.assertEqual((summary['active_loans'], summary['loans']), (2, 1))
+        self.assertEqual(summary['next_due_date'], self.soon)
+
+        services.transition(second, 'complete')
+
+        summary = history.get_summary(self.user.pk)
+        self.assertEqual((summary['collected'], summary['complete'], summary['active_loans']), (0, 1, 1))
+        self.assertEqual(summary['next_due_date'], self.later)
+
+    def test_summary_is_cached_until_it_changes(self):
+        borrow_request = services.request_borrow(self.books[0], self.user)
+        history.get_summary(self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.counts()['pending'], 1)
+
+        borrow_request.delete()
+
+        self.assertEqual(self.counts()['pending'], 0)
+
+    def test_rebuild_matches_the_incremental_summary(self):
+        borrow_request = services.request_borrow(self.books[0], self.user)
+        services.transition(borrow_request, 'approve', due_date=self.soon.isoformat())
+        services.request_borrow(self.books[1], self.user)
+        expected = history.get_summary(self.user.pk)
+        UserLoanStats.objects.update(pending=5, next_due_date=None)
+
+        services.rebuild_loan_stats()
+
+        self.assertEqual(history.get_summary(self.user.pk), expected)
+
+    def test_status_counts_follow_changes_and_read_in_one_query(self):
+        first, second = (services.request_borrow(book, self.user) for book in self.books[:2])
+        services.transition(first, 'approve', due_date=self.soon.isoformat())
+        second.delete()
+
+        with self.assertNumQueries(1):
+            counts = history.status_counts()
+        self.assertEqual(counts, {BorrowRequest.PENDING: 0, BorrowRequest.APPROVED: 1, BorrowRequest.COLLECTED: 0,
+                                  BorrowRequest.COMPLETE: 0, BorrowRequest.DECLINED: 0})
+
+        BorrowStatusCount.objects.update(count=7)
+        services.rebuild_loan_stats()
+        self.assertEqual(history.status_counts(), counts)
+
+    def test_history_page_is_paginated_with_a_fixed_number_of_queries(self):
+        BorrowRequest.objects.bulk_create(
+            BorrowRequest(book=self.books[index % 3], borrower=self.user, status=BorrowRequest.COMPLETE)
+            for index in range(30)
+        )
+        # bulk_create bypasses the summaries the pages are counted from.
+        services.rebuild_loan_stats()
+        self.client.login(username='reader', password='password123')
+        self.client.get(reverse('borrow_history'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('borrow_history'))
+        with self.assertNumQueries(len(queries)):
+            following = self.client.get(reverse('borrow_history'), {'page': 2})
+
+        self.assertEqual(len(response.context['borrow_requests']), 25)
+        self.assertEqual(len(following.context['borrow_requests']), 5)
+        self.assertContains(response, 'Page 1 of 2')
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+
+        User.objects.create_user(username='librarian', password='password123', is_staff=True)
+        self.client.login(username='librarian', password='password123')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('borrow_history'))
+        self.assertContains(response, 'Page 1 of 2')
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+
+
+class BorrowRequestQueueTests(TestCase):
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', is_staff=True)
+        self.reader = User.objects.create_user(username='reader', password='password123')
+        now = timezone.now()
+        self.requests = {}
+        for index, status in enumerate([BorrowRequest.COMPLETE, BorrowRequest.PENDING, BorrowRequest.DECLINED,
+                                        BorrowRequest.COLLECTED, BorrowRequest.APPROVED]):
+            book = Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                       published_date=date.today(), publisher='Publisher')
+            self.requests[status] = BorrowRequest.objects.create(
+                book=book, borrower=self.reader, status=status, request_date=now - timedelta(days=10 - index),
+            )
+        history.get_summary_cache().clear()
+        self.client.login(username='librarian', password='password123')
+
+    def test_open_requests_are_listed_oldest_first_by_default(self):
+        response = self.client.get(reverse('borrow_requests'))
+
+        expected = [self.requests[status] for status in (BorrowRequest.PENDING, BorrowRequest.COLLECTED,
+                                                         BorrowRequest.APPROVED)]
+        self.assertEqual(list(response.context['borrow_requests']), expected)
+        self.assertEqual(response.context['paginator'].count, 3)
+
+    def test_statuses_can_be_selected(self):
+        response = self.client.get(reverse('borrow_requests'), {'status': ['complete', 'declined', 'bogus']})
+
+        self.assertEqual(list(response.context['borrow_requests']),
+                         [self.requests[BorrowRequest.COMPLETE], self.requests[BorrowRequest.DECLINED]])
+        self.assertEqual(response.context['status_query'], 'status=complete&status=declined')
+
+    def test_pages_are_counted_from_the_summaries(self):
+        for index in range(60):
+            book = Book.objects.create(title=f'Queued {index}', summary='Summary', isbn=f'9{index:012d}',
+                                       published_date=date.today(), publisher='Publisher')
+            services.request_borrow(book, self.reader)
+        self.client.get(reverse('borrow_requests'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('borrow_requests'), {'page': 2})
+
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+        self.assertEqual(response.context['paginator'].count, 63)
+        self.assertEqual(len(response.context['borrow_requests']), 13)
+
+    def test_readers_are_sent_home(self):
+        self.client.login(username='reader', password='password123')
+
+        self.assertRedirects(self.client.get(reverse('borrow_requests')), reverse('home'))
+
+
+class OverdueSweepTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        now = timezone.now()
+        self.loans = {}
+        for index, (name, status, due_date) in enumerate([
+            ('late', BorrowRequest.COLLECTED, now - timedelta(days=2)),
+            ('late_too', BorrowRequest.COLLECTED, now - timedelta(days=1)),
+            ('on_time', BorrowRequest.COLLECTED, now + timedelta(days=1)),
+            ('approved', BorrowRequest.APPROVED, now - timedelta(days=1)),
+        ]):
+            book = Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                       published_date=date.today(), publisher='Publisher')
+            self.loans[name] = BorrowRequest.objects.create(
+                book=book, borrower=self.user, status=status, due_date=due_date,
+            )
+
+    def flagged(self):
+        return set(BorrowRequest.objects.filter(overdue=True).values_list('pk', flat=True))
+
+    def test_flags_only_collected_loans_past_due(self):
+        self.assertEqual(services.mark_overdue(batch_size=1), 2)
+        self.assertEqual(self.flagged(), {self.loans['late'].pk, self.loans['late_too'].pk})
+
+    def test_sweep_is_idempotent(self):
+        services.mark_overdue()
+        self.assertEqual(services.mark_overdue(), 0)
+
+    def test_command_runs_a_single_sweep(self):
+        out = StringIO()
+        call_command('sweep_overdue', batch_size=10, stdout=out)
+        self.assertIn('Flagged 2 overdue loans.', out.getvalue())
+
+
+class CatalogueImportTests(TestCase):
+    CSV = (
+        'title,summary,isbn,published_date,publisher,authors,genres\n'
+        'Dune,Desert planet,9780000000001,1965-08-01,Chilton,Frank Herbert,Science Fiction\n'
+        'Good Omens,Apocalypse,9780000000002,1990-05-01,Gollancz,Terry Pratchett; Neil Gaiman,Fantasy;Comedy\n'
+        'Broken,,9780000000003,not a date,Nobody,Someone,\n'
+    )
+
+    def import_csv(self, text, batch_size=1000):
+        return importers.import_catalogue(importers.read_csv(StringIO(text)), batch_size=batch_size)
+
+    def test_imports_books_with_relations(self):
+        existing = Author.objects.create(name='Frank Herbert')
+
+        stats = self.import_csv(self.CSV, batch_size=1)
+
+        self.assertEqual((stats.created, stats.updated, len(stats.errors)), (2, 0, 1))
+        self.assertEqual(stats.errors[0][0], 4)
+        dune = Book.objects.get(isbn='9780000000001')
+        self.assertEqual(list(dune.authors.all()), [existing])
+        self.assertEqual(dune.summary_excerpt, 'Desert planet')
+        omens = Book.objects.get(isbn='9780000000002')
+        self.assertEqual(sorted(omens.authors.values_list('name', flat=True)), ['Neil Gaiman', 'Terry Pratchett'])
+        self.assertEqual(sorted(omens.genres.values_list('name', flat=True)), ['Comedy', 'Fantasy'])
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(search.search_books('pratchett', limit=10), [omens.pk])
+
+    def test_reimport_updates_in_place(self):
+        self.import_csv(self.CSV)
+        dune = Book.objects.get(isbn='9780000000001')
+        services.set_copies(dune, 0)
+
+        stats = self.import_csv(
+            'title,summary,isbn,published_date,publisher,authors\n'
+            'Dune Messiah,Sequel,9780000000001,1969-10-01,Putnam,Frank Herbert;Brian Herbert\n'
+        )
+
+        self.assertEqual((stats.created, stats.updated), (0, 1))
+        dune.refresh_from_db()
+        self.assertEqual((dune.title, dune.publisher, dune.available), ('Dune Messiah', 'Putnam', False))
+        self.assertEqual(dune.authors.count(), 2)
+        self.assertEqual(list(dune.genres.values_list('name', flat=True)), ['Science Fiction'])
+
+    def test_batch_query_count_does_not_depend_on_size(self):
+        def rows(count, offset):
+            for index in range(count):
+                yield index, {
+                    'title': f'Book {index}', 'isbn': f'{offset + index:013d}', 'published_date': '2000-01-01',
+                    'publisher': 'Publisher', 'authors': [f'Author {offset + index}'], 'genres': [f'Genre {offset}'],
+                }
+
+        with CaptureQueriesContext(connection) as small:
+            importers.import_catalogue(rows(2, 0))
+        with CaptureQueriesContext(connection) as large:
+            importers.import_catalogue(rows(20, 1000))
+
+        self.assertEqual(len(small), len(large))
+
+    def test_jsonl_coerces_numbers_and_skips_lines_that_are_not_objects(self):
+        jsonl = StringIO(
+            '{"title": "Emma", "isbn": 9780000000010, "published_date": "1815-12-23", "publisher": "Murray"}\n'
+            '["Persuasion", "9780000000011"]\n'
+            '{"title": "Sanditon", "isbn": "9780000000012", "published_date": "1925-01-01", "publisher": "Murray", '
+            '"authors": {"name": "Jane Austen"}}\n'
+            '{"title": ["Lady Susan"], "isbn": "9780000000013", "published_date": "1871-01-01", "publisher": "Bentley"}\n'
+        )
+
+        stats = importers.import_catalogue(importers.read_jsonl(jsonl))
+
+        self.assertEqual((stats.processed, stats.created), (4, 1))
+        self.assertEqual([line for line, _ in stats.errors], [2, 3, 4])
+        self.assertEqual(Book.objects.get().isbn, '9780000000010')
+
+    def test_command_reads_jsonl_and_marc(self):
+        jsonl = StringIO(
+            '{"title": "Emma", "isbn": "9780000000010", "published_date": "1815-12-23", "publisher": "Murray", '
+            '"authors": ["Jane Austen"], "genres": ["Novel"]}\n'
+        )
+        marc = StringIO(
+            '020 9780000000011\n245 Persuasion\n100 Jane Austen\n260 Murray\n362 1817-12-20\n650 Novel\n'
+            '\n'
+            '020 9780000000012\n245 Sanditon\n100 Jane Austen\n260 Murray\n362 1925-01-01\n'
+        )
+
+        out = StringIO()
+        with mock.patch('sys.stdin', jsonl):
+            call_command('import_catalogue', '-', format='jsonl', stdout=out)
+        with mock.patch('sys.stdin', marc):
+            call_command('import_catalogue', '-', format='marc', stdout=out)
+
+        self.assertIn('Imported 1 books (1 created, 0 updated, 0 skipped)', out.getvalue())
+        self.assertIn('Imported 2 books (2 created, 0 updated, 0 skipped)', out.getvalue())
+        self.assertEqual(Author.objects.get().books.count(), 3)
+        self.assertEqual(Genre.objects.get().books.count(), 2)
+
+    def test_only_the_first_errors_are_kept(self):
+        jsonl = StringIO('not json\n' * 50)
+
+        out, err = StringIO(), StringIO()
+        with mock.patch('sys.stdin', jsonl):
+            call_command('import_catalogue', '-', format='jsonl', max_errors=2, stdout=out, stderr=err)
+
+        self.assertIn('(0 created, 0 updated, 50 skipped)', out.getvalue())
+        self.assertEqual(err.getvalue().count('Line '), 2)
+        self.assertIn('... and 48 more errors.', err.getvalue())
+
+
+class CirculationRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password123')
+        self.author = Author.objects.create(name='Author')
+        self.genre = Genre.objects.create(name='Genre')
+        self.books = []
+        for index in range(2):
+            book = Book.objects.create(title=f'Book {index}', summary='Summary', isbn=f'{index:013d}',
+                                       published_date=date.today(), publisher='Publisher')
+            book.authors.add(self.author)
+            self.books.append(book)
+        self.books[0].genres.add(self.genre)
+        self.day = timezone.now().replace(year=2024, month=3, day=4, hour=10, minute=0, second=0, microsecond=0)
+
+    def loan(self, book, approved_days, completed_days=None):
+        approved = self.day + timedelta(days=approved_days)
+        BorrowRequest.objects.create(
+            book=book, borrower=self.user, approval_date=approved,
+            status=BorrowRequest.APPROVED if completed_days is None else BorrowRequest.COMPLETE,
+            complete_date=None if completed_days is None else approved + timedelta(days=completed_days),
+        )
+
+    def rollup(self, dimension, key_id=0):
+        return {
+            rollup.day: (rollup.loans, rollup.completed, rollup.loan_time.days)
+            for rollup in CirculationRollup.objects.filter(dimension=dimension, key_id=key_id)
+        }
+
+    def test_rolls_up_every_dimension(self):
+        self.loan(self.books[0], 0, completed_days=4)
+        self.loan(self.books[1], 0)
+
+        analytics.rollup_circulation(now=self.day + timedelta(days=30), window=timedelta(days=3))
+
+        first, fourth = self.day.date(), (self.day + timedelta(days=4)).date()
+        self.assertEqual(self.rollup('total'), {first: (2, 0, 0), fourth: (0, 1, 4)})
+        self.assertEqual(self.rollup('book', self.books[1].pk), {first: (1, 0, 0)})
+        self.assertEqual(self.rollup('author', self.author.pk), {first: (2, 0, 0), fourth: (0, 1, 4)})
+        self.assertEqual(self.rollup('genre', self.genre.pk), {first: (1, 0, 0), fourth: (0, 1, 4)})
+
+    def test_runs_only_fold_new_events(self):
+        self.loan(self.books[0], 0)
+        analytics.rollup_circulation(now=self.day + timedelta(days=1))
+        self.assertEqual(analytics.rollup_circulation(now=self.day + timedelta(days=1)), 0)
+
+        self.loan(self.books[1], 2)
+        analytics.rollup_circulation(now=self.day + timedelta(days=3))
+
+        self.assertEqual(
+            self.rollup('total'), {self.day.date(): (1, 0, 0), (self.day + timedelta(days=2)).date(): (1, 0, 0)},
+        )
+
+    def test_lag_leaves_recent_events_for_the_next_run(self):
+        self.loan(self.books[0], 0)
+
+        analytics.rollup_circulation(now=self.day + timedelta(minutes=1))
+
+        self.assertFalse(CirculationRollup.objects.exists())
+
+    def test_weekly_ranking(self):
+        self.loan(self.books[0], 0, completed_days=1)
+        self.loan(self.books[0], 1, completed_days=1)
+        self.loan(self.books[0], 7)
+        self.loan(self.books[1], 2)
+        analytics.rollup_circulation(now=self.day + timedelta(days=30))
+
+        weekly = list(analytics.circulation(CirculationRollup.BOOK, 'week'))
+        ranked = list(analytics.circulation(CirculationRollup.BOOK, 'total'))
+
+        monday = self.day.date()
+        self.assertEqual([(row['period'], row['key_id'], row['loans']) for row in weekly], [
+            (monday, self.books[0].pk, 2), (monday, self.books[1].pk, 1),
+            (monday + timedelta(days=7), self.books[0].pk, 1),
+        ])
+        self.assertEqual([(row['key_id'], row['loans']) for row in ranked], [(self.books[0].pk, 3), (self.books[1].pk, 1)])
@@ -1,17 +1,23 @@
+from urllib.parse import urlencode
+
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
 from django.contrib.auth.views import LoginView, LogoutView
 from django.contrib.auth.forms import AuthenticationForm
-from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.generic import View, ListView, CreateView, UpdateView, DeleteView
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.contrib import messages
+from . import history
 from .forms import UserRegistrationForm, AuthorForm, GenreForm, BookForm
 from django.views.generic import TemplateView
 from django.urls import reverse_lazy
-from .models import Author, Genre, BorrowRequest, Book
+from django.utils.functional import cached_property
+from .models import Author, Genre, BorrowRequest, Book, Hold, UserLoanStats
 from .permissions import LibrarianOrAdminMixin, AdminOnlyMixin
+from .services import BorrowError, borrow_or_hold, hold_position, set_copies, transition
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 
 
@@ -63,11 +69,27 @@ class BorrowHistoryView(LoginRequiredMixin, ListView):
     model = BorrowRequest
     template_name = 'borrow_history.html'
     context_object_name = 'borrow_requests'
+    paginate_by = 25
 
     def get_queryset(self):
+        borrow_requests = BorrowRequest.objects.select_related('book').order_by('-request_date', '-pk')
+        if self.request.user.is_staff:
+            return borrow_requests
+        return borrow_requests.filter(borrower=self.request.user)
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        # Counted from the summaries, which hold the same totals, instead of COUNT(*) over the history.
         if self.request.user.is_staff:
-            return BorrowRequest.objects.all()
-        return BorrowRequest.objects.filter(borrower=self.request.user)
+            count = sum(history.status_counts().values())
+        else:
+            summary = history.get_summary(self.request.user.pk)
+            count = sum(summary[field] for field in UserLoanStats.STATUS_FIELDS.values())
+        return KnownCountPaginator(queryset, per_page, count=count, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['summary'] = history.get_summary(self.request.user.pk)
+        return context
 
 
 class AuthorListView(LibrarianOrAdminMixin, ListView):
@@ -130,6 +152,13 @@ class BookCreateUpdateMixin(LoginRequiredMixin, UserPassesTestMixin):
     def test_func(self):
         return self.request.user.is_staff
 
+    def form_valid(self, form):
+        # A book is never left saved with a copy count other than the one asked for.
+        with transaction.atomic():
+            response = super().form_valid(form)
+            set_copies(self.object, form.cleaned_data['copies'])
+        return response
+
 
 class BookCreateView(BookCreateUpdateMixin, CreateView):
     success_url = reverse_lazy('book_list')
@@ -154,21 +183,28 @@ class BookListView(ListView):
     context_object_name = 'books'
 
     def get_queryset(self):
-        return Book.objects.all()
+        return Book.objects.for_listing().defer('summary')
+
+
+def _hold_message(hold):
+    return f'Every copy is out; you are number {hold_position(hold)} in the hold queue.'
 
 
 @method_decorator(login_required, name='dispatch')
 class BookDetailView(View):
     def get(self, request, pk):
-        book = get_object_or_404(Book, pk=pk)
+        book = get_object_or_404(Book.objects.for_listing(), pk=pk)
         user_borrow_request = None
+        hold = None
 
         if request.user.is_authenticated:
             user_borrow_request = BorrowRequest.objects.filter(book=book, borrower=request.user).first()
+            hold = Hold.objects.filter(book=book, user=request.user).first()
 
         context = {
             'book': book,
-            'user_borrow_request': user_borrow_request
+            'user_borrow_request': user_borrow_request,
+            'hold_position': hold_position(hold) if hold else None,
         }
         return render(request, 'book_detail.html', context)
 
@@ -177,22 +213,22 @@ class BookDetailView(View):
         user_borrow_request = BorrowRequest.objects.filter(book=book, borrower=request.user).first()
 
         if 'borrow' in request.POST:
-            if not user_borrow_request:
-                BorrowRequest.objects.create(book=book, borrower=request.user, status=BorrowRequest.PENDING)
-                book.available = False
-                book.save()
-                messages.success(request, 'Your borrow request has been submitted.')
-            else:
-                messages.error(request, 'You already have a borrow request for this book.')
+            try:
+                _, hold = borrow_or_hold(book, request.user)
+                if hold is None:
+                    messages.success(request, 'Your borrow request has been submitted.')
+                else:
+                    messages.info(request, _hold_message(hold))
+            except BorrowError as exc:
+                messages.error(request, str(exc))
 
         elif ('collect' in request.POST and user_borrow_request
               and user_borrow_request.status == BorrowRequest.APPROVED):
-            user_borrow_request.status = BorrowRequest.COMPLETE
-            user_borrow_request.complete_date = timezone.now()
-            user_borrow_request.save()
-            book.available = True
-            book.save()
-            messages.success(request, 'You have collected the book.')
+            try:
+                transition(user_borrow_request, 'collect')
+                messages.success(request, 'You have collected the book.')
+            except BorrowError as exc:
+                messages.error(request, str(exc))
 
         return redirect('book_detail', pk=book.pk)
 
@@ -201,48 +237,86 @@ class BorrowRequestView(View):
     def post(self, request, pk):
         book = get_object_or_404(Book, pk=pk)
 
-        if not BorrowRequest.objects.filter(book=book, borrower=request.user).exists():
-            BorrowRequest.objects.create(book=book, borrower=request.user)
-            messages.success(request, f"You have successfully requested to borrow '{book.title}'.")
-        else:
-            messages.warning(request, f"You have already requested to borrow '{book.title}'.")
+        try:
+            _, hold = borrow_or_hold(book, request.user)
+            if hold is None:
+                messages.success(request, f"You have successfully requested to borrow '{book.title}'.")
+            else:
+                messages.info(request, _hold_message(hold))
+        except BorrowError as exc:
+            messages.warning(request, str(exc))
 
         return redirect('book_list')
 
 
-class BorrowRequestListView(View):
-    def get(self, request):
+class KnownCountPaginator(Paginator):
+    """A paginator given its count up front, so paging never runs COUNT(*)."""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self._count = count
+
+    @cached_property
+    def count(self):
+        return self._count
+
+
+class BorrowRequestListView(ListView):
+    """The librarian's work queue: requests in the selected statuses, oldest first, open ones by default."""
+    template_name = 'borrow_requests.html'
+    context_object_name = 'borrow_requests'
+    paginate_by = 50
+    status_names = {label.lower(): status for status, label in BorrowRequest.STATUS_CHOICES}
+
+    def dispatch(self, request, *args, **kwargs):
         if not request.user.is_staff:
             return redirect('home')
+        return super().dispatch(request, *args, **kwargs)
 
-        borrow_requests = BorrowRequest.objects.all()
-        return render(request, 'borrow_requests.html', {'borrow_requests': borrow_requests})
+    def get_statuses(self):
+        names = self.request.GET.getlist('status')
+        statuses = [self.status_names[name] for name in names if name in self.status_names]
+        return sorted(set(statuses)) or list(BorrowRequest.OPEN_STATUSES)
+
+    def get_queryset(self):
+        # Served by borrow_queue_idx, which leads with the status.
+        return BorrowRequest.objects.filter(status__in=self.get_statuses()).select_related(
+            'book', 'borrower',
+        ).order_by('request_date', 'pk')
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        counts = history.status_counts()
+        return KnownCountPaginator(
+            queryset, per_page, count=sum(counts[status] for status in self.get_statuses()), **kwargs,
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        statuses = self.get_statuses()
+        context['status_filters'] = [
+            (name, status in statuses) for name, status in self.status_names.items()
+        ]
+        context['status_query'] = urlencode(
+            [('status', name) for name, status in self.status_names.items() if status in statuses]
+        )
+        return context
 
 
 class BorrowRequestUpdateView(LibrarianOrAdminMixin, View):
+    success_messages = {
+        'approve': 'The borrow request has been approved.',
+        'decline': 'The borrow request has been declined.',
+        'collect': 'The borrow request has been marked as collected.',
+        'complete': 'The borrow request has been completed.',
+    }
+
     def post(self, request, pk, action):
         borrow_request = get_object_or_404(BorrowRequest, pk=pk)
 
-        if action == 'approve':
-            if borrow_request.book.available:
-                borrow_request.status = BorrowRequest.APPROVED
-                borrow_request.approval_date = timezone.now()
-                borrow_request.book.available = False
-                borrow_request.book.save()
-                messages.success(request, 'The borrow request has been approved.')
-            else:
-                messages.error(request, 'The book is not available.')
-
-        elif action == 'decline':
-            borrow_request.status = BorrowRequest.DECLINED
-            messages.success(request, 'The borrow request has been declined.')
-
-        elif action == 'complete':
-            borrow_request.status = BorrowRequest.COMPLETE
-            borrow_request.complete_date = timezone.now()
-            borrow_request.book.available = True
-            borrow_request.book.save()
-            messages.success(request, 'The borrow request has been completed.')
+        try:
+            transition(borrow_request, action)
+            messages.success(request, self.success_messages[action])
+        except BorrowError as exc:
+            messages.error(request, str(exc))
 
-        borrow_request.save()
         return redirect('borrow_requests')
@@ -1,15 +1,139 @@
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.exceptions import AuthenticationFailed
+"""
+Token authentication with a sliding expiry and cached token lookups.
+
+Resolved tokens are kept in a small per-process LRU in front of the shared ``TOKEN_CACHE_ALIAS`` cache, so
+most requests authenticate without touching the database. Tokens are renewed by moving ``Token.created``
+forward, which only happens once ``TOKEN_RENEW_AFTER`` of the TTL has passed, so an active client costs one
+write per renewal window rather than one per request.
+
+``invalidate_token`` drops a key from the shared cache and this process's LRU; other processes forget it once
+their ``TOKEN_LOCAL_CACHE_TIMEOUT`` runs out.
+
+``authenticate_cached`` answers from the LRU alone, which async views use to authenticate inside the event loop.
+"""
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
 from django.utils.timezone import now
-from datetime import timedelta
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+
+class LocalTokenCache:
+    """A thread-safe LRU of resolved tokens whose entries also expire after ``timeout`` seconds."""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_tokens = LocalTokenCache(
+    size=getattr(settings, 'TOKEN_LOCAL_CACHE_SIZE', 1024),
+    timeout=getattr(settings, 'TOKEN_LOCAL_CACHE_TIMEOUT', 10),
+)
+
+
+def get_token_cache():
+    return caches[settings.TOKEN_CACHE_ALIAS]
+
+
+def _cache_key(key):
+    return f'auth:token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def _remember(key, user, token):
+    entry = (user, token)
+    get_token_cache().set(_cache_key(key), entry, timeout=settings.TOKEN_TTL.total_seconds())
+    local_tokens.set(key, entry)
+
+
+def invalidate_token(key):
+    get_token_cache().delete(_cache_key(key))
+    local_tokens.delete(key)
 
 
 class ExpiringTokenAuthentication(TokenAuthentication):
+    def authenticate_cached(self, request):
+        """
+        Return what ``authenticate`` would without doing any I/O, or ``NotImplemented`` when that needs the
+        shared cache or the database: the token is not in this process's LRU, is due for renewal, or the
+        header is malformed and ``authenticate`` should report it.
+        """
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            return NotImplemented
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            return NotImplemented
+
+        entry = local_tokens.get(key)
+        if entry is None:
+            return NotImplemented
+        user, token = entry
+        if not user.is_superuser and now() - token.created > settings.TOKEN_TTL * settings.TOKEN_RENEW_AFTER:
+            return NotImplemented
+        return copy.copy(user), token
+
     def authenticate_credentials(self, key):
-        user, token = super().authenticate_credentials(key)
+        entry = local_tokens.get(key)
+        if entry is None:
+            entry = get_token_cache().get(_cache_key(key))
+            if entry is None:
+                entry = super().authenticate_credentials(key)
+                _remember(key, *entry)
+            else:
+                local_tokens.set(key, entry)
+
+        user, token = entry
+        if user.is_superuser:
+            return copy.copy(user), token
 
-        if now() - token.created > timedelta(minutes=1) and not user.is_superuser:
+        age = now() - token.created
+        if age > settings.TOKEN_TTL:
             token.delete()
             raise AuthenticationFailed('Token has expired')
 
-        return user, token
+        if age > settings.TOKEN_TTL * settings.TOKEN_RENEW_AFTER:
+            token = copy.copy(token)
+            token.created = now()
+            token.__class__.objects.filter(key=key).update(created=token.created)
+            _remember(key, user, token)
+
+        return copy.copy(user), token
@@ -0,0 +1,245 @@
+"""
+Per-view request metrics.
+
+``MetricsMiddleware`` measures every request and records its latency, query count and database time under the
+resolved URL name. Queries are timed by a wrapper installed on each database connection (see
+``connection.execute_wrapper``) which adds to the tally of the request in progress, found through a context
+variable so queries made from ``sync_to_async`` threads are counted too. Responses carry the figures in a
+``Server-Timing`` header.
+
+``registry`` aggregates without locking on the request path: every thread records into its own shard, and the
+shards are only merged when ``/metrics`` is scraped. A scrape may see a request half recorded, which Prometheus
+tolerates; it never blocks a request. When a thread exits, its shard is folded into a retired total, so servers
+that start a thread per request or recycle their pools do not keep a shard for every thread they ever ran.
+"""
+import contextvars
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.permissions import IsAdminUser
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UNRESOLVED = '<unresolved>'
+
+
+class Tally:
+    """The queries of one request."""
+    __slots__ = ('queries', 'db_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_tally = contextvars.ContextVar('metrics_tally', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    tally = _tally.get()
+    if tally is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        tally.db_time += time.perf_counter() - started
+        tally.queries += 1
+
+
+def instrument(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+@receiver(connection_created, dispatch_uid='metrics_instrument_connection')
+def instrument_new_connection(sender, connection, **kwargs):
+    instrument(connection)
+
+
+class Series:
+    """Totals for one view, written by a single thread."""
+    __slots__ = ('count', 'duration', 'queries', 'db_time', 'buckets')
+
+    def __init__(self, size):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        # One counter per bucket plus one for +Inf; not cumulative until exported.
+        self.buckets = [0] * (size + 1)
+
+    def add(self, other):
+        self.count += other.count
+        self.duration += other.duration
+        self.queries += other.queries
+        self.db_time += other.db_time
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+
+class _ShardHolder:
+    """Holds a thread's shard in its ``threading.local``; dropped, and so finalized, when the thread exits."""
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self):
+        self.shard = {}
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        # Totals of the threads that have exited.
+        self._retired = {}
+        # Reentrant: a finalizer may run on a thread that already holds it.
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = self._local.holder = _ShardHolder()
+            with self._lock:
+                self._shards.append(holder.shard)
+            weakref.finalize(holder, self._retire, holder.shard)
+        return holder.shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            self._merge(self._retired, shard.copy())
+
+    def _merge(self, totals, shard):
+        for view, series in shard.items():
+            total = totals.get(view)
+            if total is None:
+                total = totals[view] = Series(len(self.buckets))
+            total.add(series)
+
+    def record(self, view, duration, queries, db_time):
+        shard = self._shard()
+        series = shard.get(view)
+        if series is None:
+            series = shard[view] = Series(len(self.buckets))
+        series.count += 1
+        series.duration += duration
+        series.queries += queries
+        series.db_time += db_time
+        series.buckets[bisect_left(self.buckets, duration)] += 1
+
+    def collect(self):
+        """Return a ``Series`` per view summed over every thread's shard."""
+        totals = {}
+        with self._lock:
+            shards = list(self._shards)
+            self._merge(totals, self._retired)
+        for shard in shards:
+            # dict.copy() does not release the GIL, so it is safe against the owning thread adding a view.
+            self._merge(totals, shard.copy())
+        return totals
+
+    def clear(self):
+        with self._lock:
+            self._retired.clear()
+            for shard in self._shards:
+                shard.clear()
+
+    def render(self):
+        """The collected metrics in the Prometheus text exposition format."""
+        totals = sorted(self.collect().items())
+        lines = [
+            '# HELP http_request_duration_seconds Request latency by view.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for view, series in totals:
+            label = _label(view)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series.buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{view="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{{view="{label}"}} {series.duration}')
+            lines.append(f'http_request_duration_seconds_count{{view="{label}"}} {series.count}')
+        for name, attribute, help_text in (
+            ('http_request_db_queries_total', 'queries', 'Database queries by view.'),
+            ('http_request_db_seconds_total', 'db_time', 'Time spent in database queries by view.'),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for view, series in totals:
+                lines.append(f'{name}{{view="{_label(view)}"}} {getattr(series, attribute)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry(getattr(settings, 'METRICS_BUCKETS', DEFAULT_BUCKETS))
+
+
+class MetricsMiddleware:
+    """Record every request in ``registry`` and describe it in a ``Server-Timing`` header."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.asynchronous = iscoroutinefunction(get_response)
+        if self.asynchronous:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.asynchronous:
+            return self.__acall__(request)
+        # Connections opened before this module was imported missed connection_created.
+        for connection in connections.all(initialized_only=True):
+            instrument(connection)
+        tally, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _tally.reset(token)
+        return self.finish(request, response, tally, started)
+
+    async def __acall__(self, request):
+        tally, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _tally.reset(token)
+        return self.finish(request, response, tally, started)
+
+    @staticmethod
+    def start():
+        tally = Tally()
+        return tally, _tally.set(tally), time.perf_counter()
+
+    @staticmethod
+    def finish(request, response, tally, started):
+        duration = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        registry.record(match.view_name if match else UNRESOLVED, duration, tally.queries, tally.db_time)
+        response['Server-Timing'] = (
+            f'db;dur={tally.db_time * 1000:.1f};desc="{tally.queries} queries", total;dur={duration * 1000:.1f}'
+        )
+        return response
+
+
+class MetricsView(APIView):
+    """Prometheus scrape endpoint, for staff with a token or a session."""
+    authentication_classes = [SessionAuthentication, *api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+from datetime import timedelta
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mysite.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -62,8 +65,25 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.IdCursorPagination',
+    'PAGE_SIZE': 50,
 }
 
+API_MAX_PAGE_SIZE = 200
+API_BULK_MAX_ITEMS = 500
+# Serve the async variants of the read-heavy views (api/asyncviews.py); mysite/asgi.py turns this on.
+API_ASYNC_VIEWS = os.environ.get('API_ASYNC_VIEWS') == '1'
+
+# API tokens expire TOKEN_TTL after they were issued or last renewed; superuser tokens never expire.
+TOKEN_TTL = timedelta(hours=8)
+# Fraction of TOKEN_TTL after which a used token is renewed; renewal is the only write authentication makes.
+TOKEN_RENEW_AFTER = 0.5
+TOKEN_CACHE_ALIAS = 'default'
+# Per-process LRU in front of the shared cache. Entries live TOKEN_LOCAL_CACHE_TIMEOUT seconds, which bounds
+# how long another process may keep accepting a token after logout.
+TOKEN_LOCAL_CACHE_SIZE = 1024
+TOKEN_LOCAL_CACHE_TIMEOUT = 10
+
 
 ROOT_URLCONF = 'mysite.urls'
 
@@ -93,10 +113,48 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts so concurrent writers queue on the busy timeout
+            # instead of failing when a read lock cannot be upgraded.
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # A file rather than shared memory, where concurrent writers fail with "table is locked" instead of
+        # waiting, so the tests of the concurrent benchmark clients can run.
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'library-default',
+    },
+}
+
+# Alias of the cache holding public catalogue responses; point it at a shared backend in production.
+CATALOGUE_CACHE_ALIAS = 'default'
+CATALOGUE_CACHE_TIMEOUT = 300
+
+# Alias of the cache holding per-user borrow history summaries (myapp/history.py).
+LOAN_SUMMARY_CACHE_ALIAS = 'default'
+LOAN_SUMMARY_CACHE_TIMEOUT = 300
+
+# Borrow request event streams (api/events.py), served by the ASGI application. Streams send a comment every
+# EVENTS_HEARTBEAT seconds, close after EVENTS_MAX_AGE so clients resync, and keep at most EVENTS_BUFFER
+# unsent events.
+EVENTS_HEARTBEAT = 15
+EVENTS_MAX_AGE = 300
+EVENTS_BUFFER = 100
+
+# Upper bounds, in seconds, of the per-view latency histogram exported at /metrics (mysite/metrics.py).
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -0,0 +1,236 @@
+"""
+Query budgets for every endpoint of ``api.urls`` and ``myapp.urls``.
+
+Each endpoint is requested by a librarian with a small and a large library loaded. The number of queries must
+not grow with the data, which catches N+1 patterns, and must stay within the endpoint's entry in
+``query_budgets.json``. Endpoints that write are sent the requests in ``WRITES`` instead of a GET, with
+payloads as large as the library, and budgeted as ``name:method``; each is rolled back before the next.
+After a deliberate change, regenerate the file with::
+
+    UPDATE_QUERY_BUDGETS=1 python manage.py test mysite
+"""
+import json
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+import api.urls
+import myapp.urls
+from mysite.authentication import local_tokens
+from myapp import analytics, services
+from myapp.models import Author, Book, BorrowRequest, Genre, Hold
+
+BUDGETS = Path(__file__).with_name('query_budgets.json')
+SIZES = (3, 12)
+
+# Endpoints that change the session or stream until the client leaves.
+SKIPPED = {'logout', 'api_logout', 'api_borrow_request_events'}
+
+# URL name -> the kwargs to reverse it with, from the fixtures.
+ARGUMENTS = {
+    'author_update': lambda library: {'pk': library.author.pk},
+    'author_delete': lambda library: {'pk': library.author.pk},
+    'author-detail': lambda library: {'pk': library.author.pk},
+    'genre_update': lambda library: {'pk': library.genre.pk},
+    'genre_delete': lambda library: {'pk': library.genre.pk},
+    'genre-detail': lambda library: {'pk': library.genre.pk},
+    'book_update': lambda library: {'pk': library.book.pk},
+    'book_delete': lambda library: {'pk': library.book.pk},
+    'book_detail': lambda library: {'pk': library.book.pk},
+    'book-detail': lambda library: {'pk': library.book.pk},
+    'api_book-detail': lambda library: {'book_id': library.book.pk},
+    'borrow_request': lambda library: {'pk': library.spare.pk},
+    'borrow_request_update': lambda library: {'pk': library.borrow_request.pk, 'action': 'approve'},
+    'borrowrequest-detail': lambda library: {'pk': library.borrow_request.pk},
+    'api_user_loan_stats': lambda library: {'user_id': library.librarian.pk},
+    'api_hold': lambda library: {'book_id': library.book.pk},
+}
+
+# URL name -> query string, for endpoints with required parameters.
+QUERY_STRINGS = {
+    'book-search': 'q=book',
+}
+
+# URL name -> {method: payload from the fixtures}, for endpoints to measure with something other than a GET.
+# Dicts are posted as forms and lists as JSON; bulk payloads list as many items as the library has rows.
+WRITES = {
+    'api_login': {'post': lambda library: {'username': 'librarian', 'password': 'password123'}},
+    'api_register': {'post': lambda library: {'username': 'newcomer', 'password': 'secret', 'confirm_password': 'secret'}},
+    'borrow_request': {'post': lambda library: {}},
+    'borrow_request_update': {'post': lambda library: {}},
+    'borrowrequest-list': {'get': lambda library: None, 'post': lambda library: {'book': library.spare.pk}},
+    'borrowrequest-bulk': {'post': lambda library: [
+        {'id': pk, 'action': TRANSITION_FROM[status]}
+        for pk, status in BorrowRequest.objects.exclude(borrower=library.librarian)
+        .filter(status__in=TRANSITION_FROM).values_list('pk', 'status')
+    ]},
+    'author-bulk': {
+        'post': lambda library: [{'name': f'New author {index}'} for index in range(library.size)],
+        'patch': lambda library: [{'id': author.pk, 'bio': 'Updated'} for author in library.authors],
+        'delete': lambda library: [author.pk for author in library.authors],
+    },
+    'genre-bulk': {
+        'post': lambda library: [{'name': f'New genre {index}'} for index in range(library.size)],
+        'patch': lambda library: [{'id': genre.pk, 'name': f'{genre.name}!'} for genre in library.genres],
+        'delete': lambda library: [genre.pk for genre in library.genres],
+    },
+    'book-bulk': {
+        'post': lambda library: [
+            {'title': f'New book {index}', 'summary': 'A summary', 'isbn': f'9{index:012d}',
+             'published_date': '2023-01-01', 'publisher': 'Publisher',
+             'authors': [library.authors[index].pk], 'genres': [library.genres[index].pk]}
+            for index in range(library.size)
+        ],
+        'patch': lambda library: [{'id': book.pk, 'title': f'{book.title}!'} for book in library.books],
+        'delete': lambda library: [book.pk for book in library.books],
+    },
+}
+# Open status -> the transition the bulk request applies to requests in it.
+TRANSITION_FROM = {
+    BorrowRequest.PENDING: 'approve',
+    BorrowRequest.APPROVED: 'collect',
+    BorrowRequest.COLLECTED: 'complete',
+}
+
+
+def endpoints():
+    """Yield ``(name, kwarg names)`` for every named URL of the two URLconfs, format suffix variants aside."""
+    def walk(patterns):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                yield from walk(pattern.url_patterns)
+                continue
+            kwargs = set(pattern.pattern.regex.groupindex)
+            if pattern.name and 'format' not in kwargs:
+                yield pattern.name, kwargs
+
+    seen = set()
+    for urlconf in (myapp.urls, api.urls):
+        for name, kwargs in walk(urlconf.urlpatterns):
+            if name not in seen:
+                seen.add(name)
+                yield name, kwargs
+
+
+class Library:
+    """
+    ``size`` authors, genres and books, a borrow request in every status, mostly the librarian's, and a hold of
+    the librarian's behind ``size`` others, plus a spare book on the shelf for the librarian to borrow.
+    """
+
+    def __init__(self, size):
+        now = timezone.now()
+        self.size = size
+        self.librarian = User.objects.create_superuser(username='librarian', password='password123')
+        self.token = Token.objects.create(user=self.librarian)
+        readers = [User.objects.create_user(username=f'reader{index}') for index in range(size)]
+        authors = [Author.objects.create(name=f'Author {index}') for index in range(size)]
+        genres = [Genre.objects.create(name=f'Genre {index}') for index in range(size)]
+        books = []
+        for index in range(size):
+            book = Book.objects.create(title=f'Book {index}', summary='A summary', isbn=f'{index:013d}',
+                                       published_date='2023-01-01', publisher='Publisher')
+            book.authors.set([authors[index], authors[index - 1]])
+            book.genres.set([genres[index]])
+            books.append(book)
+
+        statuses = (BorrowRequest.PENDING, BorrowRequest.APPROVED, BorrowRequest.COLLECTED, BorrowRequest.DECLINED)
+        for index, book in enumerate(books):
+            BorrowRequest.objects.create(
+                book=book, borrower=self.librarian, status=BorrowRequest.COMPLETE,
+                request_date=now - timedelta(days=30), approval_date=now - timedelta(days=29),
+                due_date=now - timedelta(days=15), complete_date=now - timedelta(days=16),
+            )
+            status = statuses[index % len(statuses)]
+            active = status in BorrowRequest.ACTIVE_LOAN_STATUSES
+            BorrowRequest.objects.create(
+                book=book, borrower=readers[index], status=status, overdue=status == BorrowRequest.COLLECTED,
+                approval_date=now - timedelta(days=20) if active else None,
+                due_date=now - timedelta(days=6) if active else None,
+            )
+        for reader in readers:
+            Hold.objects.create(book=books[0], user=reader)
+        Hold.objects.create(book=books[0], user=self.librarian)
+        services.rebuild_loan_stats()
+        analytics.rollup_circulation(now=now + analytics.DEFAULT_LAG)
+
+        self.spare = Book.objects.create(title='Spare', summary='A summary', isbn='8' * 13,
+                                         published_date='2023-01-01', publisher='Publisher')
+        self.authors, self.genres, self.books = authors, genres, books
+        self.author, self.genre, self.book = authors[0], genres[0], books[0]
+        self.borrow_request = BorrowRequest.objects.filter(status=BorrowRequest.PENDING).order_by('pk').first()
+
+
+class QueryBudgetTests(TestCase):
+
+    def send(self, library, path, method, payload):
+        """Make one request, read the whole response and return the number of queries it took."""
+        headers = {'HTTP_AUTHORIZATION': f'Token {library.token.key}'}
+        if isinstance(payload, list):
+            headers.update(data=json.dumps(payload), content_type='application/json')
+        elif payload is not None:
+            headers['data'] = payload
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        local_tokens.clear()
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(path, **headers)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            count = len(queries)
+            transaction.set_rollback(True)
+        if response.status_code in (405, 400):
+            self.fail(f'{method.upper()} {path} answered {response.status_code}; add it to WRITES or fix its payload.')
+        return count
+
+    def measure(self, size):
+        """Return ``{name: queries}`` for every endpoint with a library of ``size`` loaded."""
+        counts = {}
+        with transaction.atomic():
+            library = Library(size)
+            self.client.force_login(library.librarian)
+            for name, kwargs in endpoints():
+                if name in SKIPPED:
+                    continue
+                if kwargs and name not in ARGUMENTS:
+                    self.fail(f'No arguments for {name}; add it to ARGUMENTS or SKIPPED.')
+                path = reverse(name, kwargs=ARGUMENTS[name](library) if kwargs else None)
+                if name in QUERY_STRINGS:
+                    path = f'{path}?{QUERY_STRINGS[name]}'
+                if name not in WRITES:
+                    counts[name] = self.send(library, path, 'get', None)
+                    continue
+                for method, payload in WRITES[name].items():
+                    counts[f'{name}:{method}'] = self.send(library, path, method, payload(library))
+            transaction.set_rollback(True)
+        return counts
+
+    def test_query_counts_do_not_grow_with_the_data(self):
+        small, large = (self.measure(size) for size in SIZES)
+
+        if os.environ.get('UPDATE_QUERY_BUDGETS'):
+            BUDGETS.write_text(json.dumps(dict(sorted(large.items())), indent=2) + '\n')
+        budgets = json.loads(BUDGETS.read_text())
+
+        problems = []
+        for name, count in large.items():
+            if count != small[name]:
+                problems.append(f'{name}: {small[name]} queries with {SIZES[0]} rows, {count} with {SIZES[1]}')
+            if name not in budgets:
+                problems.append(f'{name}: no budget in {BUDGETS.name}')
+            elif count > budgets[name]:
+                problems.append(f'{name}: {count} queries, over its budget of {budgets[name]}')
+        problems.extend(f'{name}: budgeted but no longer requested' for name in budgets.keys() - large.keys())
+        if problems:
+            self.fail('\n'.join(problems))